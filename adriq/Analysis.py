@@ -0,0 +1,128 @@
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+
+class Shared_Array:
+    """
+    A NumPy array copied into a shared memory segment, so a worker process can map it
+    instead of receiving it pickled through a pipe. Only the segment name, shape and
+    dtype are pickled. The creating process owns the segment and releases it.
+    """
+    def __init__(self, array):
+        array = np.ascontiguousarray(array)
+        self.shape = array.shape
+        self.dtype = array.dtype.str
+        self._shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        self.name = self._shm.name
+        np.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)[...] = array
+
+    def __getstate__(self):
+        return {"shape": self.shape, "dtype": self.dtype, "name": self.name, "_shm": None}
+
+    def open(self):
+        """Map the segment in a worker. Returns (segment, array); close the segment when done."""
+        # Pool workers share the creating process's resource tracker, so attaching
+        # registers nothing new and the segment is only unlinked by release()
+        shm = shared_memory.SharedMemory(name=self.name)
+        return shm, np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf)
+
+    def release(self):
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def _call(func, args, kwargs):
+    # Runs in the worker: map the shared arguments, call func and copy the result out
+    # before the segments are closed
+    segments = []
+    def resolve(arg):
+        if isinstance(arg, Shared_Array):
+            shm, array = arg.open()
+            segments.append(shm)
+            return array
+        return arg
+    try:
+        result = func(*[resolve(arg) for arg in args], **{key: resolve(arg) for key, arg in kwargs.items()})
+        return _detach(result)
+    finally:
+        for shm in segments:
+            shm.close()
+
+
+def _detach(result):
+    # Results that are views of a shared argument would point at a closed segment
+    if isinstance(result, np.ndarray):
+        return result.copy() if result.base is not None else result
+    if isinstance(result, (list, tuple)):
+        return type(result)(_detach(item) for item in result)
+    return result
+
+
+class Analysis_Pool:
+    """
+    Runs CPU heavy analysis (filter_runs, compute_time_diffs, fits) in worker processes,
+    so it doesn't hold the GIL of the server process and acquisition, counting and
+    other clients' calls stay responsive. run() blocks the calling thread only.
+
+    Array arguments with at least `inline_below` elements are passed through shared
+    memory; if there are none the call is cheaper to run inline than to ship to a
+    worker, so it is. func must be a module level function (it is pickled by name).
+
+    On Windows the workers are started with spawn and import the main script again, so
+    a script that creates a pool (e.g. a QuTau_Reader with analysis_workers) must start
+    the experiment under if __name__ == "__main__":, or every worker would run it too.
+    """
+    def __init__(self, workers=1, inline_below=100000):
+        self.workers = workers
+        self.inline_below = inline_below
+        self.executor = None
+        self.pending = set()  # Futures submitted and not done yet, cancelled by close
+        self.lock = threading.Lock()
+
+    def _executor(self):
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def run(self, func, *args, **kwargs):
+        """Call func(*args, **kwargs) in a worker and return its result."""
+        arrays = [arg for arg in list(args) + list(kwargs.values()) if isinstance(arg, np.ndarray)]
+        if not any(arg.size >= self.inline_below for arg in arrays):
+            return func(*args, **kwargs)
+
+        shared = []
+        def share(arg):
+            if isinstance(arg, np.ndarray) and arg.size >= self.inline_below:
+                shared.append(Shared_Array(arg))
+                return shared[-1]
+            return arg
+        try:
+            args = [share(arg) for arg in args]
+            kwargs = {key: share(arg) for key, arg in kwargs.items()}
+            future = self._executor().submit(_call, func, args, kwargs)
+            with self.lock:
+                self.pending.add(future)
+            future.add_done_callback(self._done)
+            return future.result()
+        finally:
+            for array in shared:
+                array.release()
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def close(self):
+        with self.lock:
+            executor, self.executor = self.executor, None
+            pending, self.pending = self.pending, set()
+        if executor is not None:
+            # Cancel what hasn't started (shutdown's cancel_futures needs Python 3.9)
+            for future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,479 @@
+import os
+import time
+import threading
+import numpy as np
+
+
+class Timestamp_Ring_Buffer:
+    """
+    Preallocated ring buffer of raw QuTau events (timestamps in timebase units and channels).
+
+    There is a single writer and any number of readers, each with its own cursor. The
+    writer reserves the region it is about to overwrite before copying and only then
+    advances `head`, so readers never take a lock: after copying they check whether the
+    writer has lapped them and drop (and report) anything that was overwritten.
+    """
+    def __init__(self, capacity=2**24):
+        self.capacity = int(capacity)
+        self.tstamp = np.zeros(self.capacity, dtype=np.int64)
+        self.tchannel = np.zeros(self.capacity, dtype=np.int8)
+        self.head = 0  # Total number of events ever written
+        self._reserved = 0  # End of the region currently being written
+
+    def write(self, tstamp, tchannel):
+        n = len(tstamp)
+        if n == 0:
+            return
+        if n > self.capacity:
+            # Only the newest events fit, the rest are counted as written and lost
+            self.head += n - self.capacity
+            tstamp = tstamp[-self.capacity:]
+            tchannel = tchannel[-self.capacity:]
+            n = self.capacity
+
+        self._reserved = self.head + n
+        start = self.head % self.capacity
+        first = min(n, self.capacity - start)
+        self.tstamp[start:start + first] = tstamp[:first]
+        self.tchannel[start:start + first] = tchannel[:first]
+        if first < n:
+            self.tstamp[:n - first] = tstamp[first:]
+            self.tchannel[:n - first] = tchannel[first:]
+        self.head += n
+
+    def read(self, cursor):
+        """Copy out all events from cursor to head. Returns (tstamp, tchannel, new_cursor, lost)."""
+        head = self.head
+        lost = 0
+        oldest = head - self.capacity
+        if cursor < oldest:
+            lost += oldest - cursor
+            cursor = oldest
+
+        start = cursor % self.capacity
+        n = head - cursor
+        first = min(n, self.capacity - start)
+        tstamp = np.empty(n, dtype=np.int64)
+        tchannel = np.empty(n, dtype=np.int8)
+        tstamp[:first] = self.tstamp[start:start + first]
+        tchannel[:first] = self.tchannel[start:start + first]
+        if first < n:
+            tstamp[first:] = self.tstamp[:n - first]
+            tchannel[first:] = self.tchannel[:n - first]
+
+        # Anything the writer reserved while we were copying may have overwritten our start
+        overrun = self._reserved - self.capacity - cursor
+        if overrun > 0:
+            overrun = min(overrun, n)
+            lost += overrun
+            tstamp = tstamp[overrun:]
+            tchannel = tchannel[overrun:]
+
+        return tstamp, tchannel, head, lost
+
+    def subscribe(self):
+        """Return a subscriber whose cursor starts at the current head."""
+        return Ring_Buffer_Subscriber(self, self.head)
+
+
+class Ring_Buffer_Subscriber:
+    def __init__(self, ring, cursor):
+        self.ring = ring
+        self.cursor = cursor
+        self.lost = 0  # Events overwritten before this subscriber read them
+
+    def read(self):
+        tstamp, tchannel, self.cursor, lost = self.ring.read(self.cursor)
+        self.lost += lost
+        return tstamp, tchannel
+
+    def skip(self):
+        """Discard everything not yet read."""
+        self.cursor = self.ring.head
+
+    def lag(self):
+        return self.ring.head - self.cursor
+
+
+class Count_History:
+    """
+    Fixed-capacity history of count rates: sample times in epoch seconds and one float64
+    series per named channel, in preallocated ring buffers. Samples are numbered from 0
+    in the order they are added, so a cursor (the number of the next sample wanted)
+    lets a poller fetch only what is new with get_since instead of the whole history.
+    """
+    def __init__(self, names, capacity=100):
+        self.names = list(names)
+        self.capacity = int(capacity)
+        self.times = np.zeros(self.capacity)
+        self.values = np.zeros((len(self.names), self.capacity))
+        self.head = 0  # Number of samples ever added
+        self.start = 0  # First sample still valid after a clear
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.head - max(self.start, self.head - self.capacity)
+
+    def append(self, t, values):
+        """Add one sample: time t and one value per channel, in the order of names."""
+        with self.lock:
+            i = self.head % self.capacity
+            self.times[i] = t
+            self.values[:, i] = values
+            self.head += 1
+
+    def extend(self, times, values):
+        """Add several samples: an array of times and a (channels, samples) array of values."""
+        with self.lock:
+            n = len(times)
+            if n > self.capacity:
+                self.head += n - self.capacity
+                times, values = times[-self.capacity:], values[:, -self.capacity:]
+                n = self.capacity
+            idx = np.arange(self.head, self.head + n) % self.capacity
+            self.times[idx] = times
+            self.values[:, idx] = values
+            self.head += n
+
+    def clear(self):
+        with self.lock:
+            self.start = self.head
+
+    def resize(self, capacity):
+        """Change the capacity, keeping the newest samples."""
+        with self.lock:
+            times, values = self._copy(self.head - len(self))
+            self.capacity = int(capacity)
+            self.times = np.zeros(self.capacity)
+            self.values = np.zeros((len(self.names), self.capacity))
+            n = min(len(times), self.capacity)
+            self.start = self.head - n
+            idx = np.arange(self.start, self.head) % self.capacity
+            self.times[idx] = times[len(times) - n:]
+            self.values[:, idx] = values[:, len(times) - n:]
+
+    def _copy(self, cursor):
+        oldest = max(self.start, self.head - self.capacity)
+        cursor = min(max(cursor, oldest), self.head)
+        idx = np.arange(cursor, self.head) % self.capacity
+        return self.times[idx], self.values[:, idx]
+
+    def get(self):
+        """Return (times, {name: values}) for the whole history, oldest first."""
+        times, values, _ = self.get_since(0)
+        return times, values
+
+    def get_since(self, cursor):
+        """
+        Return (times, {name: values}, cursor) for the samples from cursor on, and the
+        cursor to pass next time. Samples already overwritten are skipped; a cursor from
+        before a clear restarts at the first sample after it.
+        """
+        with self.lock:
+            times, values = self._copy(cursor)
+            return times, dict(zip(self.names, values)), self.head
+
+    def latest(self):
+        """Return {name: newest value}, or None if there are no samples."""
+        with self.lock:
+            if len(self) == 0:
+                return None
+            i = (self.head - 1) % self.capacity
+            return dict(zip(self.names, self.values[:, i]))
+
+
+class Time_Diff_Store:
+    """
+    Append-only float64 array that grows by doubling, so appends are amortised O(1)
+    and view() is a zero-copy view of everything stored. It keeps a running summary
+    (count, sum, sum of squares, min, max and the number of values above
+    outlier_threshold) so nothing has to scan the whole store.
+    """
+    def __init__(self, capacity=1024, outlier_threshold=None):
+        self.data = np.empty(int(capacity))
+        self.length = 0
+        self.outlier_threshold = outlier_threshold
+        self._reset_summary()
+
+    def _reset_summary(self):
+        self.total = 0.0
+        self.total_squares = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.outliers = 0
+
+    def __len__(self):
+        return self.length
+
+    def __array__(self, dtype=None, copy=None):
+        view = self.view()
+        return view if dtype is None else view.astype(dtype)
+
+    def _reserve(self, length):
+        if length > len(self.data):
+            data = np.empty(max(length, 2 * len(self.data)))
+            data[:self.length] = self.data[:self.length]
+            self.data = data
+
+    def append(self, values):
+        """Append an array of values; returns how many of them are outliers."""
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return 0
+        self._reserve(self.length + n)
+        self.data[self.length:self.length + n] = values
+        self.length += n
+        return self._summarise(values)
+
+    def _summarise(self, values):
+        self.total += values.sum()
+        self.total_squares += np.dot(values, values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        outliers = 0
+        if self.outlier_threshold is not None:
+            outliers = int(np.count_nonzero(values > self.outlier_threshold))
+            self.outliers += outliers
+        return outliers
+
+    def view(self, start=0, stop=None):
+        """The stored values (or a slice of them), without copying. Valid until the next append."""
+        stop = self.length if stop is None else min(stop, self.length)
+        return self.data[start:stop]
+
+    def clear(self):
+        self.length = 0
+        self._reset_summary()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def summary(self):
+        n = self.length
+        mean = self.total / n if n else np.nan
+        std = np.sqrt(max(self.total_squares / n - mean**2, 0)) if n else np.nan
+        return {"count": n, "mean": mean, "std": std,
+                "min": self.min if n else np.nan, "max": self.max if n else np.nan,
+                "outliers": self.outliers}
+
+
+class Mapped_Time_Diff_Store(Time_Diff_Store):
+    """
+    Time_Diff_Store backed by memory-mapped files, so the stored diffs are limited by
+    disk rather than RAM and survive a crash of the process.
+
+    The values are kept in segment files <path>.0, <path>.1, ... of segment_size
+    float64 values each. A segment is created at full size and never resized, so
+    mappings held elsewhere (views from view(), or another process reading with
+    open_time_diffs) stay valid while the store grows; on Windows a mapped file can't
+    be resized at all. <path> itself holds the number of values and the segment size
+    as two int64s. The count is only updated by flush() after the values are written,
+    which happens every flush_interval seconds on append, so a reader never sees
+    values that are not there yet. An existing store is appended to.
+    """
+    HEADER = 2  # int64s in <path>: number of values, segment size
+
+    def __init__(self, path, segment_size=2**20, outlier_threshold=None, flush_interval=5.0):
+        self.path = path
+        self.outlier_threshold = outlier_threshold
+        self.flush_interval = flush_interval
+        if not os.path.exists(path) or os.path.getsize(path) < 8 * self.HEADER:
+            np.array([0, segment_size], dtype=np.int64).tofile(path)
+        self.header = np.memmap(path, dtype=np.int64, mode='r+', shape=(self.HEADER,))
+        self.length = int(self.header[0])
+        self.segment_size = int(self.header[1])
+        self.segments = []
+        self._reserve(max(self.length, 1))
+        self._reset_summary()
+        for index, segment in enumerate(self.segments):
+            values = segment[:max(0, self.length - index * self.segment_size)]
+            if len(values):
+                self._summarise(values)
+        self._last_flush = time.time()
+
+    def _reserve(self, length):
+        while len(self.segments) * self.segment_size < length:
+            path = f"{self.path}.{len(self.segments)}"
+            size = 8 * self.segment_size
+            if not os.path.exists(path) or os.path.getsize(path) < size:
+                # Only a segment nobody has mapped yet is ever resized
+                with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                    f.truncate(size)
+            self.segments.append(np.memmap(path, dtype=np.float64, mode='r+', shape=(self.segment_size,)))
+
+    def append(self, values):
+        """Append an array of values; returns how many of them are outliers."""
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if n == 0:
+            return 0
+        self._reserve(self.length + n)
+        written = 0
+        while written < n:
+            index, offset = divmod(self.length + written, self.segment_size)
+            chunk = min(n - written, self.segment_size - offset)
+            self.segments[index][offset:offset + chunk] = values[written:written + chunk]
+            written += chunk
+        self.length += n
+        outliers = self._summarise(values)
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+        return outliers
+
+    def view(self, start=0, stop=None):
+        """
+        The stored values (or a slice of them): a view of the file if they lie within
+        one segment, otherwise a copy.
+        """
+        return _join_segments(self.segments, self.segment_size, self.length, start, stop)
+
+    def clear(self):
+        super().clear()
+        self.flush()
+
+    def flush(self):
+        if self.header is None:
+            return
+        for segment in self.segments:
+            segment.flush()
+        self.header[0] = self.length
+        self.header.flush()
+        self._last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        self.header = None
+        self.segments = []
+
+
+def _join_segments(segments, segment_size, length, start, stop):
+    start, stop, _ = slice(start, stop).indices(length)
+    parts = []
+    position = start
+    while position < stop:
+        index, offset = divmod(position, segment_size)
+        chunk = min(stop - position, segment_size - offset)
+        parts.append(segments[index][offset:offset + chunk])
+        position += chunk
+    if len(parts) == 1:
+        return parts[0]
+    return np.concatenate(parts) if parts else np.zeros(0)
+
+
+def open_time_diffs(path, start=0, stop=None):
+    """
+    Open a Mapped_Time_Diff_Store read-only, e.g. for analysis while acquisition is
+    still appending to it. Returns the values flushed so far, or the slice start:stop
+    of them: a memory-mapped array if they lie within one segment, so nothing is read
+    from disk until it is used, otherwise a copy. The mapping stays valid while the
+    store grows.
+    """
+    length, segment_size = (int(value) for value in np.fromfile(path, dtype=np.int64, count=Mapped_Time_Diff_Store.HEADER))
+    segments = [np.memmap(f"{path}.{index}", dtype=np.float64, mode='r', shape=(segment_size,))
+                for index in range(-(-length // segment_size))]
+    return _join_segments(segments, segment_size, length, start, stop)
+
+
+class Count_Rollups:
+    """
+    Min/mean/max rollups of a Count_History for long-term monitoring at constant memory.
+    Every sample appended goes to the history, to a raw buffer of the last raw_span
+    seconds at the sample rate (independent of the history's capacity, which is set by
+    update_N) and into the current bucket of each tier; tiers are (bucket width in
+    seconds, number of buckets kept), by default 1 s buckets for an hour, 10 s for a day
+    and 1 min for a week. Each tier is a Count_History of bucket start times with the
+    min, mean and max of every channel.
+
+    query picks the finest tier that covers the requested span without returning many
+    more points than the plot has pixels, so a day of data is a few thousand points.
+    """
+    def __init__(self, history, rate, raw_span=60, tiers=((1, 3600), (10, 8640), (60, 10080))):
+        self.history = history
+        self.names = history.names
+        n = len(self.names)
+        self.raw_span = raw_span
+        self.raw = Count_History(self.names, self._raw_capacity(rate))
+        self.widths = [float(width) for width, _ in tiers]
+        self.tiers = [Count_History([f"{name} {stat}" for stat in ("min", "mean", "max") for name in self.names], capacity)
+                      for _, capacity in tiers]
+        self._bucket = [None] * len(tiers)  # Index of the bucket being filled
+        self._count = np.zeros(len(tiers))
+        self._sum = np.zeros((len(tiers), n))
+        self._min = np.full((len(tiers), n), np.inf)
+        self._max = np.full((len(tiers), n), -np.inf)
+
+    def _raw_capacity(self, rate):
+        return max(1, int(np.ceil(rate * self.raw_span)) + 1)
+
+    def set_rate(self, rate):
+        """Keep raw_span seconds of raw samples at the new sample rate."""
+        self.raw.resize(self._raw_capacity(rate))
+
+    def append(self, t, values):
+        """Add one sample to the history, the raw buffer and the rollups."""
+        self.history.append(t, values)
+        self.raw.append(t, values)
+        values = np.asarray(values, dtype=np.float64)
+        for i, width in enumerate(self.widths):
+            bucket = int(t // width)
+            if bucket != self._bucket[i]:
+                self._close(i)
+                self._bucket[i] = bucket
+            self._count[i] += 1
+            self._sum[i] += values
+            np.minimum(self._min[i], values, out=self._min[i])
+            np.maximum(self._max[i], values, out=self._max[i])
+
+    def _close(self, i):
+        if self._count[i]:
+            self.tiers[i].append(self._bucket[i] * self.widths[i],
+                                 np.concatenate((self._min[i], self._sum[i] / self._count[i], self._max[i])))
+        self._count[i] = 0
+        self._sum[i] = 0
+        self._min[i] = np.inf
+        self._max[i] = -np.inf
+
+    def flush(self):
+        """Close the buckets being filled, e.g. before a long pause in counting."""
+        for i in range(len(self.tiers)):
+            self._close(i)
+            self._bucket[i] = None
+
+    def query(self, span, width=1000, now=None):
+        """
+        Return (resolution, times, {name: min}, {name: mean}, {name: max}) for the last
+        span seconds, from the finest level with at most 2 * width points in the span
+        that still covers it. If none covers it, e.g. the span is longer than the session,
+        from the level within the point limit whose data goes back furthest, the finest
+        of them on a tie, so a short session still gets its raw samples or 1 s buckets.
+        Raw samples have resolution 0 and min = mean = max.
+        """
+        now = time.time() if now is None else now
+        start = now - span
+        levels = [(0.0, self.raw)] + list(zip(self.widths, self.tiers))
+        chosen, reach = None, np.inf
+        for resolution, level in levels:
+            times, _ = level.get()
+            if not len(times) or np.count_nonzero(times >= start) > 2 * width:
+                continue
+            if times[0] <= start:
+                chosen = (resolution, level)
+                break
+            if times[0] + resolution < reach:  # End of the oldest bucket
+                chosen, reach = (resolution, level), times[0] + resolution
+        if chosen is None:
+            # Too many points everywhere, the coarsest level with data
+            chosen = next(((resolution, level) for resolution, level in reversed(levels) if len(level)), levels[0])
+        resolution, level = chosen
+        times, values = level.get()
+        keep = times >= start
+        times = times[keep]
+        if resolution == 0:
+            series = {name: values[name][keep] for name in self.names}
+            return resolution, times, series, series, series
+        stats = [{name: values[f"{name} {stat}"][keep] for name in self.names} for stat in ("min", "mean", "max")]
+        return (resolution, times, *stats)
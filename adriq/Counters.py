@@ -1,16 +1,16 @@
 # Standard library imports
+import os
 import time
 import threading
-import csv
-from datetime import datetime
+import itertools
 from collections import Counter
 import configparser
 # Third-party imports
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.optimize import curve_fit
 import nidaqmx
-from nidaqmx.constants import Edge
+from nidaqmx.constants import Edge, AcquisitionType, TriggerType, Level
+from nidaqmx.stream_readers import CounterReader
 import tkinter as tk
 from tkinter import ttk, BooleanVar
 from matplotlib.figure import Figure
@@ -22,44 +22,217 @@ from PyQt5.QtWidgets import QSpinBox
 import pyqtgraph as pg
 from PyQt5.QtCore import QTimer
 from .Custom_Tkinter import CustomSpinbox, CustomIntSpinbox
-from .tdc_functions import filter_trailing_zeros, compute_time_diffs, count_channel_events, filter_runs
+from .tdc_functions import compute_time_diffs, count_channel_events, filter_runs
 
 # Local application/library-specific imports
 from . import QuTau
-from .Servers import Server, Client
+from .QuTau_Acquisition import QuTau_Acquisition, Multi_Device_Acquisition
+from .Analysis import Analysis_Pool
+from .Data_Logger import Data_Logger
+from .Buffers import Count_History, Count_Rollups, Time_Diff_Store, Mapped_Time_Diff_Store
+from .Servers import Server, Client, exclusive, shared
 
 def sine_wave(x, amplitude, frequency, phase, offset):
     return amplitude * np.sin(2 * np.pi * frequency * x + phase) + offset
 
 
+def fit_sine_linear(x, y, frequency):
+    """
+    Least squares fit of sine_wave at a fixed frequency, which is linear in
+    a sin + b cos + offset. Returns ([amplitude, frequency, phase, offset], residual).
+    """
+    w = 2 * np.pi * frequency * x
+    design = np.column_stack((np.sin(w), np.cos(w), np.ones_like(x)))
+    (a, b, offset), *_ = np.linalg.lstsq(design, y, rcond=None)
+    residual = np.sum((y - design @ (a, b, offset)) ** 2)
+    return np.array([np.hypot(a, b), frequency, np.arctan2(b, a), offset]), residual
+
+
+def fit_sine_wave(x, y, frequency=None, steps=21):
+    """
+    Fit sine_wave to evenly spaced samples y(x). Without a frequency, it is taken
+    from the peak of the FFT and refined to the best fit within half an FFT bin.
+    Fewer than 3 samples can't fix the fit, so all parameters are NaN then.
+    """
+    if len(x) < 3:
+        return np.full(4, np.nan)
+    if frequency is not None:
+        return fit_sine_linear(x, y, frequency)[0]
+    span = len(x) * (x[1] - x[0])
+    spectrum = np.abs(np.fft.rfft(y - np.mean(y)))
+    peak = np.argmax(spectrum[1:]) + 1
+    fits = [fit_sine_linear(x, y, k / span) for k in np.linspace(peak - 0.5, peak + 0.5, steps)]
+    return min(fits, key=lambda fit: fit[1])[0]
+
+
+class RF_Histogram:
+    """
+    Fixed-bin histogram of photon delays after the RF sync, filled run by run, so the
+    memory and the fit cost depend only on the number of bins.
+    """
+    def __init__(self, no_bins, period):
+        self.edges = np.linspace(0, period, no_bins + 1)
+        self.counts = np.zeros(no_bins, dtype=np.int64)
+
+    def add(self, time_diffs):
+        self.counts += np.histogram(time_diffs, bins=self.edges)[0]
+
+    def total(self):
+        return int(self.counts.sum())
+
+    def quantile(self, q):
+        """Quantile of the delays, interpolated within the bins."""
+        cdf = np.concatenate(([0], np.cumsum(self.counts)))
+        return np.interp(q * cdf[-1], cdf, self.edges)
+
+    def result(self, rf_frequency=None):
+        """Return (popt, hist, bin_edges) for the bins within the IQR outlier bounds."""
+        q1, q3 = self.quantile(0.25), self.quantile(0.75)
+        lower, upper = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+        keep = np.flatnonzero((self.edges[1:] >= lower) & (self.edges[:-1] <= upper))
+        first, last = keep[0], keep[-1]
+        hist = self.counts[first:last + 1].copy()
+        bin_edges = self.edges[first:last + 2]
+        popt = fit_sine_wave((bin_edges[:-1] + bin_edges[1:]) / 2, hist.astype(np.float64), rf_frequency)
+        # Report the phase in [0, pi) as before, with the sign moved into the amplitude
+        if popt[2] % (2 * np.pi) >= np.pi:
+            popt[0] = -popt[0]
+        popt[2] = popt[2] % np.pi
+        return popt, hist, bin_edges
+
+
+def pair_delays(t1, t2, max_delay, same_events=False):
+    """
+    Delays t2 - t1 of every pair of events within max_delay of each other (sorted inputs).
+    same_events: t1 and t2 are the same events (an autocorrelation), so each event's
+    pair with itself is left out.
+    """
+    lo = np.searchsorted(t2, t1 - max_delay)
+    hi = np.searchsorted(t2, t1 + max_delay, side='right')
+    n = hi - lo
+    index = np.repeat(lo - (np.cumsum(n) - n), n) + np.arange(n.sum())
+    delays = t2[index] - np.repeat(t1, n)
+    if same_events:
+        delays = delays[index != np.repeat(np.arange(len(t1)), n)]
+    return delays
+
 class PMT_Reader:
     host = 'localhost'
     port = 8000
     
-    def __init__(self, rate=10, N=100):
+    def __init__(self, rate=10, N=100, counters=None, buffered=True, sample_rate=1000, clock_counter="Dev1/ctr1"):
+        """
+        rate: count rate points per second added to the history.
+        counters: list of (counter, terminal[, name]) read together in one task, e.g.
+        [("Dev1/ctr0", "/Dev1/PFI8", "PMT"), ("Dev1/ctr2", "/Dev1/PFI3", "APD")]. Unnamed
+        entries are called PMT, PMT2, PMT3... Defaults to the PMT on ctr0/PFI8.
+        buffered: latch the counter on a hardware sample clock (a pulse train generated
+        on clock_counter at sample_rate) into a circular DAQ buffer, and turn every
+        sample_rate / rate samples into one point from a DAQ callback. The timing is
+        then set by the hardware, not by sleeps and task start/stop on every point.
+        With buffered=False each point is a software-timed start/sleep/read/stop.
+        """
         self.rate = rate
         self.N = N
         self.counting = False
-        self.counts = []
-        self.times = []
-        self.lock = threading.Lock()
-        self.task = nidaqmx.Task()
-
-        self.channel = self.task.ci_channels.add_ci_count_edges_chan(
-            "Dev1/ctr0",
-            edge=Edge.RISING,
-            initial_count=0,
-            count_direction=nidaqmx.constants.CountDirection.COUNT_UP
-        )
-        self.channel.ci_count_edges_term = "/Dev1/PFI8"
+        if counters is None:
+            counters = [("Dev1/ctr0", "/Dev1/PFI8")]
+        self.counters = [(c[0], c[1], c[2] if len(c) > 2 else ("PMT" if i == 0 else f"PMT{i + 1}"))
+                         for i, c in enumerate(counters)]
+        self.history = Count_History([name for _, _, name in self.counters], N)
+        self.rollups = Count_Rollups(self.history, rate)  # The last minute and long-term min/mean/max, see get_counts_history
+        self.buffered = buffered
+        self.sample_rate = sample_rate
+        self.clock_counter = clock_counter
+        self.clock_task = None
+        self.pmt_terminal = self.counters[0][1]  # Counted by the gated counters
+        self.task = self._create_count_task()
+        self.gates = {}  # Gated counters by name, see start_gated_counting
+        self.gate_lock = threading.Lock()
         self.initialized = True
 
+    def _create_count_task(self):
+        # All counters in one task, so they share the sample clock and are read in one call
+        task = nidaqmx.Task()
+        for counter, terminal, _ in self.counters:
+            channel = task.ci_channels.add_ci_count_edges_chan(
+                counter,
+                edge=Edge.RISING,
+                initial_count=0,
+                count_direction=nidaqmx.constants.CountDirection.COUNT_UP
+            )
+            channel.ci_count_edges_term = terminal
+        return task
+
+    def _read_counts(self, samples):
+        # task.read returns a flat list for one channel, a list per channel otherwise
+        data = self.task.read(number_of_samples_per_channel=samples)
+        return np.asarray(data, dtype=np.uint32).reshape(len(self.counters), samples)
+
+    def _start_buffered(self):
+        self.samples_per_point = max(1, int(round(self.sample_rate / self.rate)))
+        buffer_size = max(10 * self.samples_per_point, int(self.sample_rate))  # At least a second
+
+        # Sample clock: a continuous pulse train on the second counter
+        self.clock_task = nidaqmx.Task()
+        self.clock_task.co_channels.add_co_pulse_chan_freq(self.clock_counter, freq=self.sample_rate, duty_cycle=0.5)
+        self.clock_task.timing.cfg_implicit_timing(sample_mode=AcquisitionType.CONTINUOUS)
+
+        # The edge counter is latched into the buffer on every clock pulse
+        device, counter = self.clock_counter.split("/")
+        self.task.timing.cfg_samp_clk_timing(
+            self.sample_rate,
+            source=f"/{device}/{counter.capitalize()}InternalOutput",
+            active_edge=Edge.RISING,
+            sample_mode=AcquisitionType.CONTINUOUS,
+            samps_per_chan=buffer_size
+        )
+        self._last_count = np.zeros((len(self.counters), 1), dtype=np.uint32)
+        self._samples_read = 0
+        self.task.register_every_n_samples_acquired_into_buffer_event(self.samples_per_point, self._samples_acquired)
+
+        self.task.start()  # Armed, waits for the first clock pulse
+        self._start_time = time.time()
+        self.clock_task.start()
+
+    def _samples_acquired(self, task_handle, event_type, number_of_samples, callback_data):
+        """DAQ callback: turn the latest samples_per_point counter values into one rate point."""
+        try:
+            samples = self._read_counts(self.samples_per_point)
+        except nidaqmx.DaqError as e:
+            print(f"Error reading PMT counts: {e}")
+            return 0
+        # The counters are cumulative and wrap at 2**32; uint32 differences wrap with them
+        counts = np.diff(samples, axis=1, prepend=self._last_count).sum(axis=1, dtype=np.int64)
+        self._last_count[:, 0] = samples[:, -1]
+        self._samples_read += self.samples_per_point
+        self.rollups.append(self._start_time + self._samples_read / self.sample_rate,
+                            counts * self.sample_rate / self.samples_per_point)
+        return 0
+
+    def _stop_buffered(self):
+        for task in (self.clock_task, self.task):
+            if task is not None:
+                task.stop()
+                task.close()
+        self.clock_task = None
+        # The sample clock and callback belong to that task; start the next run from a fresh one
+        self.task = self._create_count_task()
+
+    @exclusive
     def update_rate(self, new_rate):
         self.rate = new_rate
+        self.rollups.set_rate(new_rate)
+        if self.counting and self.buffered:
+            # The number of samples per point is fixed when the task starts
+            self._stop_buffered()
+            self._start_buffered()
         return True
 
+    @exclusive
     def update_N(self, new_N):
         self.N = new_N
+        self.history.resize(new_N)
         return True
 
     def get_rate(self):
@@ -75,66 +248,175 @@ class PMT_Reader:
         start_time = time.time()  # Record the start time
         self.task.start()
         time.sleep(1 / self.rate)
-        read_data = self.task.read(number_of_samples_per_channel=1)
-        count1, end_time = (read_data if isinstance(read_data, int) else read_data[0] if len(read_data) > 0 else 0), time.time()
+        counts, end_time = self._read_counts(1)[:, 0], time.time()
         elapsed_time = end_time - start_time  # Calculate the elapsed time
-        count_rate = int(count1 / elapsed_time)  # Use the elapsed time to calculate the count rate
+        count_rates = counts / elapsed_time  # Use the elapsed time to calculate the count rates
         self.task.stop()
-        end_time = time.time()  # End timing
-        current_time = datetime.now()
-        return count_rate, current_time
+        return count_rates, end_time
 
+    @exclusive
     def start_counting(self):
-        self.counts = []
-        self.times = []
-        self.counting = True
+        if self.counting:
+            return False
+        self.history.clear()
+        if self.buffered:
+            try:
+                self._start_buffered()
+            except nidaqmx.DaqError as e:
+                print(f"Error starting buffered PMT counting: {e}")
+                self._stop_buffered()
+                return False
+            self.counting = True
+        else:
+            self.counting = True
+            threading.Thread(target=self._counting_loop, daemon=True).start()
         print("Counting started...")
-        threading.Thread(target=self._counting_loop, daemon=True).start()
         return True
 
     def _counting_loop(self):
         while self.counting:
-            count_rate, current_time = self.count_rate()
-            with self.lock:  # Ensure thread-safe access
-                self.counts.append(count_rate)  # Store only the first element
-                self.times.append(current_time)
-
-                # Trim lists if necessary
-                if len(self.counts) > self.N:
-                    self.counts.pop(0)
-                if len(self.times) > self.N:
-                    self.times.pop(0)
+            count_rates, current_time = self.count_rate()
+            self.rollups.append(current_time, count_rates)
 
+    @exclusive
     def stop_counting(self):
+        if self.counting and self.buffered:
+            self._stop_buffered()
         self.counting = False
         return True
 
     def get_counts(self):
-        with self.lock:  # Ensure thread-safe access
-            return self.times, {"PMT": self.counts}
+        """Return (times, {counter name: counts}) for the whole history, as lists (epoch seconds)."""
+        times, counts = self.history.get()
+        return times.tolist(), {name: values.tolist() for name, values in counts.items()}
+
+    def get_counts_since(self, cursor=0):
+        """Return (times, {counter name: counts}, cursor) for the samples since cursor, as arrays."""
+        return self.history.get_since(cursor)
+
+    @shared
+    def get_counts_history(self, span, width=1000):
+        """
+        Return (resolution, times, {name: min}, {name: mean}, {name: max}) for the last
+        span seconds, as lists, from the raw samples of the last minute or the 1 s, 10 s
+        or 1 min rollups, whichever is finest without many more than width points.
+        """
+        resolution, times, *stats = self.rollups.query(span, width)
+        return (resolution, times.tolist(), *({name: values.tolist() for name, values in stat.items()} for stat in stats))
+
+    @exclusive
+    def start_gated_counting(self, gates, windows_per_run=1, max_gate_rate=1e6):
+        """
+        Count PMT edges only while a pulse sequencer gate is high, with one counter per
+        gate, alongside the continuous counting. gates is a list of
+        (name, counter, gate_terminal[, windows_per_run]), e.g.
+        ("fluorescence", "Dev1/ctr2", "/Dev1/PFI1") with PFI1 wired to the pmt_gate_pin.
+        Each counter is paused while its gate is low and latched into the DAQ buffer on
+        every falling gate edge, so each gate window gives one sample, and windows_per_run
+        consecutive windows make up one run of the sequence.
+        """
+        self.stop_gated_counting()
+        with self.gate_lock:
+            for gate in gates:
+                name, counter, gate_terminal = gate[:3]
+                task = nidaqmx.Task()
+                try:
+                    channel = task.ci_channels.add_ci_count_edges_chan(
+                        counter,
+                        edge=Edge.RISING,
+                        initial_count=0,
+                        count_direction=nidaqmx.constants.CountDirection.COUNT_UP
+                    )
+                    channel.ci_count_edges_term = self.pmt_terminal
+                    task.triggers.pause_trigger.trig_type = TriggerType.DIGITAL_LEVEL
+                    task.triggers.pause_trigger.dig_lvl_src = gate_terminal
+                    task.triggers.pause_trigger.dig_lvl_when = Level.LOW
+                    task.timing.cfg_samp_clk_timing(
+                        max_gate_rate,
+                        source=gate_terminal,
+                        active_edge=Edge.FALLING,
+                        sample_mode=AcquisitionType.CONTINUOUS,
+                        samps_per_chan=100000
+                    )
+                    task.start()
+                except nidaqmx.DaqError as e:
+                    print(f"Error starting gated counter {name} on {counter}: {e}")
+                    task.close()
+                    continue
+                self.gates[name] = {
+                    "task": task,
+                    "reader": CounterReader(task.in_stream),
+                    "windows": gate[3] if len(gate) > 3 else windows_per_run,
+                    "last": np.zeros(1, dtype=np.uint32),
+                    "pending": np.zeros(0, dtype=np.int64),  # Windows of an incomplete run
+                }
+        return len(self.gates) == len(gates)
+
+    @shared
+    def get_gated_counts(self):
+        """
+        Return {name: counts} with counts an array of shape (runs, windows_per_run) for
+        every run completed since the last call. An incomplete run is kept for the next.
+        """
+        result = {}
+        with self.gate_lock:
+            for name, gate in self.gates.items():
+                available = gate["task"].in_stream.avail_samp_per_chan
+                if available:
+                    samples = np.zeros(available, dtype=np.uint32)
+                    gate["reader"].read_many_sample_uint32(samples, number_of_samples_per_channel=available)
+                    counts = np.diff(samples, prepend=gate["last"]).astype(np.int64)
+                    gate["last"][0] = samples[-1]
+                    gate["pending"] = np.concatenate((gate["pending"], counts))
+                windows = gate["windows"]
+                runs = len(gate["pending"]) // windows
+                result[name] = gate["pending"][:runs * windows].reshape(runs, windows)
+                gate["pending"] = gate["pending"][runs * windows:]
+        return result
+
+    @exclusive
+    def clear_gated_counts(self):
+        """Discard everything counted so far, e.g. before the first run of an experiment."""
+        self.get_gated_counts()
+        with self.gate_lock:
+            for gate in self.gates.values():
+                gate["pending"] = gate["pending"][:0]
+        return True
+
+    @exclusive
+    def stop_gated_counting(self):
+        with self.gate_lock:
+            for gate in self.gates.values():
+                gate["task"].stop()
+                gate["task"].close()
+            self.gates = {}
+        return True
 
     def close(self):
+        self.stop_gated_counting()
         self.stop_counting()  # Ensure counting is stopped
         self.task.stop()  # Stop the task if it's running
         self.task.close()  # Explicitly release the resources
         print("NIDAQmx Task closed.")
 
 class QuTau_Channel:
-    def __init__(self, name, number, mode="idle"):
+    def __init__(self, name, number, mode="idle", delay=0.0, dead_time=None):
         self.name = name
         self.number = number
         self.mode = mode
+        self.delay = delay  # Seconds added to this channel's timestamps by the device
+        self.dead_time = dead_time  # Seconds, events closer than this are dropped by the device
         self.active = mode != "idle"
         self.recent_time_diffs = []
-        self.time_diffs = []
+        self.time_diffs = Time_Diff_Store(outlier_threshold=1e-4)
         self.counts = []  # Initialize counts attribute
 
     def save_recent_time_diffs(self):
-        """Save recent time differences by extending the time_diffs attribute."""
-        self.time_diffs.extend(self.recent_time_diffs)
-        for i, diff in enumerate(self.time_diffs):
-            if diff > 1e-4:
-                print(f"Channel {self.name} - Time diff: {diff} at index {i}/{len(self.time_diffs)}")
+        """Save recent time differences by appending them to the time_diffs store."""
+        outliers = self.time_diffs.append(self.recent_time_diffs)
+        if outliers:
+            print(f"Channel {self.name} - {outliers} time diffs over 1e-4 s in this run "
+                  f"({self.time_diffs.outliers}/{len(self.time_diffs)} in total)")
 
     def discard_recent_time_diffs(self):
         """Discard recent time differences."""
@@ -142,10 +424,20 @@ class QuTau_Channel:
 
     def clear_time_diffs(self):
         """Clear the time_diffs attribute."""
-        self.time_diffs = []
+        self.time_diffs.clear()
 
 def load_channels_from_ini(ini_file):
-    """Load channel configurations from an .ini file."""
+    """
+    Load channel configurations from an .ini file. Each section is a channel with a
+    number, name and mode, and optionally a delay and a dead_time in seconds, e.g.
+
+        [PMT]
+        number = 6
+        name = PMT
+        mode = signal-f
+        delay = 12.5e-9
+        dead_time = 50e-9
+    """
     config = configparser.ConfigParser()
     config.read(ini_file)
 
@@ -156,35 +448,114 @@ def load_channels_from_ini(ini_file):
         name = config[section].get('name', f'Channel{section}')
         number = int(config[section].get('number', -1))
         mode = config[section].get('mode', 'idle')
+        delay = config[section].getfloat('delay', 0.0)
+        dead_time = config[section].getfloat('dead_time', None)
         if number == -1:
             raise ValueError(f"Invalid or missing 'number' for channel '{section}' in {ini_file}")
-        channels.append(QuTau_Channel(name, number, mode=mode))
+        channels.append(QuTau_Channel(name, number, mode=mode, delay=delay, dead_time=dead_time))
     return channels
 
 class QuTau_Reader:
     host = 'localhost'
     port = 8001  # Set a unique port number for QuTau_Reader
  
-    def __init__(self, ini_file='C:\\Users\\probe\\OneDrive - University of Sussex\\Desktop\\Experiment_Config\\qutau_config.cfg'):
+    def __init__(self, ini_file='C:\\Users\\probe\\OneDrive - University of Sussex\\Desktop\\Experiment_Config\\qutau_config.cfg', backend=None, hardware_counting=False, devices=None, device_offsets=None, time_diff_dir=None, analysis_workers=0):
+        """
+        backend: QuTau backend class or instance, defaults to the QuTau DLL. Pass e.g.
+        QuTau_Simulator (or QuTau_Simulator(rates=...)) to run without the hardware.
+        hardware_counting: count rates from the device's own counters, with the exposure
+        time set from the rate, instead of transferring every timestamp to Python. The
+        timestamp stream is stopped while counting, so get_data and the other consumers
+        get nothing until counting stops, and a point is only added to the history when
+        an exposure completes. Off by default.
+        devices: list of TDC device numbers to acquire from concurrently. Channel c of
+        the i-th device is channel 8 * i + c in the ini file and in the merged stream.
+        device_offsets: {device: seconds} added to that device's timestamps.
+        time_diff_dir: directory to keep the channels' accumulated time diffs in, as
+        memory-mapped files (<channel name>_<date>_<time>.tdiff) instead of in RAM. A
+        channel's file is created when its first time diffs are saved, so only the
+        channels that are signals in the current mode get one. They can be opened
+        read-only with Buffers.open_time_diffs while acquisition continues.
+        clear_channels starts new files, the previous ones are kept.
+        analysis_workers: processes to run filter_runs and compute_time_diffs on large
+        event buffers in, so they don't stall counting and RPC calls. 0 (the default)
+        runs them here. On Windows the workers import the main script again, so the
+        script must start the reader under if __name__ == "__main__":, see Analysis_Pool.
+        """
         # Load channels from the specified .ini file
         self.channels = load_channels_from_ini(ini_file)
-        self.qutau = QuTau.QuTau()  # Initialize QuTau object
+        if backend is None:
+            backend = QuTau.QuTau
+        self.qutau = backend() if isinstance(backend, type) else backend  # Initialize QuTau object
         self.timebase = self.qutau.getTimebase()
+        if devices is not None and len(devices) > 1:
+            offsets = {dev: int(round(offset / self.timebase)) for dev, offset in (device_offsets or {}).items()}
+            self.acquisition = Multi_Device_Acquisition(self.qutau, devices, offsets=offsets)
+            self.acquisition.connect()
+            self.n_devices = len(devices)
+        else:
+            self.acquisition = QuTau_Acquisition(self.qutau, adaptive=True)  # Drains the device buffer in the background
+            self.n_devices = 1
         self.ensure_all_channels()
         self.ensure_single_trap_drive_and_ps_sync()
+        self.time_diff_dir = time_diff_dir
+        if time_diff_dir is not None:
+            os.makedirs(time_diff_dir, exist_ok=True)
+            self.new_time_diff_files()
         self.default_modes = {ch.number: ch.mode for ch in self.channels}
         self.rate = 5
         self.N = 100
+        self.hardware_counting = hardware_counting
         self.current_mode = "idle"
-        self.times = []  # Initialize times array
+        self.counting_channels = [ch for ch in self.channels if ch.mode in ["signal-f", "signal-sp"]]
+        self.history = Count_History([ch.name for ch in self.counting_channels], self.N)
+        self.rollups = Count_Rollups(self.history, self.rate)  # The last minute and long-term min/mean/max, see get_counts_history
+        self.last_count_time = None
+        self.jobs = {}  # Background jobs by id, see start_rf_correlation
+        self.job_lock = threading.Lock()
+        self._job_ids = itertools.count(1)
+        self.max_jobs = 10
+        self._lifetime = None  # Set up by start_lifetime_histogram
+        self._hbt = None  # Set up by start_hbt_histogram
+        self.analysis = Analysis_Pool(analysis_workers) if analysis_workers else None
+        self.apply_channel_settings()
         self.update_active_channels()
+        self.acquisition.start()
 
     def ensure_all_channels(self):
         existing_numbers = {ch.number for ch in self.channels}
-        for i in range(8):
+        for i in range(8 * self.n_devices):
             if i not in existing_numbers:
                 self.channels.append(QuTau_Channel(f"idle-{i}", i, mode="idle"))
 
+    def apply_channel_settings(self):
+        """
+        Push the channels' delays and dead times to the device, so cable delays are
+        aligned and duplicate counts rejected in hardware rather than in software.
+        Dead times are only supported by the quTAG; elsewhere they are reported and skipped.
+        """
+        delays = {ch.number: int(round(ch.delay / self.timebase)) for ch in self.channels if ch.delay}
+        dead_times = {ch.number: int(round(ch.dead_time * 1e12)) for ch in self.channels if ch.dead_time is not None}
+        if dead_times and self.qutau._deviceType != self.qutau.DEVTYPE_2A:
+            print(f"Dead times for channels {sorted(dead_times)} need a quTAG, ignoring them.")
+            dead_times = {}
+        return self.acquisition.configure_channels(delays, dead_times)
+
+    @exclusive
+    def set_channel_settings(self, channel_number, delay=None, dead_time=None):
+        """Change a channel's delay and/or dead time (seconds) and apply it to the device."""
+        channel = next(ch for ch in self.channels if ch.number == channel_number)
+        if delay is not None:
+            channel.delay = delay
+        if dead_time is not None:
+            channel.dead_time = dead_time
+        return self.apply_channel_settings()
+
+    @exclusive
+    def set_coincidence_window(self, window):
+        """Set the coincidence window of the device counters, in seconds."""
+        return self.acquisition.set_coincidence_window(int(round(window / self.timebase)))
+
     def ensure_single_trap_drive_and_ps_sync(self):
         trap_drive_channels = [ch for ch in self.channels if ch.mode == "trap"]
         ps_sync_channels = [ch for ch in self.channels if ch.mode == "trigger"]
@@ -196,33 +567,48 @@ class QuTau_Reader:
 
     def set_active_channels(self, modes):
         self.active_channels = [ch.number for ch in self.channels if ch.mode in modes]
-        self.qutau.enableChannels(self.active_channels)
+        self.enable_channels(self.active_channels)
         print(f"Active channels: {self.active_channels}")
 
+    @exclusive
     def enter_idle_mode(self):
         print("Idle mode entered.")
         self.current_mode = "idle"
         self.set_active_channels([])  # No active channels in idle mode
+        self.acquisition.start()  # In case hardware counting stopped it
 
+    @exclusive
     def enter_counting_mode(self):
         self.current_mode = "counting"
-        self.times = []  # Clear times array
+        self.history.clear()
         self.set_active_channels(["signal-sp", "signal-f"]) #(["43-f", "signal-sp"])
+        if self.hardware_counting:
+            # No arrival times are needed, so stop transferring timestamps altogether
+            self.acquisition.stop()
+            self.set_exposure_time()
+        else:
+            self.clear_data("counting")
+        self.last_count_time = time.time()
         print("Counting mode entered.")
 
+    @exclusive
     def enter_rf_correlation_mode(self):
         print("RF correlation mode entered.")
         self.current_mode = "rf_correlation"
         self.set_active_channels(["signal-f", "trap"])
+        self.acquisition.start()
     
+    @exclusive
     def exit_rf_correlation_mode(self):
         print("RF correlation mode exited.")
         self.current_mode = "idle"
         self.set_active_channels([])
     
+    @exclusive
     def enter_experiment_mode(self, experiment_config=None):
         print("Experiment mode entered.")
         self.current_mode = "experiment"
+        self.acquisition.start()
         
         # Standard experiment configuration
         standard_experiment_config = {
@@ -249,6 +635,7 @@ class QuTau_Reader:
         
         self.update_active_channels()
 
+    @exclusive
     def exit_experiment_mode(self):
         print("Experiment mode exited.")
         self.current_mode = "idle"
@@ -260,20 +647,169 @@ class QuTau_Reader:
 
     def update_active_channels(self):
         self.active_channels = [ch.number for ch in self.channels if ch.active]
-        self.qutau.enableChannels(self.active_channels)
+        self.enable_channels(self.active_channels)
         print(f"Active channels: {self.active_channels}")
 
-    def get_data(self):
-        self.timestamps = self.qutau.getLastTimestamps(True)
-        self.tchannel = np.array(self.timestamps[1], dtype=np.int64)
-        self.tstamp = np.array(self.timestamps[0], dtype=np.float64) * self.timebase
-        self.tstamp, self.tchannel = filter_trailing_zeros(self.tstamp, self.tchannel)
-        return self.tstamp, self.tchannel
+    def enable_channels(self, channels):
+        self.acquisition.enable_channels(channels)
 
+    @exclusive
+    def get_data(self, consumer="default"):
+        """
+        Return all events the consumer has not read yet, as (seconds, channel) arrays.
+        Only the default (experiment) consumer's events are also kept in self.tstamp and
+        self.tchannel for filter_runs_for_fluorescence and compute_time_diff, so other
+        consumers, e.g. a remote get_last_timestamps, can't overwrite them in between.
+        """
+        self.acquisition.drain()  # Include everything up to now, not just up to the last drain
+        tstamp, tchannel = self.acquisition.read(consumer)
+        tstamp, tchannel = tstamp * self.timebase, tchannel.astype(np.int64)
+        if consumer == "default":
+            self.tstamp, self.tchannel = tstamp, tchannel
+        return tstamp, tchannel
+
+    @exclusive
+    def clear_data(self, consumer="default"):
+        """Discard everything the consumer has not read yet."""
+        self.acquisition.drain()
+        self.acquisition.skip(consumer)
+
+    @exclusive
+    def start_recording(self, filename, fileformat=None):
+        """Have the QuTau library stream all timestamps straight to a binary file."""
+        if fileformat is None:
+            fileformat = self.qutau.FILEFORMAT_BINARY
+        with self.acquisition.lock:
+            ans = self.qutau.writeTimestamps(filename, fileformat)
+        if ans == 0:
+            print(f"Recording timestamps to {filename}")
+        return ans == 0
+
+    @exclusive
+    def stop_recording(self):
+        with self.acquisition.lock:
+            ans = self.qutau.writeTimestamps("", self.qutau.FILEFORMAT_NONE)
+        return ans == 0
+
+    @shared
+    def get_acquisition_status(self):
+        return self.acquisition.get_status()
+
+    @exclusive
+    def start_lifetime_histogram(self, start_channel, stop_channel, bin_width, bin_count):
+        """
+        Histogram the delay from each start_channel event to the following stop_channel
+        events in bin_count bins of bin_width seconds. The device builds the histogram
+        itself when it has the lifetime feature (single device only), otherwise it is
+        accumulated here from the timestamp stream. Both channels must be enabled.
+        Returns True if the device is used.
+        """
+        on_device = self.qutau._featureLifetime and self.n_devices == 1
+        self._lifetime = {"stop": stop_channel, "start": start_channel, "on_device": on_device,
+                          "bin_width": max(1, int(round(bin_width / self.timebase))), "bin_count": bin_count}
+        if on_device:
+            with self.acquisition.lock:
+                self.qutau.setLftParams(self._lifetime["bin_width"], bin_count)
+                self.qutau.setLftStartInput(start_channel)
+                self.qutau.enableLft(True)
+                self.qutau.resetLftHistograms()
+        else:
+            self._lifetime["counts"] = np.zeros(bin_count, dtype=np.int64)
+            self.clear_data("lifetime")
+        return on_device
+
+    @exclusive
+    def get_lifetime_histogram(self, reset=False):
+        """Return (bin start times in seconds, counts) since the start or the last reset."""
+        lifetime = self._lifetime
+        if lifetime is None:
+            raise RuntimeError("Call start_lifetime_histogram before get_lifetime_histogram.")
+        if lifetime["on_device"]:
+            with self.acquisition.lock:
+                counts, bin_width, _, _ = self.qutau.getLftHistogram(lifetime["stop"], reset)
+            return np.arange(len(counts)) * bin_width * self.timebase, counts
+
+        self.acquisition.drain()
+        tstamp, tchannel = self.acquisition.read("lifetime")
+        bin_width = lifetime["bin_width"] * self.timebase
+        time_diffs = self._analyse(compute_time_diffs, tstamp * self.timebase, tchannel.astype(np.int64),
+                                   lifetime["start"], np.array([lifetime["stop"]], dtype=np.int64))[0]
+        hist, _ = np.histogram(time_diffs, bins=lifetime["bin_count"], range=(0, lifetime["bin_count"] * bin_width))
+        lifetime["counts"] += hist
+        counts = lifetime["counts"].copy()
+        if reset:
+            lifetime["counts"][:] = 0
+        return np.arange(len(counts)) * bin_width, counts
+
+    @exclusive
+    def start_hbt_histogram(self, channel1, channel2, bin_width, bin_count):
+        """
+        Histogram the delays between channel1 and channel2 events in bin_count bins of
+        bin_width seconds centred on zero delay. The device computes the correlation
+        itself when it has the HBT feature (single device only, values as normalised by
+        the library), otherwise coincidences are counted here from the timestamp stream.
+        Both channels must be enabled. Returns True if the device is used.
+        """
+        on_device = self.qutau._featureHBT and self.n_devices == 1
+        self._hbt = {"channel1": channel1, "channel2": channel2, "on_device": on_device,
+                     "bin_width": max(1, int(round(bin_width / self.timebase))), "bin_count": bin_count}
+        if on_device:
+            with self.acquisition.lock:
+                self.qutau.setHbtParams(self._hbt["bin_width"], bin_count)
+                self.qutau.setHbtInput(channel1, channel2)
+                self.qutau.enableHbt(True)
+                self.qutau.resetHbtCorrelations()
+        else:
+            self._hbt["counts"] = np.zeros(bin_count, dtype=np.int64)
+            self.clear_data("hbt")
+        return on_device
+
+    @exclusive
+    def get_hbt_histogram(self, reset=False):
+        """Return (bin start delays in seconds, values) since the start or the last reset."""
+        hbt = self._hbt
+        if hbt is None:
+            raise RuntimeError("Call start_hbt_histogram before get_hbt_histogram.")
+        if hbt["on_device"]:
+            with self.acquisition.lock:
+                values, bin_width, index_offset = self.qutau.getHbtCorrelations()
+                if reset:
+                    self.qutau.resetHbtCorrelations()
+            return (np.arange(len(values)) + index_offset) * bin_width * self.timebase, values
+
+        self.acquisition.drain()
+        tstamp, tchannel = self.acquisition.read("hbt")
+        bin_width, bin_count = hbt["bin_width"], hbt["bin_count"]
+        offset = bin_count // 2
+        # Pairs straddling two reads are missed, which is negligible for ns-scale ranges
+        delays = pair_delays(tstamp[tchannel == hbt["channel1"]], tstamp[tchannel == hbt["channel2"]], (bin_count - offset) * bin_width,
+                             same_events=hbt["channel1"] == hbt["channel2"])
+        bins = delays // bin_width + offset
+        hbt["counts"] += np.bincount(bins[(bins >= 0) & (bins < bin_count)], minlength=bin_count)
+        counts = hbt["counts"].copy()
+        if reset:
+            hbt["counts"][:] = 0
+        return (np.arange(bin_count) - offset) * bin_width * self.timebase, counts
+
+    def _analyse(self, func, *args, **kwargs):
+        """Run a CPU heavy function on event arrays in the analysis pool, if there is one."""
+        if self.analysis is None:
+            return func(*args, **kwargs)
+        return self.analysis.run(func, *args, **kwargs)
+
+    @exclusive
     def filter_runs_for_fluorescence(self, expected_fluorescence, pulse_window_time, bin_size=10000):
         """
         expected_fluorescence: Expected fluorescence rate while the pulse sequence is running
         """
+        # Call the filter_runs function with self.tstamp and self.tchannel
+        self.tstamp, self.tchannel, valid_pulse_count, total_pulses = self._filter_runs(
+            self.tstamp, self.tchannel, expected_fluorescence, pulse_window_time, bin_size)
+
+        return valid_pulse_count, total_pulses
+
+    def _filter_runs(self, tstamp, tchannel, expected_fluorescence, pulse_window_time, bin_size=10000):
+        """filter_runs on the given events, returns (tstamp, tchannel, valid_pulse_count, total_pulses)."""
         # Find the signal channel counting fluoresence
         signal_chans = np.array(
             [ch.number for ch in self.channels if ch.mode in ["signal-f"]],
@@ -288,10 +824,10 @@ class QuTau_Reader:
         signal_chan = signal_chans[0]
         trigger_chan = next(ch.number for ch in self.channels if ch.mode == "trigger")
         
-        # Call the filter_runs function with self.tstamp and self.tchannel
-        self.tstamp, self.tchannel, valid_pulse_count, total_pulses = filter_runs(
-            tstamp=self.tstamp,
-            tchannel=self.tchannel,
+        return self._analyse(
+            filter_runs,
+            tstamp=tstamp,
+            tchannel=tchannel,
             trig_chan=trigger_chan,
             signal_chan=signal_chan,
             expected_count_rate=expected_fluorescence,
@@ -299,8 +835,7 @@ class QuTau_Reader:
             bin_size=bin_size
         )
 
-        return valid_pulse_count, total_pulses
-
+    @exclusive
     def compute_time_diff(self, pulse_window_time=50E-6, trigger_mode="normal"):
 
         if trigger_mode == "normal":
@@ -309,7 +844,7 @@ class QuTau_Reader:
             
             signal_chans = np.array([ch.number for ch in self.channels if ch.mode in ["signal-f", "signal-sp"]], dtype=np.int64)
 
-            time_diffs = compute_time_diffs(self.tstamp, self.tchannel, trigger_chan, signal_chans, pulse_window_time)
+            time_diffs = self._analyse(compute_time_diffs, self.tstamp, self.tchannel, trigger_chan, signal_chans, pulse_window_time)
             # Store time differences in the corresponding channel objects
             for ch in self.channels:
                 if ch.number in signal_chans:
@@ -321,7 +856,7 @@ class QuTau_Reader:
             
             signal_chans = np.array([ch.number for ch in self.channels if ch.mode in ["signal-f", "signal-sp"]], dtype=np.int64)
 
-            time_diffs = compute_time_diffs(self.tstamp, self.tchannel, trigger_chan, signal_chans, pulse_window_time)
+            time_diffs = self._analyse(compute_time_diffs, self.tstamp, self.tchannel, trigger_chan, signal_chans, pulse_window_time)
             # Store time differences in the corresponding channel objects
             for ch in self.channels:
                 if ch.number in signal_chans:
@@ -329,6 +864,7 @@ class QuTau_Reader:
 
 
 
+    @exclusive
     def start_counting(self):
         if self.current_mode == "idle":
             print(self.current_mode)
@@ -337,86 +873,202 @@ class QuTau_Reader:
                 print("Cannot start counting in experiment or RF correlation mode.")
                 return
 
-            self.counts = {ch.number: [] for ch in self.channels if ch.mode in ["signal-f", "signal-sp"]}
             self.enter_counting_mode()
             threading.Thread(target=self._counting_loop, daemon=True).start()
             return True
         else:
             return False
 
+    @exclusive
     def stop_counting(self):
         if self.current_mode == "counting":
             print("Counting stopped.")
-            for ch in self.channels:
-                if ch.mode in ["signal-f", "signal-sp"]:
-                    ch.counts = []
-            self.times = []  # Clear times array
+            self.history.clear()
             self.enter_idle_mode()
             return True
         else:
             return False
 
+    def set_exposure_time(self):
+        self.exposure_time = max(1, int(round(1000 / self.rate)))  # ms
+        self.acquisition.set_exposure_time(self.exposure_time)
+
+    def count_rate_hardware(self):
+        """Read per-channel totals of the last completed exposure from the device counters."""
+        counters, updates = self.acquisition.read_counters()
+        if updates == 0:
+            return  # No exposure finished since the last read
+        exposure = self.exposure_time / 1000
+        self.rollups.append(time.time(), [counters[ch.number] / exposure for ch in self.counting_channels])
+
+    @exclusive
     def count_rate(self):
-        # Get the latest timestamps and filter trailing zeros
-        self.get_data()
+        if self.hardware_counting:
+            return self.count_rate_hardware()
+        # Get the timestamps since the last count
+        _, tchannel = self.get_data("counting")
+        now = time.time()
+        elapsed_time = now - self.last_count_time if self.last_count_time else 1 / self.rate
+        self.last_count_time = now
 
         # Use count_channel_events to count occurrences of each channel
-        counts_list = count_channel_events(self.tchannel)
-        # Generate the count rates list and update channel counts
-        for ch in self.channels:
-            if ch.active:
-                count = next((count for channel, count in counts_list if channel == ch.number), 0)
-                count_rate = count * self.rate
-                ch.counts.append(count_rate)
-                if len(ch.counts) > self.N:
-                    ch.counts.pop(0)
-
-        current_time = datetime.now()
-        self.times.append(current_time)  # Store the current time
-        if len(self.times) > self.N:
-            self.times.pop(0)
+        counts = dict(count_channel_events(tchannel))
+        self.rollups.append(now, [counts.get(ch.number, 0) / elapsed_time for ch in self.counting_channels])
     
     def _counting_loop(self):
         while self.current_mode=="counting":
             start_time = time.time()  # Start time for the loop
             self.count_rate()
 
-            # Calculate the remaining time to sleep to maintain the desired rate
+            # Calculate the remaining time to sleep to maintain the desired rate.
+            # The device counters are polled twice per exposure so none are missed.
+            interval = 1 / self.rate / (2 if self.hardware_counting else 1)
             elapsed_time = time.time() - start_time
-            sleep_time = max(0, (1 / self.rate) - elapsed_time)
+            sleep_time = max(0, interval - elapsed_time)
             time.sleep(sleep_time)
 
+    @shared
     def get_counts(self):
-        return self.times, {ch.name: ch.counts for ch in self.channels if ch.mode in ["signal-f", "signal-sp"]}
+        """Return (times, {channel name: count rates}) for the whole history, as lists (epoch seconds)."""
+        times, counts = self.history.get()
+        return times.tolist(), {name: values.tolist() for name, values in counts.items()}
+
+    @shared
+    def get_counts_since(self, cursor=0):
+        """Return (times, {channel name: count rates}, cursor) for the samples since cursor, as arrays."""
+        return self.history.get_since(cursor)
 
-    def get_last_timestamps(self):
-        self.get_data()
-        return self.tstamp, self.tchannel
+    @shared
+    def get_counts_history(self, span, width=1000):
+        """
+        Return (resolution, times, {name: min}, {name: mean}, {name: max}) for the last
+        span seconds, as lists, from the raw samples of the last minute or the 1 s, 10 s
+        or 1 min rollups, whichever is finest without many more than width points.
+        """
+        resolution, times, *stats = self.rollups.query(span, width)
+        return (resolution, times.tolist(), *({name: values.tolist() for name, values in stat.items()} for stat in stats))
 
+    @exclusive
+    def get_last_timestamps(self, consumer="remote"):
+        return self.get_data(consumer)
+
+    @shared
     def get_rate(self):
         return self.rate
     
+    @shared
     def get_counting(self): # Return the current counting status
         if self.current_mode == "counting":
             return True
         else:
             return False
 
+    @shared
     def get_N(self):
         return self.N
 
+    @exclusive
     def update_rate(self, new_rate):
         self.rate = new_rate
+        self.rollups.set_rate(new_rate)
+        if self.current_mode == "counting" and self.hardware_counting:
+            self.set_exposure_time()
         return True
 
+    @exclusive
     def update_N(self, new_N):
         self.N = new_N
+        self.history.resize(new_N)
         return True
 
-    def RF_correlation(self, no_runs, rate, no_bins):
+    @exclusive
+    def RF_correlation(self, no_runs, rate, no_bins, rf_frequency=None):
+        """
+        Histogram the delays of the fluorescence photons after the trap drive sync over
+        no_runs reads at rate, and fit sine_wave to it. rf_frequency is the frequency of
+        the modulation in the histogram if known, otherwise it is estimated from the data.
+        Returns (popt, hist, bin_edges), popt = [amplitude, frequency, phase, offset].
+        Blocks until done, see start_rf_correlation for the background version.
+        """
+        job = self._new_job(no_runs, rf_frequency)
+        if job is None:
+            return [], [], []
+        self._run_rf_correlation(job, rate, no_bins)
+        histogram = job["histogram"]
+        if histogram is None or histogram.total() == 0:
+            print("No time differences were computed.")
+            return [], [], []
+        return histogram.result(rf_frequency)
+
+    @exclusive
+    def start_rf_correlation(self, no_runs, rate, no_bins, rf_frequency=None):
+        """
+        Run RF_correlation in the background. Returns a job id to poll with get_job and
+        stop with cancel_job, or None if an RF correlation is already running.
+        """
+        job = self._new_job(no_runs, rf_frequency)
+        if job is None:
+            return None
+        threading.Thread(target=self._run_rf_correlation, args=(job, rate, no_bins), daemon=True).start()
+        return job["id"]
+
+    @shared
+    def get_job(self, job_id):
+        """
+        Return the job's status ("running", "done", "cancelled" or "failed"), progress
+        and the histogram and fit so far as popt, hist and bin_edges (empty until
+        there is data), or None for an unknown job.
+        """
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        histogram = job["histogram"]
+        photons = histogram.total() if histogram is not None else 0
+        popt, hist, bin_edges = histogram.result(job["rf_frequency"]) if photons else ([], [], [])
+        return {
+            "id": job_id,
+            "status": job["status"],
+            "runs": job["runs"],
+            "no_runs": job["no_runs"],
+            "progress": job["runs"] / job["no_runs"] if job["no_runs"] else 1.0,
+            "photons": photons,
+            "popt": popt,
+            "hist": hist,
+            "bin_edges": bin_edges,
+            "error": job["error"],
+        }
+
+    @exclusive
+    def cancel_job(self, job_id):
+        """Stop a running job after its current run; its results so far stay available."""
+        job = self.jobs.get(job_id)
+        if job is None or job["status"] != "running":
+            return False
+        job["cancelled"] = True
+        return True
+
+    def _new_job(self, no_runs, rf_frequency):
+        """Register a new running job, or return None if an RF correlation is already running."""
+        with self.job_lock:
+            if any(job["status"] == "running" for job in self.jobs.values()):
+                print("RF correlation already in progress.")
+                return None
+            job_id = next(self._job_ids)
+            job = {"id": job_id, "status": "running", "runs": 0, "no_runs": no_runs, "rf_frequency": rf_frequency,
+                   "histogram": None, "cancelled": False, "error": None}
+            self.jobs[job_id] = job
+            # Only keep the most recent jobs around for polling
+            for old_id in sorted(self.jobs)[:-self.max_jobs]:
+                if self.jobs[old_id]["status"] != "running":
+                    del self.jobs[old_id]
+        return job
+
+    def _run_rf_correlation(self, job, rate, no_bins):
         if self.current_mode == "experiment":
             print("RF correlation cannot be performed in experiment mode.")
-            return [], [], []
+            job["error"] = "RF correlation cannot be performed in experiment mode."
+            job["status"] = "failed"
+            return
         was_counting = False
         if self.current_mode == "counting":
             self.stop_counting()
@@ -425,111 +1077,104 @@ class QuTau_Reader:
         previous_channels = self.active_channels
         self.enter_rf_correlation_mode()
         self.update_rate(rate)
+        self.clear_data("rf_correlation")
 
-        time_diffs = []
-        self.get_data()
-        
-        
-        for run in range(no_runs):
-            start_time = time.time()
-
-            self.get_data()
-            valid_pulse_count, total_pulses = self.filter_runs_for_fluorescence(expected_fluorescence=8000, pulse_window_time=0.5E-6, bin_size=10000)
-            print(f"Run {run + 1}/{no_runs}: Valid pulses: {valid_pulse_count}, Total pulses: {total_pulses}")
-            start_time2 = time.time()
-            trap_drive_chan = next(ch.number for ch in self.channels if ch.mode == "trap")
-            signal_chans = np.array([ch.number for ch in self.channels if ch.mode in ["signal-f"]], dtype=np.int64)
-            time_diffs_run = compute_time_diffs(self.tstamp, self.tchannel, trap_drive_chan, signal_chans)
-            if time_diffs_run and len(time_diffs_run[0]) > 0:  # Check if time_diffs_run is not empty
-                time_diffs.extend(time_diffs_run[0])  # Assuming single signal channel
-            elapsed_time = time.time() - start_time
-            sleep_time = max(0, (1 / self.rate) - elapsed_time)
-            time.sleep(sleep_time)
-            percent_complete = (run + 1) / no_runs * 100
-            print(f'\rProgress: {percent_complete:.2f}%', end='', flush=True)
-        if len(time_diffs) == 0:
-            print("No time differences were computed.")
-            self.active_channels = previous_channels
-            self.qutau.enableChannels(self.active_channels)
-            if was_counting:
-                self.start_counting()
-            return [], [], []
-
-        time_diffs = np.array(time_diffs, dtype=np.float64)
-
-        # Remove outliers using the IQR method
-        if len(time_diffs) > 0:
-            Q1 = np.percentile(time_diffs, 25)
-            Q3 = np.percentile(time_diffs, 75)
-            IQR = Q3 - Q1
-            lower_bound = Q1 - 1.5 * IQR
-            upper_bound = Q3 + 1.5 * IQR
-
-            filtered_time_diffs = time_diffs[(time_diffs >= lower_bound) & (time_diffs <= upper_bound)]
-        else:
-            filtered_time_diffs = np.array([])
-
-        if len(filtered_time_diffs) == 0:
-            print("No filtered time differences remain after outlier removal.")
+        try:
+            for run in range(job["no_runs"]):
+                if job["cancelled"]:
+                    break
+                start_time = time.time()
+                job["histogram"] = self._rf_correlation_run(job["histogram"], no_bins)
+                job["runs"] = run + 1
+                elapsed_time = time.time() - start_time
+                sleep_time = max(0, (1 / self.rate) - elapsed_time)
+                time.sleep(sleep_time)
+                percent_complete = (run + 1) / job["no_runs"] * 100
+                print(f'\rProgress: {percent_complete:.2f}%', end='', flush=True)
+            job["status"] = "cancelled" if job["cancelled"] else "done"
+        except Exception as e:
+            print(f"Error in RF correlation: {e}")
+            job["error"] = str(e)
+            job["status"] = "failed"
+        finally:
             self.active_channels = previous_channels
-            self.qutau.enableChannels(self.active_channels)
+            self.enable_channels(self.active_channels)
+            self.exit_rf_correlation_mode()
+            self.enter_idle_mode()
             if was_counting:
                 self.start_counting()
-            return [], [], []
-
-        hist, bin_edges = np.histogram(filtered_time_diffs, bins=no_bins, range=(0, max(filtered_time_diffs, default=1)))
-
-        bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
-
-        def fit_sine_wave(p0):
-            try:
-                popt, _ = curve_fit(sine_wave, bin_centers, hist, p0=p0)
-                residuals = hist - sine_wave(bin_centers, *popt)
-                ss_res = np.sum(residuals**2)
-                return popt, ss_res
-            except Exception as e:
-                print(f"Error fitting sine wave: {e}")
-                return [0, 0, 0, 0], float('inf')
-
-        p0_1 = [max(hist), 4 / ((bin_edges[-1] - bin_edges[0])), 0, 0]
-        p0_2 = [max(hist), 8 / ((bin_edges[-1] - bin_edges[0])), 0, 0]
-
-        popt_1, ss_res_1 = fit_sine_wave(p0_1)
-        popt_2, ss_res_2 = fit_sine_wave(p0_2)
-
-        if ss_res_1 < ss_res_2:
-            popt = popt_1
-        else:
-            popt = popt_2
-
-        amplitude, frequency, phase, offset = popt
-        phase = phase % np.pi
-
-        self.active_channels = previous_channels
-        self.qutau.enableChannels(self.active_channels)
-        self.exit_rf_correlation_mode()
-        self.enter_idle_mode()
-        if was_counting:
-            self.start_counting()
-        
-
-        return popt, hist, bin_edges
 
+    def _rf_correlation_run(self, histogram, no_bins):
+        """Add the photon delays since the last read to the histogram, created on the first run with a sync."""
+        tstamp, tchannel = self.get_data("rf_correlation")
+        tstamp, tchannel, valid_pulse_count, total_pulses = self._filter_runs(tstamp, tchannel, expected_fluorescence=8000, pulse_window_time=0.5E-6, bin_size=10000)
+        print(f"Valid pulses: {valid_pulse_count}, Total pulses: {total_pulses}")
+        trap_drive_chan = next(ch.number for ch in self.channels if ch.mode == "trap")
+        if histogram is None:
+            # The delays run from 0 to one sync period, which fixes the histogram range
+            sync_times = tstamp[tchannel == trap_drive_chan]
+            if len(sync_times) < 2:
+                return None
+            histogram = RF_Histogram(no_bins, np.median(np.diff(sync_times)))
+        signal_chans = np.array([ch.number for ch in self.channels if ch.mode in ["signal-f"]], dtype=np.int64)
+        time_diffs_run = self._analyse(compute_time_diffs, tstamp, tchannel, trap_drive_chan, signal_chans)
+        if time_diffs_run and len(time_diffs_run[0]) > 0:
+            histogram.add(time_diffs_run[0])  # Assuming single signal channel
+        return histogram
+
+    @exclusive
     def clear_channels(self):
+        if self.time_diff_dir is not None:
+            self.new_time_diff_files()  # Keep the previous run's files
+            return
         for ch in self.channels:
             ch.clear_time_diffs()
 
+    def new_time_diff_files(self):
+        """
+        Store the time diffs in new files in time_diff_dir from now on. The files are
+        only created by save_recent_time_diffs, once the channel modes of the run are set.
+        """
+        self.time_diff_stamp = time.strftime("%Y%m%d_%H%M%S")
+        for ch in self.channels:
+            ch.time_diffs.close()
+            ch.time_diffs = Time_Diff_Store(outlier_threshold=1e-4)
+
+    def _time_diff_file(self, ch):
+        path = os.path.join(self.time_diff_dir, f"{ch.name}_{self.time_diff_stamp}.tdiff")
+        suffix = itertools.count(1)
+        while os.path.exists(path):  # Started within the same second
+            path = os.path.join(self.time_diff_dir, f"{ch.name}_{self.time_diff_stamp}_{next(suffix)}.tdiff")
+        return Mapped_Time_Diff_Store(path, outlier_threshold=1e-4)
+
+    @exclusive
     def save_recent_time_diffs(self):
         for ch in self.channels:
+            if (self.time_diff_dir is not None and len(ch.recent_time_diffs)
+                    and not isinstance(ch.time_diffs, Mapped_Time_Diff_Store)):
+                ch.time_diffs.close()
+                ch.time_diffs = self._time_diff_file(ch)
             ch.save_recent_time_diffs()
+
+    @exclusive
+    def flush_time_diffs(self):
+        """Write the accumulated time diffs of file-backed channels to disk now."""
+        for ch in self.channels:
+            ch.time_diffs.flush()
     
+    @exclusive
     def discard_recent_time_diffs(self):
         for ch in self.channels:
             ch.discard_recent_time_diffs()
         
     def close(self):
         if self.current_mode != "experiment":
+            self.acquisition.stop()
             self.qutau.deInitialize()  # Use the deInitialize method for cleanup
+            if self.analysis is not None:
+                self.analysis.close()
+            for ch in self.channels:
+                ch.time_diffs.close()
             print("QuTau_Reader has been closed.")
         else:
             print("Cannot close QuTau_Reader while in experiment mode.")
@@ -542,7 +1187,8 @@ class MicromotionWindow:
         self.micromotion_window = tk.Toplevel(parent)
         self.micromotion_window.title("Single Micromotion Fit")
         self.micromotion_window.protocol("WM_DELETE_WINDOW", self.close_window)
-        self.micromotion_thread = None
+        self.job_id = None  # RF correlation job being polled
+        self.poll_interval = 500  # ms
         self.ax = None  # Initialize ax to None
 
         # Initialize previous fit parameters
@@ -572,8 +1218,14 @@ class MicromotionWindow:
         self.entry_no_bins = CustomIntSpinbox(micromotion_frame, from_=1, to=500, initial_value=200)
         self.entry_no_bins.grid(row=2, column=1, padx=5, pady=5)
 
-        self.start_micromotion_button = tk.Button(micromotion_frame, text="Start", command=self.start_rf_correlation_thread)
-        self.start_micromotion_button.grid(row=3, column=0, columnspan=2, padx=5, pady=10)
+        self.start_micromotion_button = tk.Button(micromotion_frame, text="Start", command=self.start_rf_correlation)
+        self.start_micromotion_button.grid(row=3, column=0, padx=5, pady=10)
+
+        self.stop_micromotion_button = tk.Button(micromotion_frame, text="Stop", command=self.stop_rf_correlation, state=tk.DISABLED)
+        self.stop_micromotion_button.grid(row=3, column=1, padx=5, pady=10)
+
+        self.progress_label = tk.Label(micromotion_frame, text="")
+        self.progress_label.grid(row=4, column=0, columnspan=2, padx=5, pady=5)
 
         self.micromotion_window.configure(bg="#f0f0f0")
         micromotion_frame.configure(bg="#f0f0f0")
@@ -625,21 +1277,17 @@ class MicromotionWindow:
         self.ax = self.fig.add_subplot(111)
         self.canvas = FigureCanvasTkAgg(self.fig, master=self.micromotion_window)
         self.canvas.draw()
-        self.canvas.get_tk_widget().grid(row=4, column=0, columnspan=6, padx=5, pady=5)
+        self.canvas.get_tk_widget().grid(row=5, column=0, columnspan=6, padx=5, pady=5)
 
     def close_window(self):
+        self.stop_rf_correlation()
         self.micromotion_window.destroy()
         self.micromotion_window = None
 
-    def start_rf_correlation_thread(self):
-        if self.micromotion_thread and self.micromotion_thread.is_alive():
+    def start_rf_correlation(self):
+        if self.job_id is not None:
             print("Micromotion correlation already in progress.")
             return
-
-        self.micromotion_thread = threading.Thread(target=self.start_rf_correlation)
-        self.micromotion_thread.start()
-
-    def start_rf_correlation(self):
         try:
             no_runs = int(self.entry_no_runs.get())
             rate = float(self.entry_rate.get())
@@ -647,9 +1295,40 @@ class MicromotionWindow:
         except ValueError:
             print("Invalid input, please enter valid numbers.")
             return
-        
-        popt, hist, bin_edges = self.count_reader_client.RF_correlation(no_runs, rate, no_bins)
 
+        self.job_id = self.count_reader_client.start_rf_correlation(no_runs, rate, no_bins)
+        if self.job_id is None:
+            return
+        self.start_micromotion_button.config(state=tk.DISABLED)
+        self.stop_micromotion_button.config(state=tk.NORMAL)
+        self.micromotion_window.after(self.poll_interval, self.poll_rf_correlation)
+
+    def stop_rf_correlation(self):
+        """Stop early, e.g. once the amplitude is resolved; the fit so far is kept."""
+        if self.job_id is not None:
+            self.count_reader_client.cancel_job(self.job_id)
+
+    def poll_rf_correlation(self):
+        """Show the histogram and fit so far, until the job finishes."""
+        if self.micromotion_window is None or self.job_id is None:
+            return
+        job = self.count_reader_client.get_job(self.job_id)
+        if job is None:
+            self.job_id = None
+            return
+        finished = job["status"] != "running"
+        self.progress_label.config(text=f"{job['status'].capitalize()}: run {job['runs']}/{job['no_runs']}, {job['photons']} photons")
+        if finished or len(job["popt"]):
+            self.show_fit(job["popt"], job["hist"], job["bin_edges"], final=finished)
+        if finished:
+            self.job_id = None
+            self.start_micromotion_button.config(state=tk.NORMAL)
+            self.stop_micromotion_button.config(state=tk.DISABLED)
+        else:
+            self.micromotion_window.after(self.poll_interval, self.poll_rf_correlation)
+
+    def show_fit(self, popt, hist, bin_edges, final=True):
+        """Plot the histogram and fit; a final fit also becomes the previous fit for the next run."""
         # Ensure ax is initialized
         if self.ax is None:
             print("Error: ax is not initialized.")
@@ -716,6 +1395,9 @@ class MicromotionWindow:
         self.entry_offset.insert(0, f"{popt[3]:.3f}")
         self.entry_offset.config(state='readonly')
 
+        if not final:
+            return
+
         # Update previous fit parameter output boxes
         self.entry_prev_amplitude.config(state='normal')
         self.entry_prev_amplitude.delete(0, tk.END)
@@ -744,7 +1426,11 @@ class MicromotionWindow:
         self.prev_offset = popt[3]
 
 class LivePlotter(QWidget):
-    def __init__(self, count_reader):
+    def __init__(self, count_reader, max_points=360000):
+        """
+        max_points: samples kept for plotting (an hour at 100 Hz). Only new samples are
+        fetched from the reader each tick and the curves are updated in place.
+        """
         super().__init__()
         self.count_reader_client = Client(count_reader)
  
@@ -760,6 +1446,8 @@ class LivePlotter(QWidget):
         self.plot_widget.setLabel('bottom', "Time", units='s', color='w', size='20pt')
         self.plot_widget.getAxis('left').tickFont = pg.QtGui.QFont('Arial', 14)
         self.plot_widget.getAxis('bottom').tickFont = pg.QtGui.QFont('Arial', 14)
+        self.plot_widget.setClipToView(True)  # Only draw the visible part of long histories
+        self.plot_widget.setDownsampling(auto=True, mode='peak')
         self.layout.addWidget(self.plot_widget)
  
         # Label for displaying current count rate
@@ -808,14 +1496,15 @@ class LivePlotter(QWidget):
         self.timer.timeout.connect(self.update_plot)
         self.timer.start(self.update_interval)
  
-        self.times = []
-        self.counts = []
+        self.max_points = max_points
+        self.history = None  # Local Count_History, created with the curves
+        self.cursor = 0  # Next sample to fetch from the reader
+        self.curves = {}
         self.is_paused = False
         self.is_counting = self.count_reader_client.get_counting()
         self.colors = ['w', 'r', 'g', 'b', 'y', 'c', 'm']  # List of colors to cycle through
         self.is_logging = False  # To track if logging is active
-        self.log_file = None  # To store log file reference
-        self.log_writer = None  # To store the CSV writer
+        self.logger = None  # Data_Logger writing the log in the background
  
         # Initialize counting button state
         self.update_count_button_state()
@@ -836,18 +1525,15 @@ class LivePlotter(QWidget):
             self.stop_log()
             return
 
-        # Ask the user for a filename to save the log
-        filename, _ = QFileDialog.getSaveFileName(self, "Save Log", "", "CSV Files (*.csv)")
+        # Ask the user for a filename to save the log. The log is binary (see
+        # Data_Logger.read_log); choosing .csv also exports it to CSV when it is stopped
+        filename, _ = QFileDialog.getSaveFileName(self, "Save Log", "", "Log Files (*.npylog);;CSV Files (*.csv)")
 
         if filename:
+            base, ext = os.path.splitext(filename)
+            self.logger = Data_Logger(base + ".npylog", list(self.channel_checkboxes.keys()), csv_export=ext.lower() == ".csv")
             self.is_logging = True
-            self.log_file = open(filename, 'w', newline='')
-            log_writer = csv.writer(self.log_file)
-            log_writer.writerow(["Time"] + list(self.channel_checkboxes.keys()))  # Write header
-            print(f"Logging started. Data will be saved to {filename}")
-
-            # Save the writer for future use
-            self.log_writer = log_writer
+            print(f"Logging started. Data will be saved to {self.logger.path}")
 
             # Update button appearance
             self.start_log_button.setText("Stop Log")
@@ -858,10 +1544,9 @@ class LivePlotter(QWidget):
         """Stop logging and close the file."""
         if self.is_logging:
             self.is_logging = False
-            if self.log_file:
-                self.log_file.close()
-            self.log_writer = None
-            self.log_file = None
+            if self.logger:
+                self.logger.close(wait=False)  # Finishes writing (and reports drops) in the background
+            self.logger = None
             print("Logging stopped.")
 
             # Update button appearance
@@ -870,13 +1555,18 @@ class LivePlotter(QWidget):
 
 
     def create_channel_checkboxes(self):
-        """Create checkboxes for each channel."""
-        _, counts = self.count_reader_client.get_counts()
+        """Create a checkbox and a curve for each channel."""
+        _, counts, _ = self.count_reader_client.get_counts_since(0)
         for i, label in enumerate(counts.keys()):
             checkbox = QCheckBox(label)
             checkbox.setChecked(True)
             self.checkbox_layout.addWidget(checkbox)
             self.channel_checkboxes[label] = checkbox
+            color = self.colors[i % len(self.colors)]  # Cycle through colors
+            curve = self.plot_widget.plot([], [], pen=pg.mkPen(color, width=2), name=label)
+            checkbox.toggled.connect(curve.setVisible)
+            self.curves[label] = curve
+        self.history = Count_History(list(counts.keys()), self.max_points)
 
     def set_rate(self, new_rate):
         """Send a command to set the new rate in the PMT_Reader."""
@@ -930,36 +1620,34 @@ class LivePlotter(QWidget):
                 self.update_count_button_state()
             
             if self.is_counting and not self.is_paused:
-                data = self.count_reader_client.get_counts()
-                
-
+                data = self.count_reader_client.get_counts_since(self.cursor)
 
                 if not data:
                     print("No data received from server.")
                     return
 
-                times, counts = data
-
-                self.times = [time.timestamp() for time in times]
+                times, counts, cursor = data  # Only the samples since the last update
+                if cursor < self.cursor:
+                    self.history.clear()  # The reader was restarted, start again
+                self.cursor = cursor
+                if len(times) == 0:
+                    return
+                new_values = np.array([counts[label] for label in self.history.names])
+                self.history.extend(times, new_values)
 
-                # Update plot
-                self.plot_widget.clear()
-                for i, (label, count_values) in enumerate(counts.items()):
+                # Update the curves in place
+                all_times, all_counts = self.history.get()
+                for label, curve in self.curves.items():
                     if self.channel_checkboxes[label].isChecked():
-                        color = self.colors[i % len(self.colors)]  # Cycle through colors
-                        self.plot_widget.plot(self.times, count_values, pen=pg.mkPen(color, width=2), name=label)
+                        curve.setData(all_times, all_counts[label])
 
                 # Update the current count rate label
-                if counts and any(counts.values()):
-                    current_rate = [count_values[-1] for count_values in counts.values()]
-                    self.label.setText(f"Current Count Rate: {current_rate} counts/s")
-                else:
-                    self.label.setText("Current Count Rate: N/A")
+                current_rate = [float(values[-1]) for values in new_values]
+                self.label.setText(f"Current Count Rate: {current_rate} counts/s")
 
-                # Log the data if logging is active
+                # Log the new samples if logging is active
                 if self.is_logging:
-                    log_data = [times[-1].timestamp()] + [counts[channel][-1] for channel in self.channel_checkboxes.keys()]
-                    self.log_writer.writerow(log_data)
+                    self.logger.log_many(times, new_values.T)
                 
     
         except Exception as e:
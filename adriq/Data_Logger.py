@@ -0,0 +1,169 @@
+import os
+import csv
+import queue
+import threading
+import time
+import numpy as np
+
+
+class Data_Logger:
+    """
+    Background logger for the plotters, so logging never blocks the GUI thread.
+
+    log/log_many put samples on a queue and return immediately; a writer thread
+    batches them and appends them to a binary log, flushing at least every
+    flush_interval seconds. A log file starts with the channel names and then holds
+    pairs of arrays (times, values) saved with np.save, one pair per batch, so it is
+    a fraction of the size of a CSV and is read back with read_log. Each sample's
+    values can be one number per channel or one array per channel (e.g. scope traces).
+
+    When a file reaches max_bytes the log continues in <name>_1<ext>, <name>_2<ext>,
+    ... (see files). With csv_export=True every file is also exported to CSV when the
+    logger is closed. If the writer falls max_queue calls to log/log_many behind, new
+    samples are dropped and counted in dropped rather than blocking the caller; the
+    writer prints how many when it finishes.
+    """
+    def __init__(self, path, names, batch_size=1000, flush_interval=1.0, max_bytes=100 * 2**20,
+                 max_queue=100000, csv_export=False):
+        self.path = path
+        self.names = list(names)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.csv_export = csv_export
+        self.files = []  # Paths written so far, oldest first
+        self.dropped = 0
+        self.queue = queue.Queue(max_queue)
+        self.stopping = threading.Event()
+        self._file = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def log(self, t, values):
+        """Queue one sample: time t in epoch seconds and one value (or array) per channel."""
+        self.log_many([t], np.asarray(values, dtype=np.float64)[np.newaxis])
+
+    def log_many(self, times, values):
+        """Queue several samples: an array of times and values with one row per sample."""
+        if self.stopping.is_set():
+            return
+        try:
+            self.queue.put_nowait((np.asarray(times, dtype=np.float64), np.asarray(values, dtype=np.float64)))
+        except queue.Full:
+            self.dropped += len(times)
+
+    def close(self, wait=True):
+        """
+        Write out everything queued and close the file (and export it if requested).
+        Never blocks with wait=False, the writer then finishes in the background.
+        """
+        self.stopping.set()
+        try:
+            self.queue.put_nowait(None)  # Wake the writer up
+        except queue.Full:
+            pass  # It's busy with the queue, and checks stopping between items
+        if wait:
+            self.thread.join()
+
+    def _run(self):
+        pending = []
+        last_flush = time.time()
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0, self.flush_interval - (time.time() - last_flush)))
+            except queue.Empty:
+                item = None
+            if item is not None:
+                pending.append(item)
+            stop = self.stopping.is_set() and self.queue.empty()
+            if stop:
+                # Anything queued while stopping was being set
+                while True:
+                    try:
+                        item = self.queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not None:
+                        pending.append(item)
+            rows = sum(len(times) for times, _ in pending)
+            if stop or rows >= self.batch_size or time.time() - last_flush >= self.flush_interval:
+                try:
+                    self._write(pending)
+                except (OSError, ValueError) as e:
+                    print(f"Error writing log {self.path}: {e}")
+                pending = []
+                last_flush = time.time()
+            if stop:
+                break
+
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.csv_export:
+            for path in self.files:
+                export_csv(path)
+        if self.dropped:
+            print(f"{self.dropped} samples were dropped from the log {self.path}.")
+
+    def _write(self, blocks):
+        # Consecutive samples with the same shape are saved as one pair of arrays
+        while blocks:
+            shape = blocks[0][1].shape[1:]
+            n = next((i for i, (_, values) in enumerate(blocks) if values.shape[1:] != shape), len(blocks))
+            times = np.concatenate([times for times, _ in blocks[:n]])
+            values = np.concatenate([values for _, values in blocks[:n]])
+            blocks = blocks[n:]
+            if self._file is None or self._file.tell() >= self.max_bytes:
+                self._open_next()
+            np.save(self._file, times)
+            np.save(self._file, values)
+        if self._file is not None:
+            self._file.flush()
+
+    def _open_next(self):
+        if self._file is not None:
+            self._file.close()
+        base, ext = os.path.splitext(self.path)
+        path = self.path if not self.files else f"{base}_{len(self.files)}{ext}"
+        self._file = open(path, 'wb')
+        np.save(self._file, np.array(self.names, dtype=str))
+        self.files.append(path)
+
+
+def read_log(path):
+    """
+    Read a Data_Logger file. Returns (names, segments), segments being a list of
+    (times, values) with consecutive batches of the same shape joined.
+    """
+    segments = []
+    with open(path, 'rb') as f:
+        names = np.load(f).tolist()
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size:
+            try:
+                times, values = np.load(f), np.load(f)
+            except (ValueError, EOFError):
+                break  # A batch cut short, e.g. by a crash
+            if segments and segments[-1][1].shape[1:] == values.shape[1:]:
+                segments[-1] = (np.concatenate((segments[-1][0], times)), np.concatenate((segments[-1][1], values)))
+            else:
+                segments.append((times, values))
+    return names, segments
+
+
+def export_csv(path, csv_path=None):
+    """
+    Export a Data_Logger file to CSV (by default next to it, with a .csv extension):
+    a Time column in epoch seconds and one column per channel, holding a list for
+    array values.
+    """
+    if csv_path is None:
+        csv_path = os.path.splitext(path)[0] + ".csv"
+    names, segments = read_log(path)
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["Time"] + names)
+        for times, values in segments:
+            for t, row in zip(times, values):
+                writer.writerow([t] + [value.tolist() if np.ndim(value) else value for value in row])
+    return csv_path
@@ -3,9 +3,271 @@ import os
 import sys
 import pkg_resources
 import numpy as np
+from abc import ABC, abstractmethod
 
-class QuTau:
+# Layout of the files written by TDC_writeTimestamps
+FILE_HEADER_SIZE = 40
+BINARY_RECORD = np.dtype([('tstamp', '<i8'), ('channel', '<i2')])  # 10 bytes per event
+COMPRESSED_RECORD_SIZE = 5  # 37 bit timestamp + 3 bit channel per event
+
+def loadTimestampFile(filename, fileformat=1, timebase=None):
+	"""
+	Load a file written by QuTau.writeTimestamps in the BINARY (1) or COMPRESSED (2) format.
+	
+	Returns (tstamp, tchannel) as int64 arrays. If timebase is given the timestamps are
+	converted to float64 seconds, ready for the tdc_functions kernels.
+	"""
+	if fileformat == 1:
+		records = np.fromfile(filename, dtype=BINARY_RECORD, offset=FILE_HEADER_SIZE)
+		tstamp = records['tstamp'].astype(np.int64)
+		tchannel = records['channel'].astype(np.int64)
+	elif fileformat == 2:
+		raw = np.fromfile(filename, dtype=np.uint8, offset=FILE_HEADER_SIZE)
+		raw = raw[:len(raw) - len(raw) % COMPRESSED_RECORD_SIZE].reshape(-1, COMPRESSED_RECORD_SIZE)
+		words = np.zeros(len(raw), dtype=np.int64)
+		for k in range(COMPRESSED_RECORD_SIZE):
+			words |= raw[:, k].astype(np.int64) << (8 * k)
+		tstamp = words & ((1 << 37) - 1)
+		tchannel = (words >> 37) & 0x7
+	else:
+		raise ValueError(f"Unsupported file format {fileformat}, expected BINARY (1) or COMPRESSED (2).")
+	
+	if timebase is not None:
+		tstamp = tstamp * timebase
+	return tstamp, tchannel
+
+class QuTau_Backend(ABC):
+	"""
+	Method surface shared by the QuTau backends: the qutools DLL wrapper (QuTau) and
+	the software device in QuTau_Simulator. Anything above this layer (QuTau_Reader,
+	QuTau_Acquisition, the servers) should only rely on these methods and constants.
+	A backend that doesn't implement all the abstract methods can't be instantiated.
+	The on-device histogram methods are optional: they are only called when
+	checkFeatureLifetime/checkFeatureHBT return True.
+	"""
+	devtype_dict = { 0: 'DEVTYPE_1A', #quTAU
+		1: 'DEVTYPE_1B', # quTAU(H)
+		2: 'DEVTYPE_1C', # quPSI
+		3: 'DEVTYPE_2A', # quTAG
+		4: 'DEVTYPE_NONE'}
+
+	DEVTYPE_1A = 0
+	DEVTYPE_1B = 1
+	DEVTYPE_1C = 2
+	DEVTYPE_2A = 3
+	
+	# Fileformats ----------------------------------------
+	fileformat_dict = { 0: 'ASCII',
+		1: 'BINARY',
+		2: 'COMPRESSED',
+		3: 'RAW',
+		4: 'NONE' }
+		
+	FILEFORMAT_ASCII = 0
+	FILEFORMAT_BINARY = 1
+	FILEFORMAT_COMPRESSED = 2
+	FILEFORMAT_RAW = 3
+	FILEFORMAT_NONE = 4
+	
+	# Signal conditioning --------------------------------
+	signalcond_dict = { 0: 'TTL',
+		1: 'LVTTL',
+		2: 'NIM',
+		3: 'MISC',
+		4: 'NONE'}
+	
+	SIGNALCOND_TTL = 0
+	SIGNALCOND_LVTTL = 1
+	SIGNALCOND_NIM = 2
+	SIGNALCOND_MISC = 3
+	
+	simtype_dict = { 0: 'FLAT',
+		1: 'NORMAL',
+		2: 'NONE'}
+	
+	SIMTYPE_FLAT = 0
+	SIMTYPE_NORMAL = 1
+	
+	# Error types ----------------------------------------
+	err_dict = {0 : 'No error', 
+		1 : 'Receive timed out', 
+		2 : 'No connection was established',
+		3 : 'Error accessing the USB driver',
+		4 : 'Unknown Error',
+		5 : 'Unknown Error',
+		6 : 'Unknown Error',
+		7 : 'Can''t connect device because already in use',
+		8 : 'Unknown error',
+		9 : 'Invalid device number used in call',
+		10 : 'Parameter in fct. call is out of range',
+		11 : 'Failed to open specified file',
+		12 : 'Library has != been initialized',
+		13 : 'Requested Feature is != enabled',
+		14 : 'Requested Feature is != available'}
+	
+	COINC_CHANNELS = 59  # Length of the counter array (31 on the quTAU, 59 on the quTAG)
+	CHANNELS = 8
+	
 	def __init__(self):
+		self._address = 0  # Device number all calls refer to
+		self._settings = {}  # {device: {setting: value}}, see _cacheSetting
+
+	@abstractmethod
+	def Initialize(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def deInitialize(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getVersion(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getTimebase(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getDeviceType(self):
+		raise NotImplementedError
+	
+	def checkFeatureHBT(self):
+		return False
+	
+	def checkFeatureLifetime(self):
+		return False
+	
+	@abstractmethod
+	def enableChannels(self, channels):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getBufferSize(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def setBufferSize(self, size):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getDataLost(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getLastTimestamps(self, reset):
+		# Returns (timestamps, channels, valid), trimmed to the valid events
+		raise NotImplementedError
+	
+	@abstractmethod
+	def writeTimestamps(self, filename="", fileformat=None):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def inputTimestamps(self, timestamps, channels, count=None):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def readTimestamps(self, filename, fileformat):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def setChannelsDelay(self, delays):
+		# delays: 8 per-channel delays in timebase units
+		raise NotImplementedError
+	
+	@abstractmethod
+	def setDeadTime(self, channel, deadTime):
+		# deadTime in ps
+		raise NotImplementedError
+	
+	@abstractmethod
+	def setCoincidenceWindow(self, coincWin):
+		# coincWin in timebase units
+		raise NotImplementedError
+	
+	@abstractmethod
+	def setTermination(self, on):
+		raise NotImplementedError
+	
+	def getSettings(self):
+		# Settings last written to the addressed device
+		return dict(self._settings.get(self._address, {}))
+	
+	def _cachedSetting(self, key):
+		# Settings are cached per addressed device, so reapplying a configuration
+		# only talks to the device for the settings that actually changed
+		return self._settings.get(self._address, {}).get(key)
+	
+	def _cacheSetting(self, key, value):
+		self._settings.setdefault(self._address, {})[key] = value
+	
+	@abstractmethod
+	def setExposureTime(self, expTime):
+		raise NotImplementedError
+	
+	# On-device histograms, only used when checkFeatureLifetime/checkFeatureHBT
+	def enableLft(self, enable):
+		raise NotImplementedError
+	
+	def setLftParams(self, binWidth, binCount):
+		raise NotImplementedError
+	
+	def setLftStartInput(self, startChannel):
+		raise NotImplementedError
+	
+	def resetLftHistograms(self):
+		raise NotImplementedError
+	
+	def getLftHistogram(self, channel, reset=False):
+		# Returns (counts, binWidth, startEvents, stopEvents)
+		raise NotImplementedError
+	
+	def enableHbt(self, enable):
+		raise NotImplementedError
+	
+	def setHbtParams(self, binWidth, binCount):
+		raise NotImplementedError
+	
+	def setHbtInput(self, channel1, channel2):
+		raise NotImplementedError
+	
+	def resetHbtCorrelations(self):
+		raise NotImplementedError
+	
+	def getHbtCorrelations(self, forward=True):
+		# Returns (values, binWidth, indexOffset)
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getCoincCounters(self):
+		# Returns (counters, updates)
+		raise NotImplementedError
+	
+	@abstractmethod
+	def discover(self):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def connect(self, deviceNumber):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def disconnect(self, deviceNumber):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def addressDevice(self, deviceNumber):
+		raise NotImplementedError
+	
+	@abstractmethod
+	def getDeviceInfo(self, deviceNumber):
+		# Returns (deviceType, id, serial, connected)
+		raise NotImplementedError
+
+class QuTau(QuTau_Backend):
+	def __init__(self):
+		super().__init__()
 		# Determine the DLL directory based on system architecture
 		if sys.maxsize > 2**32:
 			# 64-bit Python
@@ -23,68 +285,10 @@ class QuTau:
 
 		# Load the DLL
 		self.qutools_dll = ctypes.windll.LoadLibrary(dll_path)
-		self.devtype_dict = { 0: 'DEVTYPE_1A', #quTAU
-			1: 'DEVTYPE_1B', # quTAU(H)
-			2: 'DEVTYPE_1C', # quPSI
-			3: 'DEVTYPE_2A', # quTAG
-			4: 'DEVTYPE_NONE'}
-
-		self.DEVTYPE_1A = 0
-		self.DEVTYPE_1B = 1
-		self.DEVTYPE_1C = 2
-		self.DEVTYPE_2A = 3
-		
-		# Fileformats ----------------------------------------
-		self.fileformat_dict = { 0: 'ASCII',
-			1: 'BINARY',
-			2: 'COMPRESSED',
-			3: 'RAW',
-			4: 'NONE' }
-			
-		self.FILEFORMAT_ASCII = 0
-		self.FILEFORMAT_BINARY = 1
-		self.FILEFORMAT_RAW = 2
-		self.FILEFORMAT_NONE = 3
-		
-		# Signal conditioning --------------------------------
-		self.signalcond_dict = { 0: 'TTL',
-			1: 'LVTTL',
-			2: 'NIM',
-			3: 'MISC',
-			4: 'NONE'}
-		
-		self.SIGNALCOND_TTL = 0
-		self.SIGNALCOND_LVTTL = 1
-		self.SIGNALCOND_NIM = 2
-		self.SIGNALCOND_MISC = 3
-		
-		self.simtype_dict = { 0: 'FLAT',
-			1: 'NORMAL',
-			2: 'NONE'}
-		
-		self.SIMTYPE_FLAT = 0
-		self.SIMTYPE_NORMAL = 1
-		
-		# Error types ----------------------------------------
-		self.err_dict = {0 : 'No error', 
-			1 : 'Receive timed out', 
-			2 : 'No connection was established',
-			3 : 'Error accessing the USB driver',
-			4 : 'Unknown Error',
-			5 : 'Unknown Error',
-			6 : 'Unknown Error',
-			7 : 'Can''t connect device because already in use',
-			8 : 'Unknown error',
-			9 : 'Invalid device number used in call',
-			10 : 'Parameter in fct. call is out of range',
-			11 : 'Failed to open specified file',
-			12 : 'Library has != been initialized',
-			13 : 'Requested Feature is != enabled',
-			14 : 'Requested Feature is != available'}
-			
 		# ----------------------------------------------------
 		self.dev_nr=-1
 		
+		self._bindFunctions()
 		self.Initialize()
 		
 		self._bufferSize = 1000000
@@ -102,14 +306,69 @@ class QuTau:
 
 
 # Init --------------------------------------------------------------	
+	def _bindFunctions(self):
+		# Bind the prototypes of the hot-path functions once, rather than on every call
+		self.qutools_dll.TDC_getVersion.restype = ctypes.c_double
+		
+		self.qutools_dll.TDC_getTimestampBufferSize.argtypes = [ctypes.POINTER(ctypes.c_int32)]
+		self.qutools_dll.TDC_getTimestampBufferSize.restype = ctypes.c_int32
+		
+		self.qutools_dll.TDC_setTimestampBufferSize.argtypes = [ctypes.c_int32]
+		self.qutools_dll.TDC_setTimestampBufferSize.restype = ctypes.c_int32
+		
+		self.qutools_dll.TDC_getLastTimestamps.argtypes = [ctypes.c_int32,ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_int8),ctypes.POINTER(ctypes.c_int32)]
+		self.qutools_dll.TDC_getLastTimestamps.restype = ctypes.c_int32
+		
+		self.qutools_dll.TDC_getCoincCounters.argtypes = [ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_int32)]
+		self.qutools_dll.TDC_getCoincCounters.restype = ctypes.c_int32
+		self._coincCounters = np.zeros(self.COINC_CHANNELS, dtype=np.int32)
+		self._coincPointer = self._coincCounters.ctypes.data_as(ctypes.POINTER(ctypes.c_int32))
+		self._coincUpdates = ctypes.c_int32()
+		
+		# The histogram functions are opaque library objects, created when the feature is enabled
+		self.qutools_dll.TDC_createLftFunction.restype = ctypes.c_void_p
+		self.qutools_dll.TDC_getLftHistogram.argtypes = [ctypes.c_int32,ctypes.c_int32,ctypes.c_void_p,
+			ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_int64)]
+		self.qutools_dll.TDC_analyseLftFunction.argtypes = [ctypes.c_void_p,ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_int32),
+			ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_int32),ctypes.c_int32]
+		self.qutools_dll.TDC_releaseLftFunction.argtypes = [ctypes.c_void_p]
+		self.qutools_dll.TDC_releaseLftFunction.restype = None
+		self.qutools_dll.TDC_createHbtFunction.restype = ctypes.c_void_p
+		self.qutools_dll.TDC_releaseHbtFunction.argtypes = [ctypes.c_void_p]
+		self.qutools_dll.TDC_releaseHbtFunction.restype = None
+		self.qutools_dll.TDC_getHbtCorrelations.argtypes = [ctypes.c_int32,ctypes.c_void_p]
+		self.qutools_dll.TDC_analyseHbtFunction.argtypes = [ctypes.c_void_p,ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_int32),
+			ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_int32),ctypes.POINTER(ctypes.c_double),ctypes.c_int32]
+		self._lftFunction = None
+		self._hbtFunction = None
+		self._lftValues = None  # Allocated by setLftParams
+		self._hbtValues = None  # Allocated by setHbtParams
+		
+		self.qutools_dll.TDC_writeTimestamps.argtypes = [ctypes.c_char_p, ctypes.c_int]
+		self.qutools_dll.TDC_readTimestamps.argtypes = [ctypes.c_char_p, ctypes.c_int]
+		self.qutools_dll.TDC_inputTimestamps.argtypes = [ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_uint8),ctypes.c_int32]
+		
+	def _allocateBuffers(self):
+		# Two sets of output arrays, used alternately, so the views returned by one
+		# getLastTimestamps call stay valid while the next call is being filled
+		self._timestampBuffers = [np.zeros(int(self._bufferSize), dtype=np.int64) for _ in range(2)]
+		self._channelBuffers = [np.zeros(int(self._bufferSize), dtype=np.int8) for _ in range(2)]
+		self._timestampPointers = [buf.ctypes.data_as(ctypes.POINTER(ctypes.c_int64)) for buf in self._timestampBuffers]
+		self._channelPointers = [buf.ctypes.data_as(ctypes.POINTER(ctypes.c_int8)) for buf in self._channelBuffers]
+		self._bufferIndex = 0
+		self._valid = ctypes.c_int32()
+		
 	def Initialize(self): 
 		ans = self.qutools_dll.TDC_init(self.dev_nr)
+		self._settings = {}  # The device starts from its defaults again
         
 		if (ans != 0):
 			print ("Error in TDC_init:" + self.err_dict[ans])
 		return ans
 
 	def deInitialize(self):
+		self._releaseLftFunction()
+		self._releaseHbtFunction()
 		ans = self.qutools_dll.TDC_deInit()
         
 		if (ans != 0): # from the documentation: "never fails"
@@ -118,9 +377,7 @@ class QuTau:
 
 # Device Info -------------------------------------------------------------
 	def getVersion(self):
-		func = self.qutools_dll.TDC_getVersion
-		func.restype = ctypes.c_double
-		ans = func()
+		ans = self.qutools_dll.TDC_getVersion()
 		return ans        
 	
 	def getTimebase(self):
@@ -150,38 +407,57 @@ class QuTau:
 
 # multiple devices ---------------------------------	
 	def addressDevice(self,deviceNumber):
-		print ("!= implemented")
-		return 0
+		# Select the device that all following calls refer to
+		ans = self.qutools_dll.TDC_addressDevice(ctypes.c_uint(deviceNumber))
+		if (ans!=0):
+			print ("Error in TDC_addressDevice:"+self.err_dict[ans])
+		else:
+			self._address = deviceNumber
+		return ans
 	
 	def connect(self,deviceNumber):
-		print ("!= implemented")
-		return 0
+		ans = self.qutools_dll.TDC_connect(ctypes.c_uint(deviceNumber))
+		if (ans!=0):
+			print ("Error in TDC_connect:"+self.err_dict[ans])
+		return ans
 	
 	def disconnect(self,deviceNumber):
-		print ("!= implemented")
-		return 0
+		if deviceNumber == self._address:
+			# The histogram functions were created for the addressed device
+			self._releaseLftFunction()
+			self._releaseHbtFunction()
+		ans = self.qutools_dll.TDC_disconnect(ctypes.c_uint(deviceNumber))
+		if (ans!=0):
+			print ("Error in TDC_disconnect:"+self.err_dict[ans])
+		return ans
 
-	def discover(self,deviceNumber):
-		print ("!= implemented")
-		return 0
+	def discover(self):
+		# Returns the number of devices found
+		devCount = ctypes.c_uint()
+		ans = self.qutools_dll.TDC_discover(ctypes.byref(devCount))
+		if (ans!=0):
+			print ("Error in TDC_discover:"+self.err_dict[ans])
+		return devCount.value
 
-	def getCurrentAddress(self,deviceNumber):
-		print ("!= implemented")
-		return 0
+	def getCurrentAddress(self):
+		devNo = ctypes.c_uint()
+		ans = self.qutools_dll.TDC_getCurrentAddress(ctypes.byref(devNo))
+		if (ans!=0):
+			print ("Error in TDC_getCurrentAddress:"+self.err_dict[ans])
+		return devNo.value
 		
 	def getDeviceInfo(self,deviceNumber):
-		devnum = ctypes.c_int321(deviceNumber)
 		devicetype = ctypes.c_int32()
 		deviceid = ctypes.c_int32()
-		serialnumnber=ctypes.c_char_p()
-		connected = ctypes.s_int32()
+		serialnumber = ctypes.create_string_buffer(16)
+		connected = ctypes.c_int32()
 		
-		ans = self.qutools_dll.TDC_getDeviceInfo(devnum,ctypes.byref(devicetype), ctypes.byref(deviceid), ctypes.byref(serialnumber), ctypes.byref(connected))
+		ans = self.qutools_dll.TDC_getDeviceInfo(ctypes.c_uint(deviceNumber),ctypes.byref(devicetype), ctypes.byref(deviceid), serialnumber, ctypes.byref(connected))
 		
 		if (ans!=0):
-			print ("Error in TDC_getDeviceInfo:"+self.ans_dict[err])
+			print ("Error in TDC_getDeviceInfo:"+self.err_dict[ans])
 			
-		return (devicetype.value, deviceid.value, serialnumber.value,connected.value)
+		return (devicetype.value, deviceid.value, serialnumber.value.decode(errors='replace'), connected.value == 1)
 		
 # Configure Channels ----------------------------------------------------------------
 	def getSignalConditioning(self, channel):
@@ -256,39 +532,71 @@ class QuTau:
 		return ans
 		
 	def getChannelsDelay(self):
-		print ("!= implemented")
-		return 0
+		delays = (ctypes.c_int32 * self.CHANNELS)()
+		ans = self.qutools_dll.TDC_getChannelDelays(delays)
+		if (ans!=0):
+			print ("Error in TDC_getChannelDelays:"+self.err_dict[ans])
+		return list(delays)
 		
 	def setChannelsDelay(self, delays):
-		print ("!= implemented")
-		return 0
+		# Delays in timebase units, added to the channels' timestamps by the device
+		delays = tuple(int(d) for d in delays)
+		if len(delays) != self.CHANNELS:
+			print ("Error: setChannelsDelay expects %d delays"%self.CHANNELS)
+			return 10
+		if self._cachedSetting('delays') == delays:
+			return 0
+		ans = self.qutools_dll.TDC_setChannelDelays((ctypes.c_int32 * self.CHANNELS)(*delays))
+		if (ans!=0):
+			print ("Error in TDC_setChannelDelays:"+self.err_dict[ans])
+		else:
+			self._cacheSetting('delays', delays)
+		return ans
 		
-	def getDeadTime(self):
+	def getDeadTime(self, channel):
 		if (self._deviceType != self.DEVTYPE_2A):
 			# only available in DEVTYPE_2A
-			print ("Error: getDeadtime is != available for this device type")
+			print ("Error: getDeadTime is != available for this device type")
 			return -1
 		
-		print ("!= implemented")
-		return 0
+		deadTime = ctypes.c_int32()
+		ans = self.qutools_dll.TDC_getDeadTime(ctypes.c_int32(channel), ctypes.byref(deadTime))
+		if (ans!=0):
+			print ("Error in TDC_getDeadTime:"+self.err_dict[ans])
+		return deadTime.value
 		
-	def setDeadTime(self):
+	def setDeadTime(self, channel, deadTime):
+		# Dead time in ps; events closer than this to the previous one are dropped by the device
 		if (self._deviceType != self.DEVTYPE_2A):
 			# only available in DEVTYPE_2A
-			print ("Error: getDeadtime is != available for this device type")
+			print ("Error: setDeadTime is != available for this device type")
 			return -1
 		
-		print ("!= implemented")
-		return 0
+		deadTime = int(deadTime)
+		if self._cachedSetting(('deadTime', channel)) == deadTime:
+			return 0
+		ans = self.qutools_dll.TDC_setDeadTime(ctypes.c_int32(channel), ctypes.c_int32(deadTime))
+		if (ans!=0):
+			print ("Error in TDC_setDeadTime:"+self.err_dict[ans])
+		else:
+			self._cacheSetting(('deadTime', channel), deadTime)
+		return ans
 	
 	def setTermination(self, on):
-		if (self.getDevType() != self_DEVTYPE_1A):
+		if (self._deviceType != self.DEVTYPE_1A):
 			# only available in DEVTYPE_1A
 			print ("Error: setTermination != available for this device type")
 			return -1
-			
-		print ("!= implemented")
-		return 0
+		
+		on = bool(on)
+		if self._cachedSetting('termination') == on:
+			return 0
+		ans = self.qutools_dll.TDC_switchTermination(ctypes.c_int32(on))
+		if (ans!=0):
+			print ("Error in TDC_switchTermination:"+self.err_dict[ans])
+		else:
+			self._cacheSetting('termination', on)
+		return ans
 	
 	def enableTDCInput(self, enable):
 		print ("!= implemented")
@@ -314,17 +622,22 @@ class QuTau:
 		
 # Define Measurements -------------------------------------------------------
 	def setCoincidenceWindow(self, coincWin):
-		coincidence = ctypes.c_int32(coincWin)
-		ans = self.qutools_dll.TDC_setCoincidenceWindows(coincidence)
+		# Window in timebase units for the coincidence counters
+		coincWin = int(coincWin)
+		if self._cachedSetting('coincWindow') == coincWin:
+			return 0
+		ans = self.qutools_dll.TDC_setCoincidenceWindow(ctypes.c_int32(coincWin))
 		if (ans!=0):
-			print ("Error in TDC_setCoincidenceWindows:"+dict_err[ans])
-		return 0
+			print ("Error in TDC_setCoincidenceWindow:"+self.err_dict[ans])
+		else:
+			self._cacheSetting('coincWindow', coincWin)
+		return ans
 		
 	def setExposureTime(self, expTime):
 		exposure = ctypes.c_int32(expTime)
 		ans = self.qutools_dll.TDC_setExposureTime(exposure)
 		if (ans!=0):
-			print ("Error in TDC_setExposureTime:"+dict_err[ans])
+			print ("Error in TDC_setExposureTime:"+self.err_dict[ans])
 		return ans
 		
 	def getDeviceParams(self):
@@ -334,7 +647,7 @@ class QuTau:
 		
 		ans = self.qutools_dll.TDC_getDeviceParams(ctypes.byref(chn), ctypes.byref(coinc), ctypes.byref(exptime))
 		if ans!=0:
-			print ("Error in TDC_getDeviceParams:"+dict_err[ans])
+			print ("Error in TDC_getDeviceParams:"+self.err_dict[ans])
 		return (chn.value, coinc.value, exptime.value)
 
 # Self test ---------------------------------------------------------------------
@@ -349,21 +662,17 @@ class QuTau:
 # Timestamping ---------------------------------------------------------
 	def getBufferSize(self):
 		sz = ctypes.c_int32()
-        
-		self.qutools_dll.TDC_getTimestampBufferSize.argtypes = [ctypes.POINTER(ctypes.c_int32)]
-		self.qutools_dll.TDC_getTimestampBufferSize.restype = [ctypes.c_int32]
-        
-		ans = self.qutools_dll.TDC_setTimestampBufferSize(ctypes.byref(sz))
+		ans = self.qutools_dll.TDC_getTimestampBufferSize(ctypes.byref(sz))
 		if (ans!=0):
 			print ("Error in TDC_getTimestampBufferSize:"+self.err_dict[ans])
 		return sz.value
 	
 	def setBufferSize(self, size):
 		self._bufferSize = size
-		sz = ctypes.c_int32(size)
 		ans = self.qutools_dll.TDC_setTimestampBufferSize(self._bufferSize)
 		if (ans!=0):
 			print ("Error in TDC_setTimestampBufferSize: "+self.err_dict[ans])
+		self._allocateBuffers()
 		return ans
 		
 	def getDataLost(self):
@@ -377,44 +686,175 @@ class QuTau:
 		return 0
 	
 	def getLastTimestamps(self,reset):
-		res = ctypes.c_int32(reset)
-		timestamps = np.zeros(int(self._bufferSize), dtype=np.int64)
-		channels = np.zeros(int(self._bufferSize), dtype=np.int8)
-		valid = ctypes.c_int32()
-        
-		self.qutools_dll.TDC_getLastTimestamps.argtypes = [ctypes.c_int32,ctypes.POINTER(ctypes.c_int64),ctypes.POINTER(ctypes.c_int8),ctypes.POINTER(ctypes.c_int32)]
-		self.qutools_dll.TDC_getLastTimestamps.restype = ctypes.c_int32
-        
-		ans = self.qutools_dll.TDC_getLastTimestamps(reset,timestamps.ctypes.data_as(ctypes.POINTER(ctypes.c_int64)),channels.ctypes.data_as(ctypes.POINTER(ctypes.c_int8)),ctypes.byref(valid))
+		# Returns views of length valid into a reused buffer. They are overwritten
+		# two calls later, so copy them if they need to be kept for longer.
+		idx = self._bufferIndex
+		self._bufferIndex = 1 - idx
+		
+		ans = self.qutools_dll.TDC_getLastTimestamps(int(reset),self._timestampPointers[idx],self._channelPointers[idx],ctypes.byref(self._valid))
          
 		if (ans!=0): # "never fails"
 			print ("Error in TDC_getLastTimestamps:"+self.err_dict[ans])
-			
-		return (timestamps, channels, valid.value)
+		
+		valid = self._valid.value
+		return (self._timestampBuffers[idx][:valid], self._channelBuffers[idx][:valid], valid)
 	
 # File IO -------------------------------------------
-	def writeTimestamps(self):
-		print ("!= implemented")
-		return 0
+	def writeTimestamps(self, filename="", fileformat=None):
+		# The library streams every incoming timestamp to the file until called
+		# again with an empty filename (or FILEFORMAT_NONE)
+		if fileformat is None:
+			fileformat = self.FILEFORMAT_BINARY if filename else self.FILEFORMAT_NONE
+		ans = self.qutools_dll.TDC_writeTimestamps(filename.encode(), fileformat)
+		if (ans!=0):
+			print ("Error in TDC_writeTimestamps:"+self.err_dict[ans])
+		return ans
 		
-	def inputTimestamps(self, timestamps,channels,count):
-		print ("!= implemented")
-		return 0
+	def inputTimestamps(self, timestamps,channels,count=None):
+		# Feeds timestamps into the library as if they had come from the device
+		timestamps = np.ascontiguousarray(timestamps, dtype=np.int64)
+		channels = np.ascontiguousarray(channels, dtype=np.uint8)
+		if count is None:
+			count = len(timestamps)
+		ans = self.qutools_dll.TDC_inputTimestamps(timestamps.ctypes.data_as(ctypes.POINTER(ctypes.c_int64)),channels.ctypes.data_as(ctypes.POINTER(ctypes.c_uint8)),count)
+		if (ans!=0):
+			print ("Error in TDC_inputTimestamps:"+self.err_dict[ans])
+		return ans
 	
 	def readTimestamps(self, filename, fileformat):
-		print ("!= implemented")
-		return 0
+		# Replays a file through the library (into the timestamp buffer)
+		ans = self.qutools_dll.TDC_readTimestamps(filename.encode(), fileformat)
+		if (ans!=0):
+			print ("Error in TDC_readTimestamps:"+self.err_dict[ans])
+		return ans
 		
 # Counting --------------------------------------------
 	def getCoincCounters(self):
-		print ("!= implemented")
-		return 0
+		# Counts of the last completed exposure: entries 0-7 are the single channel
+		# counts, followed by the coincidence counters. updates is the number of
+		# exposures completed since the previous call (0 means nothing new).
+		ans = self.qutools_dll.TDC_getCoincCounters(self._coincPointer, ctypes.byref(self._coincUpdates))
+		if (ans!=0):
+			print ("Error in TDC_getCoincCounters:"+self.err_dict[ans])
+		return (self._coincCounters.copy(), self._coincUpdates.value)
 # APD (qupsi) -------------------------------------------------------
 # (!= implemented)
 
 # Start-Stop --------------------------------------------------------
 
 # Lifetime ----------------------------------------------------------
+	def enableLft(self, enable):
+		ans = self.qutools_dll.TDC_enableLft(ctypes.c_int32(enable))
+		if (ans!=0):
+			print ("Error in TDC_enableLft:"+self.err_dict[ans])
+		else:
+			self._releaseLftFunction()
+			if enable:
+				self._lftFunction = self.qutools_dll.TDC_createLftFunction()
+		return ans
+	
+	def _releaseLftFunction(self):
+		if self._lftFunction is not None:
+			self.qutools_dll.TDC_releaseLftFunction(self._lftFunction)
+			self._lftFunction = None
+	
+	def setLftParams(self, binWidth, binCount):
+		# binWidth in timebase units
+		ans = self.qutools_dll.TDC_setLftParams(ctypes.c_int32(binWidth), ctypes.c_int32(binCount))
+		if (ans!=0):
+			print ("Error in TDC_setLftParams:"+self.err_dict[ans])
+		else:
+			self._lftValues = np.zeros(binCount, dtype=np.int32)
+		return ans
+	
+	def setLftStartInput(self, startChannel):
+		ans = self.qutools_dll.TDC_setLftStartInput(ctypes.c_int32(startChannel))
+		if (ans!=0):
+			print ("Error in TDC_setLftStartInput:"+self.err_dict[ans])
+		return ans
+	
+	def resetLftHistograms(self):
+		ans = self.qutools_dll.TDC_resetLftHistograms()
+		if (ans!=0):
+			print ("Error in TDC_resetLftHistograms:"+self.err_dict[ans])
+		return ans
+	
+	def getLftHistogram(self, channel, reset=False):
+		# Returns (counts, binWidth, startEvents, stopEvents): the histogram of the delays
+		# from the start input to the stop events on channel, bin i starting at i * binWidth
+		if self._lftFunction is None or self._lftValues is None:
+			raise RuntimeError("Call setLftParams and enableLft(True) before getLftHistogram.")
+		tooBig = ctypes.c_int64()
+		startEvents = ctypes.c_int64()
+		stopEvents = ctypes.c_int64()
+		expTime = ctypes.c_int64()
+		ans = self.qutools_dll.TDC_getLftHistogram(ctypes.c_int32(channel), ctypes.c_int32(reset), self._lftFunction,
+			ctypes.byref(tooBig), ctypes.byref(startEvents), ctypes.byref(stopEvents), ctypes.byref(expTime))
+		if (ans!=0):
+			print ("Error in TDC_getLftHistogram:"+self.err_dict[ans])
+		
+		capacity = ctypes.c_int32()
+		size = ctypes.c_int32()
+		binWidth = ctypes.c_int32()
+		ans = self.qutools_dll.TDC_analyseLftFunction(self._lftFunction, ctypes.byref(capacity), ctypes.byref(size),
+			ctypes.byref(binWidth), self._lftValues.ctypes.data_as(ctypes.POINTER(ctypes.c_int32)), len(self._lftValues))
+		if (ans!=0):
+			print ("Error in TDC_analyseLftFunction:"+self.err_dict[ans])
+		return (self._lftValues[:size.value].astype(np.int64), binWidth.value, startEvents.value, stopEvents.value)
 
 # HBT ---------------------------------------------------------------
+	def enableHbt(self, enable):
+		ans = self.qutools_dll.TDC_enableHbt(ctypes.c_int32(enable))
+		if (ans!=0):
+			print ("Error in TDC_enableHbt:"+self.err_dict[ans])
+		else:
+			self._releaseHbtFunction()
+			if enable:
+				self._hbtFunction = self.qutools_dll.TDC_createHbtFunction()
+		return ans
+	
+	def _releaseHbtFunction(self):
+		if self._hbtFunction is not None:
+			self.qutools_dll.TDC_releaseHbtFunction(self._hbtFunction)
+			self._hbtFunction = None
+	
+	def setHbtParams(self, binWidth, binCount):
+		# binWidth in timebase units; the bins are centred on zero delay
+		ans = self.qutools_dll.TDC_setHbtParams(ctypes.c_int32(binWidth), ctypes.c_int32(binCount))
+		if (ans!=0):
+			print ("Error in TDC_setHbtParams:"+self.err_dict[ans])
+		else:
+			self._hbtValues = np.zeros(binCount, dtype=np.float64)
+		return ans
+	
+	def setHbtInput(self, channel1, channel2):
+		ans = self.qutools_dll.TDC_setHbtInput(ctypes.c_int32(channel1), ctypes.c_int32(channel2))
+		if (ans!=0):
+			print ("Error in TDC_setHbtInput:"+self.err_dict[ans])
+		return ans
+	
+	def resetHbtCorrelations(self):
+		ans = self.qutools_dll.TDC_resetHbtCorrelations()
+		if (ans!=0):
+			print ("Error in TDC_resetHbtCorrelations:"+self.err_dict[ans])
+		return ans
+	
+	def getHbtCorrelations(self, forward=True):
+		# Returns (values, binWidth, indexOffset): the correlation function, value i at a
+		# delay of (i + indexOffset) * binWidth
+		if self._hbtFunction is None or self._hbtValues is None:
+			raise RuntimeError("Call setHbtParams and enableHbt(True) before getHbtCorrelations.")
+		ans = self.qutools_dll.TDC_getHbtCorrelations(ctypes.c_int32(forward), self._hbtFunction)
+		if (ans!=0):
+			print ("Error in TDC_getHbtCorrelations:"+self.err_dict[ans])
+		
+		capacity = ctypes.c_int32()
+		size = ctypes.c_int32()
+		binWidth = ctypes.c_int32()
+		indexOffset = ctypes.c_int32()
+		ans = self.qutools_dll.TDC_analyseHbtFunction(self._hbtFunction, ctypes.byref(capacity), ctypes.byref(size),
+			ctypes.byref(binWidth), ctypes.byref(indexOffset), self._hbtValues.ctypes.data_as(ctypes.POINTER(ctypes.c_double)), len(self._hbtValues))
+		if (ans!=0):
+			print ("Error in TDC_analyseHbtFunction:"+self.err_dict[ans])
+		return (self._hbtValues[:size.value].copy(), binWidth.value, indexOffset.value)
 	
\ No newline at end of file
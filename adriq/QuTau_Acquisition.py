@@ -0,0 +1,402 @@
+import time
+import threading
+import numpy as np
+
+from .Buffers import Timestamp_Ring_Buffer
+
+
+class Adaptive_Drain_Controller:
+    """
+    Chooses the drain interval and device buffer size from the observed event rate, so
+    the device buffer is about target_fill full at each drain. The interval is adjusted
+    first; the buffer is only grown when the interval is already at its minimum (or data
+    was lost), and shrunk when the interval is at its maximum and the buffer mostly empty.
+    The buffer never shrinks below min_buffer, the device's default size, because the
+    rate can jump by orders of magnitude (e.g. when channels are enabled after idling)
+    before the controller has seen a single drain at the new rate.
+    """
+    def __init__(self, target_fill=0.25, min_interval=0.005, max_interval=0.5,
+                 min_buffer=1000000, max_buffer=10000000, smoothing=0.3):
+        self.target_fill = target_fill
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.min_buffer = min_buffer
+        self.max_buffer = max_buffer
+        self.smoothing = smoothing
+        self.event_rate = 0.0  # Smoothed events per second
+        self.fill = 0.0  # Fill fraction seen at the last drain
+        self.loss_events = 0
+        self.resizes = 0
+
+    def update(self, valid, elapsed, lost, buffer_size, interval):
+        """Returns the (interval, buffer_size) to use from now on."""
+        if elapsed > 0:
+            rate = valid / elapsed
+            self.event_rate += self.smoothing * (rate - self.event_rate)
+        self.fill = valid / buffer_size if buffer_size else 0.0
+
+        if lost:
+            self.loss_events += 1
+            interval = max(self.min_interval, interval / 2)
+            return interval, self._resize(buffer_size, 2 * buffer_size)
+
+        if self.event_rate <= 0:
+            return self.max_interval, buffer_size
+
+        interval = self.target_fill * buffer_size / self.event_rate
+        interval = min(self.max_interval, max(self.min_interval, interval))
+        expected_fill = self.event_rate * interval / buffer_size
+        if interval == self.min_interval and expected_fill > self.target_fill:
+            buffer_size = self._resize(buffer_size, 2 * buffer_size)
+        elif interval == self.max_interval and expected_fill < self.target_fill / 4:
+            buffer_size = self._resize(buffer_size, buffer_size // 2)
+        return interval, buffer_size
+
+    def _resize(self, old_size, new_size):
+        new_size = int(min(self.max_buffer, max(self.min_buffer, new_size)))
+        if new_size != old_size:
+            self.resizes += 1
+        return new_size
+
+    def get_metrics(self):
+        return {
+            "event_rate": self.event_rate,
+            "fill": self.fill,
+            "loss_events": self.loss_events,
+            "resizes": self.resizes,
+        }
+
+
+class QuTau_Acquisition:
+    """
+    Drains the QuTau timestamp buffer on a background thread at a fixed cadence into a
+    large ring buffer. Consumers (counting, experiment, correlation, logging...) read
+    the stream through named subscribers, each with its own cursor, so no mode has to
+    reset the device buffer and several analyses can run on the same stream.
+
+    With adaptive=True (or an Adaptive_Drain_Controller) the drain interval and the
+    device buffer size follow the observed event rate instead of staying fixed.
+    """
+    def __init__(self, qutau, capacity=2**24, interval=0.05, adaptive=False):
+        self.qutau = qutau
+        self.ring = Timestamp_Ring_Buffer(capacity)
+        self.interval = interval
+        if adaptive is True:
+            adaptive = Adaptive_Drain_Controller()
+        self.controller = adaptive or None
+        self._last_drain_time = None
+        self.running = False
+        self.lock = threading.RLock()  # Serialises device access and ring writes
+        self.subscribers = {}
+        self.drains = 0
+        self.data_lost = 0  # Number of drains for which the device reported lost events
+        self._thread = None
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._thread = threading.Thread(target=self._acquisition_loop, daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=2 * self.interval + 1)
+        self._thread = None
+        return True
+
+    def _acquisition_loop(self):
+        with self.lock:
+            self.qutau.getLastTimestamps(True)  # Discard anything stale in the device buffer
+        while self.running:
+            start_time = time.time()
+            try:
+                self.drain()
+            except Exception as e:
+                print(f"Error draining QuTau buffer: {e}")
+            elapsed_time = time.time() - start_time
+            time.sleep(max(0, self.interval - elapsed_time))
+
+    def drain(self):
+        """Move everything in the device buffer into the ring. Returns the number of events."""
+        with self.lock:
+            lost = self.qutau.getDataLost()
+            tstamp, tchannel, valid = self.qutau.getLastTimestamps(True)
+            now = time.time()
+            self.ring.write(tstamp, tchannel)  # Copies out of the reused device buffers
+            self.drains += 1
+            if self.controller is not None:
+                elapsed = now - self._last_drain_time if self._last_drain_time else 0.0
+                buffer_size = self.qutau._bufferSize
+                self.interval, new_size = self.controller.update(valid, elapsed, lost, buffer_size, self.interval)
+                if new_size != buffer_size:
+                    # The device buffer was just emptied, so nothing is lost by resizing now
+                    self.qutau.setBufferSize(new_size)
+            self._last_drain_time = now
+        if lost:
+            self.data_lost += 1
+            print(f"Warning: QuTau reported lost timestamps (drain {self.drains}, buffer {valid} events).")
+        return valid
+
+    def enable_channels(self, channels):
+        with self.lock:  # Don't reconfigure the device mid-drain
+            return self.qutau.enableChannels(channels)
+
+    def configure_channels(self, delays=None, dead_times=None):
+        """
+        Write per-channel settings to the device: delays {channel: timebase units}, with
+        unlisted channels undelayed, and dead_times {channel: ps}. The backend skips
+        anything the device already has, so this is cheap to call again.
+        """
+        with self.lock:
+            return self._configure_device(delays or {}, dead_times or {}, 0)
+
+    def _configure_device(self, delays, dead_times, first):
+        n = self.qutau.CHANNELS
+        ans = self.qutau.setChannelsDelay([delays.get(first + ch, 0) for ch in range(n)])
+        for ch, dead_time in dead_times.items():
+            if first <= ch < first + n:
+                ans = self.qutau.setDeadTime(ch - first, dead_time) or ans
+        return ans
+
+    def set_coincidence_window(self, window):
+        with self.lock:
+            return self.qutau.setCoincidenceWindow(window)
+
+    def set_exposure_time(self, exposure_time):
+        with self.lock:
+            return self.qutau.setExposureTime(exposure_time)
+
+    def read_counters(self):
+        """Return (counters indexed by channel, updates) from the device counters."""
+        with self.lock:
+            return self.qutau.getCoincCounters()
+
+    def subscribe(self, name):
+        """Return the named subscriber, creating it at the current head if needed."""
+        with self.lock:
+            if name not in self.subscribers:
+                self.subscribers[name] = self.ring.subscribe()
+            return self.subscribers[name]
+
+    def unsubscribe(self, name):
+        with self.lock:
+            self.subscribers.pop(name, None)
+
+    def read(self, name):
+        """Return all raw (tstamp, tchannel) events the named subscriber has not seen yet."""
+        return self.subscribe(name).read()
+
+    def skip(self, name):
+        self.subscribe(name).skip()
+
+    def get_status(self):
+        status = {
+            "running": self.running,
+            "interval": self.interval,
+            "buffer_size": self.qutau._bufferSize,
+            "events": self.ring.head,
+            "drains": self.drains,
+            "data_lost": self.data_lost,
+            "subscribers": {name: {"lag": sub.lag(), "lost": sub.lost} for name, sub in self.subscribers.items()},
+        }
+        if self.controller is not None:
+            status.update(self.controller.get_metrics())
+        return status
+
+
+class Multi_Device_Acquisition(QuTau_Acquisition):
+    """
+    Acquisition from several TDCs sharing the qutools library, each drained by its own
+    thread. Device i's channels are renumbered to i * channels_per_device + channel so
+    they are globally unique, and offsets[device] (in timebase units) is added to its
+    timestamps. The per-device streams are time ordered, so they are merged k-way into
+    the ring: everything up to the smallest per-device watermark (the latest timestamp
+    seen from each device) is final and is written out in time order. A device which
+    has been silent for flush_timeout seconds does not hold the merge back.
+
+    The ring then holds one time-ordered stream, so subscribers and the tdc_functions
+    kernels work on it unchanged.
+    """
+    def __init__(self, qutau, devices, offsets=None, capacity=2**24, interval=0.05,
+                 channels_per_device=8, flush_timeout=0.5):
+        super().__init__(qutau, capacity=capacity, interval=interval)
+        self.devices = list(devices)
+        self.channels_per_device = channels_per_device
+        self.offsets = {dev: 0 for dev in self.devices}
+        if offsets:
+            self.offsets.update(offsets)
+        self.flush_timeout = flush_timeout
+        self._pending = {dev: (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8)) for dev in self.devices}
+        self._watermark = {dev: None for dev in self.devices}
+        self._last_seen = {dev: time.time() for dev in self.devices}
+        self._threads = []
+
+    def connect(self):
+        with self.lock:
+            found = self.qutau.discover()
+            print(f"Found {found} TDC device(s).")
+            for dev in self.devices:
+                self.qutau.connect(dev)
+                print(f"Device {dev}: {self.qutau.getDeviceInfo(dev)}")
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._threads = [threading.Thread(target=self._device_loop, args=(dev,), daemon=True) for dev in self.devices]
+            for thread in self._threads:
+                thread.start()
+        return True
+
+    def stop(self):
+        self.running = False
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout=2 * self.interval + 1)
+        self._threads = []
+        return True
+
+    def _device_loop(self, dev):
+        with self.lock:
+            self.qutau.addressDevice(dev)
+            self.qutau.getLastTimestamps(True)  # Discard anything stale in the device buffer
+        while self.running:
+            start_time = time.time()
+            try:
+                self.drain_device(dev)
+            except Exception as e:
+                print(f"Error draining TDC {dev}: {e}")
+            elapsed_time = time.time() - start_time
+            time.sleep(max(0, self.interval - elapsed_time))
+
+    def drain_device(self, dev):
+        with self.lock:
+            self.qutau.addressDevice(dev)
+            lost = self.qutau.getDataLost()
+            tstamp, tchannel, valid = self.qutau.getLastTimestamps(True)
+            if valid:
+                tstamp = tstamp + self.offsets[dev]  # Also copies out of the reused device buffers
+                tchannel = tchannel + self.devices.index(dev) * self.channels_per_device
+                old_tstamp, old_tchannel = self._pending[dev]
+                self._pending[dev] = (np.concatenate((old_tstamp, tstamp)), np.concatenate((old_tchannel, tchannel)))
+                self._watermark[dev] = tstamp[-1]
+                self._last_seen[dev] = time.time()
+            self.drains += 1
+            self.merge()
+        if lost:
+            self.data_lost += 1
+            print(f"Warning: TDC {dev} reported lost timestamps (buffer {valid} events).")
+        return valid
+
+    def drain(self):
+        return sum(self.drain_device(dev) for dev in self.devices)
+
+    def merge(self, flush=False):
+        """Write every pending event that can no longer be preceded by another device's event."""
+        with self.lock:
+            now = time.time()
+            holding = [self._watermark[dev] for dev in self.devices
+                       if now - self._last_seen[dev] < self.flush_timeout]
+            if flush or not holding:
+                limit = None
+            elif any(mark is None for mark in holding):
+                return 0  # A live device hasn't delivered anything yet
+            else:
+                limit = min(holding)
+
+            runs_tstamp, runs_tchannel = [], []
+            for dev in self.devices:
+                tstamp, tchannel = self._pending[dev]
+                n = len(tstamp) if limit is None else np.searchsorted(tstamp, limit, side='right')
+                if n:
+                    runs_tstamp.append(tstamp[:n])
+                    runs_tchannel.append(tchannel[:n])
+                    self._pending[dev] = (tstamp[n:], tchannel[n:])
+            if not runs_tstamp:
+                return 0
+
+            tstamp = np.concatenate(runs_tstamp)
+            tchannel = np.concatenate(runs_tchannel)
+            if len(runs_tstamp) > 1:
+                # The stable sort detects the k sorted runs and merges them
+                order = np.argsort(tstamp, kind='stable')
+                tstamp, tchannel = tstamp[order], tchannel[order]
+            self.ring.write(tstamp, tchannel)
+            return len(tstamp)
+
+    def _local_channels(self, channels, index):
+        first = index * self.channels_per_device
+        return [ch - first for ch in channels if first <= ch < first + self.channels_per_device]
+
+    def enable_channels(self, channels):
+        with self.lock:
+            for index, dev in enumerate(self.devices):
+                self.qutau.addressDevice(dev)
+                self.qutau.enableChannels(self._local_channels(channels, index))
+        return 0
+
+    def configure_channels(self, delays=None, dead_times=None):
+        ans = 0
+        with self.lock:
+            for index, dev in enumerate(self.devices):
+                self.qutau.addressDevice(dev)
+                ans = self._configure_device(delays or {}, dead_times or {}, index * self.channels_per_device) or ans
+        return ans
+
+    def set_coincidence_window(self, window):
+        with self.lock:
+            for dev in self.devices:
+                self.qutau.addressDevice(dev)
+                self.qutau.setCoincidenceWindow(window)
+        return 0
+
+    def set_exposure_time(self, exposure_time):
+        with self.lock:
+            for dev in self.devices:
+                self.qutau.addressDevice(dev)
+                self.qutau.setExposureTime(exposure_time)
+        return 0
+
+    def read_counters(self):
+        counters, updates = [], []
+        with self.lock:
+            for dev in self.devices:
+                self.qutau.addressDevice(dev)
+                dev_counters, dev_updates = self.qutau.getCoincCounters()
+                counters.append(dev_counters[:self.channels_per_device])
+                updates.append(dev_updates)
+        return np.concatenate(counters), min(updates)
+
+    def calibrate_offsets(self, reference_channels, duration=1.0):
+        """
+        Measure the offsets between devices from a common reference signal fed into
+        reference_channels[i] (a global channel number) on each device. Device 0 is the
+        reference; the offset of every other device is the median distance from its
+        reference events to the nearest reference event on device 0.
+        """
+        subscriber = self.subscribe("offset_calibration")
+        subscriber.skip()
+        time.sleep(duration)
+        self.drain()
+        tstamp, tchannel = subscriber.read()
+        self.unsubscribe("offset_calibration")
+
+        reference = tstamp[tchannel == reference_channels[0]]
+        if len(reference) == 0:
+            raise ValueError("No reference events seen on the first device.")
+        for dev, channel in zip(self.devices[1:], reference_channels[1:]):
+            events = tstamp[tchannel == channel]
+            if len(events) == 0:
+                print(f"No reference events seen on device {dev}, offset unchanged.")
+                continue
+            idx = np.clip(np.searchsorted(reference, events), 1, len(reference) - 1)
+            nearest = np.where(np.abs(reference[idx] - events) < np.abs(reference[idx - 1] - events), reference[idx], reference[idx - 1])
+            self.offsets[dev] += int(np.median(nearest - events))
+        print(f"Device offsets: {self.offsets}")
+        return dict(self.offsets)
+
+    def get_status(self):
+        status = super().get_status()
+        status["devices"] = {dev: {"offset": self.offsets[dev], "pending": len(self._pending[dev][0])} for dev in self.devices}
+        return status
@@ -0,0 +1,318 @@
+import time
+import numpy as np
+
+from .QuTau import QuTau_Backend, loadTimestampFile, FILE_HEADER_SIZE, BINARY_RECORD
+
+
+class QuTau_Simulator(QuTau_Backend):
+    """
+    Software QuTau with the same method surface as the DLL wrapper, so QuTau_Reader,
+    QuTau_Acquisition and the servers can run (and be benchmarked) without the hardware.
+
+    Events are generated lazily whenever the device is queried:
+        rates:   {channel: Hz} Poisson sources, e.g. PMT and single photon detectors.
+        periods: {channel: seconds} periodic sources, e.g. the trap drive or the PS sync.
+    Only enabled channels produce events. The device buffer holds at most the buffer size
+    (the oldest events are dropped and getDataLost reports it), as on the real device.
+    Channel delays and dead times are applied to the generated events like the device does.
+
+    With realtime=True the simulated clock follows the wall clock. With realtime=False
+    every getLastTimestamps call advances the clock by `step` seconds, so the stack above
+    runs as fast as it can process events.
+    """
+    def __init__(self, rates=None, periods=None, realtime=True, step=0.1, timebase=81e-12,
+                 device_type=QuTau_Backend.DEVTYPE_1A, max_step=1.0, seed=None):
+        super().__init__()
+        self.rates = dict(rates) if rates is not None else {6: 20e3, 0: 500}
+        self.periods = dict(periods) if periods is not None else {}
+        self.realtime = realtime
+        self.step = step
+        self.max_step = max_step  # Longest interval generated at once; anything older is lost
+        self._timebase = timebase
+        self._deviceType = device_type
+        self._featureHBT = False
+        self._featureLifetime = False
+        self.rng = np.random.default_rng(seed)
+
+        self._enabled = set()
+        self._bufferSize = 1000000
+        self._pendingTstamp = np.zeros(0, dtype=np.int64)
+        self._pendingChannel = np.zeros(0, dtype=np.int8)
+        self._dataLost = False
+        self._time = 0.0  # Simulated device time in seconds
+        self._lastWall = None
+        self._recordFile = None
+        self._exposureTime = 100  # ms
+        self._exposureEnd = 0.0  # Simulated time the last completed exposure ended
+        self._coincCounters = np.zeros(self.COINC_CHANNELS, dtype=np.int32)
+        self._delays = np.zeros(self.CHANNELS, dtype=np.int64)  # timebase units
+        self._deadTimes = {}  # {channel: timebase units}
+        self._lastEvent = {}  # {channel: last timestamp that passed the dead time}
+        self._coincWindow = 0
+        self._termination = False
+        self._allocateBuffers()
+
+        print("Initialized simulated " + self.devtype_dict[self._deviceType] + " device.")
+
+    def _allocateBuffers(self):
+        self._timestampBuffers = [np.zeros(int(self._bufferSize), dtype=np.int64) for _ in range(2)]
+        self._channelBuffers = [np.zeros(int(self._bufferSize), dtype=np.int8) for _ in range(2)]
+        self._bufferIndex = 0
+
+    # Event generation ---------------------------------------------------
+    def _advance(self, dt=None):
+        if dt is None:
+            if not self.realtime:
+                return
+            now = time.time()
+            dt = 0.0 if self._lastWall is None else now - self._lastWall
+            self._lastWall = now
+        if dt <= 0:
+            return
+        if dt > self.max_step:
+            # Don't generate more than can ever fit, just mark it as lost
+            self._time += dt - self.max_step
+            if self._activeRate() > 0:
+                self._dataLost = True
+            dt = self.max_step
+
+        start, stop = self._time, self._time + dt
+        times, channels = [], []
+        for channel in self._enabled:
+            if channel in self.periods:
+                period = self.periods[channel]
+                first = np.ceil(start / period)
+                t = np.arange(first, np.ceil(stop / period)) * period
+            elif channel in self.rates:
+                n = self.rng.poisson(self.rates[channel] * dt)
+                t = np.sort(self.rng.uniform(start, stop, n))
+            else:
+                continue
+            t = np.round(t / self._timebase).astype(np.int64)
+            if channel < self.CHANNELS:
+                t += self._delays[channel]
+            if channel in self._deadTimes:
+                t = self._applyDeadTime(channel, t)
+            times.append(t)
+            channels.append(np.full(len(t), channel, dtype=np.int8))
+        self._time = stop
+
+        if not times:
+            return
+        times = np.concatenate(times)
+        channels = np.concatenate(channels)
+        order = np.argsort(times, kind="stable")
+        self._push(times[order], channels[order])
+
+    def _applyDeadTime(self, channel, t):
+        # An event is dropped if it is within the dead time of the last event kept.
+        # Anything further than that from the previous raw event is always kept, so
+        # only the (rare) close events have to be checked one by one.
+        deadTime = self._deadTimes[channel]
+        last = self._lastEvent.get(channel, np.iinfo(np.int64).min // 2)
+        keep = np.diff(t, prepend=last) >= deadTime
+        reference = last
+        for i in np.flatnonzero(~keep):
+            if i > 0 and keep[i - 1]:
+                reference = t[i - 1]
+            keep[i] = t[i] - reference >= deadTime
+            if keep[i]:
+                reference = t[i]
+        t = t[keep]
+        if len(t):
+            self._lastEvent[channel] = t[-1]
+        return t
+
+    def _activeRate(self):
+        return sum(self.rates.get(ch, 0) + (1 / self.periods[ch] if ch in self.periods else 0) for ch in self._enabled)
+
+    def _push(self, tstamp, tchannel):
+        if self._recordFile is not None and len(tstamp):
+            records = np.empty(len(tstamp), dtype=BINARY_RECORD)
+            records['tstamp'] = tstamp
+            records['channel'] = tchannel
+            self._recordFile.write(records.tobytes())
+        self._pendingTstamp = np.concatenate((self._pendingTstamp, tstamp))
+        self._pendingChannel = np.concatenate((self._pendingChannel, tchannel))
+        overflow = len(self._pendingTstamp) - self._bufferSize
+        if overflow > 0:
+            self._pendingTstamp = self._pendingTstamp[overflow:]
+            self._pendingChannel = self._pendingChannel[overflow:]
+            self._dataLost = True
+
+    # Init -----------------------------------------------------------------
+    def Initialize(self):
+        return 0
+
+    def deInitialize(self):
+        return 0
+
+    # Device Info ----------------------------------------------------------
+    def getVersion(self):
+        return 0.0
+
+    def getTimebase(self):
+        return self._timebase
+
+    def getDeviceType(self):
+        return self._deviceType
+
+    def checkFeatureHBT(self):
+        return self._featureHBT
+
+    def checkFeatureLifetime(self):
+        return self._featureLifetime
+
+    # Multiple devices ---------------------------------------------------
+    # A single simulated device, addressed as device 0
+    def discover(self):
+        return 1
+
+    def connect(self, deviceNumber):
+        return 0 if deviceNumber == 0 else 9
+
+    def disconnect(self, deviceNumber):
+        return 0 if deviceNumber == 0 else 9
+
+    def addressDevice(self, deviceNumber):
+        return 0 if deviceNumber == 0 else 9
+
+    def getCurrentAddress(self):
+        return 0
+
+    def getDeviceInfo(self, deviceNumber):
+        return (self._deviceType, 0, "SIMULATED", True)
+
+    # Configure Channels -------------------------------------------------
+    def enableChannels(self, channels):
+        self._advance()
+        self._enabled = set(int(ch) for ch in channels)
+        return 0
+
+    def getChannelsDelay(self):
+        return list(self._delays)
+
+    def setChannelsDelay(self, delays):
+        if len(delays) != self.CHANNELS:
+            print(f"Error: setChannelsDelay expects {self.CHANNELS} delays")
+            return 10
+        self._advance()
+        self._delays = np.array(delays, dtype=np.int64)
+        self._cacheSetting('delays', tuple(int(d) for d in delays))
+        return 0
+
+    def getDeadTime(self, channel):
+        if self._deviceType != self.DEVTYPE_2A:
+            print("Error: getDeadTime is not available for this device type")
+            return -1
+        return int(round(self._deadTimes.get(channel, 0) * self._timebase * 1e12))
+
+    def setDeadTime(self, channel, deadTime):
+        if self._deviceType != self.DEVTYPE_2A:
+            print("Error: setDeadTime is not available for this device type")
+            return -1
+        self._advance()
+        ticks = int(round(deadTime * 1e-12 / self._timebase))
+        if ticks > 0:
+            self._deadTimes[channel] = ticks
+        else:
+            self._deadTimes.pop(channel, None)
+        self._cacheSetting(('deadTime', channel), int(deadTime))
+        return 0
+
+    def setCoincidenceWindow(self, coincWin):
+        self._coincWindow = int(coincWin)
+        self._cacheSetting('coincWindow', self._coincWindow)
+        return 0
+
+    def setTermination(self, on):
+        if self._deviceType != self.DEVTYPE_1A:
+            print("Error: setTermination is not available for this device type")
+            return -1
+        self._termination = bool(on)
+        self._cacheSetting('termination', self._termination)
+        return 0
+
+    # Timestamping ---------------------------------------------------------
+    def getBufferSize(self):
+        return self._bufferSize
+
+    def setBufferSize(self, size):
+        self._bufferSize = int(size)
+        self._push(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8))
+        self._allocateBuffers()
+        return 0
+
+    def getDataLost(self):
+        self._advance()
+        return int(self._dataLost)
+
+    def getLastTimestamps(self, reset):
+        if self.realtime:
+            self._advance()
+        else:
+            self._advance(self.step)
+
+        idx = self._bufferIndex
+        self._bufferIndex = 1 - idx
+        valid = len(self._pendingTstamp)
+        self._timestampBuffers[idx][:valid] = self._pendingTstamp
+        self._channelBuffers[idx][:valid] = self._pendingChannel
+        if reset:
+            self._pendingTstamp = self._pendingTstamp[:0]
+            self._pendingChannel = self._pendingChannel[:0]
+            self._dataLost = False
+        return (self._timestampBuffers[idx][:valid], self._channelBuffers[idx][:valid], valid)
+
+    # Counting -------------------------------------------------------------
+    def setExposureTime(self, expTime):
+        self._advance()
+        self._exposureTime = int(expTime)
+        self._exposureEnd = self._time
+        return 0
+
+    def getCoincCounters(self):
+        if self.realtime:
+            self._advance()
+        else:
+            self._advance(self.step)
+        exposure = self._exposureTime / 1000
+        updates = int((self._time - self._exposureEnd) // exposure) if exposure > 0 else 0
+        if updates > 0:
+            self._exposureEnd += updates * exposure
+            self._coincCounters[:] = 0
+            for channel in self._enabled:
+                if channel in self.periods:
+                    self._coincCounters[channel] = int(exposure / self.periods[channel])
+                elif channel in self.rates:
+                    self._coincCounters[channel] = self.rng.poisson(self.rates[channel] * exposure)
+        return (self._coincCounters.copy(), updates)
+
+    # File IO ----------------------------------------------------------------
+    def writeTimestamps(self, filename="", fileformat=None):
+        if self._recordFile is not None:
+            self._recordFile.close()
+            self._recordFile = None
+        if not filename or fileformat == self.FILEFORMAT_NONE:
+            return 0
+        if fileformat not in (None, self.FILEFORMAT_BINARY):
+            print("Error: the simulated device only writes the BINARY format")
+            return 10
+        self._recordFile = open(filename, 'wb')
+        self._recordFile.write(bytes(FILE_HEADER_SIZE))
+        return 0
+
+    def inputTimestamps(self, timestamps, channels, count=None):
+        if count is None:
+            count = len(timestamps)
+        self._push(np.asarray(timestamps[:count], dtype=np.int64), np.asarray(channels[:count], dtype=np.int8))
+        return 0
+
+    def readTimestamps(self, filename, fileformat):
+        # Replay a recorded file into the buffer, as the library does
+        try:
+            tstamp, tchannel = loadTimestampFile(filename, fileformat)
+        except (OSError, ValueError) as e:
+            print(f"Error in readTimestamps: {e}")
+            return 11
+        return self.inputTimestamps(tstamp, tchannel)
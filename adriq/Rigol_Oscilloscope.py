@@ -3,9 +3,10 @@ import numpy as np
 import time
 import threading
 from datetime import datetime
-import csv
+import os
 import sys
 from .Servers import Client
+from .Data_Logger import Data_Logger
 import pyqtgraph as pg
 from PyQt5.QtWidgets import (
     QWidget, QVBoxLayout, QLabel, QPushButton, QHBoxLayout, QSpinBox, QDoubleSpinBox,
@@ -187,8 +188,7 @@ class ScopePlotter(QWidget):
         self.is_paused = False
         self.is_logging = False
         self.is_acquiring = False
-        self.log_writer = None
-        self.log_file = None
+        self.logger = None  # Data_Logger writing the log in the background
         self.colors = ['w', 'r', 'g', 'b']
 
         self.ylim_row = QHBoxLayout()
@@ -267,22 +267,22 @@ class ScopePlotter(QWidget):
         if self.is_logging:
             self.stop_log()
         else:
-            filename, _ = QFileDialog.getSaveFileName(self, "Save Log", "", "CSV Files (*.csv)")
+            # The log is binary (see Data_Logger.read_log); .csv also exports it when stopped
+            filename, _ = QFileDialog.getSaveFileName(self, "Save Log", "", "Log Files (*.npylog);;CSV Files (*.csv)")
             if filename:
-                self.log_file = open(filename, 'w', newline='')
-                self.log_writer = csv.writer(self.log_file)
-                header = ['Timestamp'] + list(self.scope_reader.channels)
-                self.log_writer.writerow(header)
+                base, ext = os.path.splitext(filename)
+                filename = base + ".npylog"
+                self.logger = Data_Logger(filename, list(self.scope_reader.channels), batch_size=10,
+                                          csv_export=ext.lower() == ".csv")
                 self.is_logging = True
                 self.log_button.setText("Stop Log")
                 self.log_button.setStyleSheet("font-size: 16pt; padding: 10px 20px; background-color: purple; color: white;")
                 print(f"Logging to {filename}")
 
     def stop_log(self):
-        if self.log_file:
-            self.log_file.close()
-        self.log_writer = None
-        self.log_file = None
+        if self.logger:
+            self.logger.close(wait=False)  # Finishes writing in the background
+        self.logger = None
         self.is_logging = False
         self.log_button.setText("Start Log")
         self.log_button.setStyleSheet("font-size: 16pt; padding: 10px 20px; background-color: blue; color: white;")
@@ -301,13 +301,14 @@ class ScopePlotter(QWidget):
                     self.plot_widget.plot(data, pen=pg.mkPen(color, width=2), name=ch)
 
             if self.is_logging and timestamp:
-                row = [timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')]
-                for ch in self.scope_reader.channels:
-                    if voltages[ch] is not None:
-                        row.append(list(voltages[ch]))
-                    else:
-                        row.append("NaN")
-                self.log_writer.writerow(row)
+                # One trace per channel, NaN for channels without data
+                traces = [voltages[ch] for ch in self.scope_reader.channels]
+                points = max((len(trace) for trace in traces if trace is not None), default=0)
+                row = np.full((len(traces), points), np.nan)
+                for i, trace in enumerate(traces):
+                    if trace is not None:
+                        row[i, :len(trace)] = trace
+                self.logger.log(timestamp.timestamp(), row)
 
         except Exception as e:
             print(f"Plot update error: {e}")
\ No newline at end of file
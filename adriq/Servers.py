@@ -1,85 +1,434 @@
+import os
+import sys
 import socket
 import threading
+import asyncio
+import functools
+import itertools
+from concurrent import futures
 import pickle
 import atexit
 import time
+import ipaddress
+from multiprocessing import shared_memory, resource_tracker
 
 import struct
 
-def send_msg(sock, data):
-    data = pickle.dumps(data)
-    length = struct.pack('!I', len(data))
-    sock.sendall(length + data)
+# A message is a header (pickle length, number of buffers), an entry per buffer, the
+# names of any shared memory segments, the pickle and then the inline buffers. Pickle
+# protocol 5 leaves the data of contiguous NumPy arrays out of the pickle as buffers,
+# which are sent and received as they are. Between processes on the same host, buffers
+# of at least SHM_THRESHOLD bytes are put in shared memory segments instead and only
+# their names go through the socket.
+HEADER = struct.Struct('!II')
+BUFFER_ENTRY = struct.Struct('!BQH')  # kind, length, segment name length
+INLINE, SHARED = 0, 1
+SHM_THRESHOLD = 1 << 20
 
-def recv_msg(sock):
-    raw_len = recvall(sock, 4)
-    if not raw_len:
-        return None
-    msg_len = struct.unpack('!I', raw_len)[0]
-    return pickle.loads(recvall(sock, msg_len))
+_owned = set()  # Names of the segments created by this process
+
+def encode_msg(data, segments=None):
+    """
+    Return the parts of the message for data, to be sent in order. With segments (a
+    dict), large buffers go in shared memory segments, which are added to it by name:
+    the sender owns them and must release them with release_segments once the
+    receiver has read them.
+    """
+    buffers = []
+    data = pickle.dumps(data, protocol=5, buffer_callback=buffers.append)
+    entries, names, inline = [], [], []
+    for buffer in buffers:
+        buffer = buffer.raw()
+        if segments is not None and buffer.nbytes >= SHM_THRESHOLD:
+            shm = shared_memory.SharedMemory(create=True, size=buffer.nbytes)
+            _owned.add(shm.name)
+            shm.buf[:buffer.nbytes] = buffer
+            segments[shm.name] = shm
+            name = shm.name.encode()
+            entries.append(BUFFER_ENTRY.pack(SHARED, buffer.nbytes, len(name)))
+            names.append(name)
+        else:
+            entries.append(BUFFER_ENTRY.pack(INLINE, buffer.nbytes, 0))
+            inline.append(buffer)
+    header = HEADER.pack(len(data), len(entries)) + b''.join(entries) + b''.join(names)
+    if sum(buffer.nbytes for buffer in inline) < 65536:
+        return [b''.join([header, data] + inline)]  # One send for small messages
+    return [header + data] + inline
+
+def send_msg(sock, data, segments=None):
+    """Send data, see encode_msg."""
+    for part in encode_msg(data, segments):
+        sock.sendall(part)
+
+def _parse_msg(shared_names):
+    # Generator that yields the number of bytes it needs next, is sent them, and
+    # returns the message, so the same parsing serves sockets and asyncio streams
+    msg_len, n_buffers = HEADER.unpack((yield HEADER.size))
+    entries = list(BUFFER_ENTRY.iter_unpack((yield BUFFER_ENTRY.size * n_buffers)))
+    names = yield sum(name_len for _, _, name_len in entries)
+    data = yield msg_len
+    buffers = []
+    offset = 0
+    missing = None
+    for kind, length, name_len in entries:
+        if kind == SHARED:
+            name = bytes(names[offset:offset + name_len]).decode()
+            offset += name_len
+            try:
+                buffers.append(_read_segment(name, length))
+            except FileNotFoundError:
+                # Already released by a sender which gave up waiting, the rest of the
+                # message is still read so the next one starts in the right place
+                missing = name
+                continue
+            if shared_names is not None:
+                shared_names.append(name)
+        else:
+            buffers.append((yield length))
+    if missing is not None:
+        raise FileNotFoundError(f"Shared memory segment {missing} was released before it was read.")
+    # Arrays are rebuilt on top of the received buffers, without copying
+    return pickle.loads(data, buffers=buffers)
+
+def recv_msg(sock, shared_names=None):
+    """
+    Receive a message, or None if the connection closes. Arrays in shared memory are
+    rebuilt on the mapped segments, which stay mapped for as long as the arrays are in
+    use, and the segment names are appended to shared_names so the sender can be told
+    to release them.
+    """
+    parser = _parse_msg(shared_names)
+    n = next(parser)
+    while True:
+        data = recvall(sock, n)
+        if data is None:
+            return None
+        try:
+            n = parser.send(data)
+        except StopIteration as done:
+            return done.value
+
+async def read_msg(loop, sock, shared_names=None):
+    """recv_msg for a non-blocking socket served by an asyncio loop."""
+    parser = _parse_msg(shared_names)
+    n = next(parser)
+    while True:
+        data = await recvall_async(loop, sock, n)
+        if data is None:
+            return None
+        try:
+            n = parser.send(data)
+        except StopIteration as done:
+            return done.value
+
+def release_segments(segments, names=None):
+    """
+    Release the named segments (all by default) once read, and remove them from segments.
+    A released segment is unlinked, not reused: the receiver may still have arrays on
+    it, which keep their mapping until they are freed.
+    """
+    for name in list(segments) if names is None else names:
+        shm = segments.pop(name, None)
+        if shm is None:
+            continue
+        shm.close()
+        shm.unlink()
+        _owned.discard(shm.name)
+
+def _read_segment(name, length):
+    if sys.version_info >= (3, 13):
+        shm = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shm = shared_memory.SharedMemory(name=name)
+        if os.name == "posix" and name not in _owned:
+            # The segment belongs to the sender, don't let this process's resource
+            # tracker unlink it (or warn about it) when this process exits
+            resource_tracker.unregister(shm._name, "shared_memory")
+    # Keep the mapping and close the rest: the returned view holds on to the mapping,
+    # so it is unmapped once the last array on it is freed
+    mapping, shm._mmap = shm._mmap, None
+    shm.close()
+    return memoryview(mapping)[:length]
+
+def same_host(sock):
+    """True if the other end of a connected socket is on this machine."""
+    try:
+        peer, local = sock.getpeername()[0], sock.getsockname()[0]
+        return peer == local or ipaddress.ip_address(peer).is_loopback
+    except (OSError, ValueError):
+        return False
 
 def recvall(sock, n):
-    data = b''
-    while len(data) < n:
-        packet = sock.recv(n - len(data))
-        if not packet:
+    """Receive exactly n bytes into a new bytearray, or None if the connection closes."""
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:], n - received)
+        if not count:
             return None
-        data += packet
+        received += count
     return data
 
+async def recvall_async(loop, sock, n):
+    """recvall on an asyncio loop: the bytes are received straight into the new bytearray."""
+    data = bytearray(n)
+    view = memoryview(data)
+    received = 0
+    while received < n:
+        try:
+            count = await loop.sock_recv_into(sock, view[received:])
+        except OSError:
+            return None
+        if not count:
+            return None
+        received += count
+    return data
+
+class Service_Lock:
+    """
+    Readers-writer lock of a service instance, see exclusive and shared: any number of
+    shared holders at once, or one exclusive holder. Waiting exclusive holders go
+    first, so a stream of shared calls can't hold them off. The exclusive holder can
+    call any other locked method of the service; a shared holder can only call shared
+    ones.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.shared = 0  # Shared holds by all threads
+        self.owner = None  # Thread holding it exclusively
+        self.depth = 0  # Nested holds of the owner
+        self.waiting = 0  # Threads waiting to hold it exclusively
+        self.local = threading.local()  # Shared holds by this thread
+
+    def acquire(self, exclusive):
+        me = threading.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.depth += 1
+                return
+            held = getattr(self.local, "shared", 0)
+            if exclusive:
+                if held:
+                    raise RuntimeError("An exclusive method can't be called from a shared one.")
+                self.waiting += 1
+                try:
+                    self.condition.wait_for(lambda: self.owner is None and self.shared == 0)
+                finally:
+                    self.waiting -= 1
+                self.owner = me
+                self.depth = 1
+            else:
+                if not held:  # A nested shared call mustn't wait behind an exclusive one
+                    self.condition.wait_for(lambda: self.owner is None and self.waiting == 0)
+                self.shared += 1
+                self.local.shared = held + 1
+
+    def release(self):
+        with self.condition:
+            if self.owner == threading.get_ident():
+                self.depth -= 1
+                if self.depth == 0:
+                    self.owner = None
+            else:
+                self.shared -= 1
+                self.local.shared -= 1
+            self.condition.notify_all()
+
+
+def _locked(method, exclusive):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        lock = self.__dict__.get("_service_lock")
+        if lock is None:
+            lock = self.__dict__.setdefault("_service_lock", Service_Lock())
+        lock.acquire(exclusive)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            lock.release()
+    return wrapper
+
+
+def exclusive(method):
+    """
+    Decorator for service methods that change state: the method runs alone, not
+    alongside any other exclusive or shared method of the same instance. The lock is
+    the instance's, so calls made in-process (e.g. on the instance Server.master
+    returns) are serialised with calls from Clients.
+    """
+    return _locked(method, True)
+
+
+def shared(method):
+    """Decorator for service methods that only read state: they run alongside each other but not alongside exclusive methods."""
+    return _locked(method, False)
+
+
 class Server:
+    """
+    Serves the methods of a service instance to Clients. listen() runs an asyncio event
+    loop: every request is handled in its own task and answered, with its id, as soon
+    as it is done, so one connection can have many calls in flight.
+
+    Service methods run in a thread pool, each call as soon as it arrives. A service
+    declares which of its methods must not run alongside each other with the exclusive
+    and shared decorators; the others run without any locking, so one client's slow
+    call doesn't hold up the other clients.
+    """
+    use_shared_memory = True  # Send large arrays to clients on this machine through shared memory
+    max_workers = 32  # Threads running service methods
+    max_in_flight = 32  # Requests handled at once per connection
+
     def __init__(self, service_class, max_que=5, *service_args, **service_kwargs):
         # Create an instance of the service class with the provided arguments
         self.service_instance = service_class(*service_args, **service_kwargs)
         self.service_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.service_socket.bind((self.service_instance.host, self.service_instance.port))
         self.service_socket.listen(max_que)
+        self.executor = futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        self.loop = None
+        self._loop_thread = None
         self.running = True
+        self._closed = threading.Event()  # Set once the service instance is closed
+        self._close_lock = threading.Lock()
         print(f"Server listening on port {self.service_instance.port}...")
         atexit.register(self.shutdown)
- 
+
     def listen(self):
-        while self.running:
+        """Serve until shutdown. Blocks, so it is usually run in a thread."""
+        try:
+            asyncio.run(self._serve())
+        finally:
+            self.service_socket.close()
+            self._close_service()
+
+    async def _serve(self):
+        self._stopped = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.clients = {}  # {handler task: client socket}
+        self.service_socket.setblocking(False)
+        accepting = asyncio.ensure_future(self._accept())
+        if self.running:
+            await self._stopped.wait()
+        accepting.cancel()
+        # Hang up on the clients and give their handlers a moment to finish
+        for client_socket in self.clients.values():
             try:
-                client_socket, addr = self.service_socket.accept()
-                threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
+                client_socket.shutdown(socket.SHUT_RDWR)
             except OSError:
-                break
- 
-    def handle_client(self, client_socket):
+                pass
+        if self.clients:
+            await asyncio.wait(list(self.clients), timeout=1)
+        # Wait for the calls still running while the loop is open for their results,
+        # blocking it is fine as there is nothing left to serve
+        self.executor.shutdown(wait=True)
+
+    def _close_service(self):
+        # Only once the service methods still running in the pool have returned
+        self.executor.shutdown(wait=True)
+        with self._close_lock:
+            if self._closed.is_set():
+                return
+            if hasattr(self.service_instance, "close"):
+                self.service_instance.close()
+            self._closed.set()
+
+    async def _accept(self):
+        while True:
+            client_socket, _ = await self.loop.sock_accept(self.service_socket)
+            client_socket.setblocking(False)
+            task = asyncio.ensure_future(self.handle_client(client_socket))
+            self.clients[task] = client_socket
+
+    async def handle_client(self, client_socket):
+        # The socket is read with sock_recv_into, so every part of a request is received
+        # straight into its own buffer, without a stream buffer in between
+        client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Response segments the client has not released yet
+        segments = {} if self.use_shared_memory and same_host(client_socket) else None
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        sending = asyncio.Lock()  # Keeps the parts of a response together
+        tasks = set()
         try:
             while True:
-                command = recv_msg(client_socket)
+                try:
+                    command = await read_msg(self.loop, client_socket)
+                except FileNotFoundError as e:
+                    print(f"Skipping request: {e}")  # The client has given up on it
+                    continue
                 if not command:
                     break
                 if command["method"] == "SHUTDOWN":
                     self.shutdown()
                     break
+                if command["method"] == "RELEASE":
+                    # The client has read these segments, no response
+                    release_segments(segments or {}, command["args"])
+                    continue
+                if command["method"] == "PING":
+                    # Health check of an idle connection, answered without running anything
+                    await self.send(client_socket, sending, encode_msg({"id": command.get("id"), "success": True, "result": None}))
+                    continue
 
-                method_name = command["method"]
-                args = command["args"]
-                kwargs = command["kwargs"]
-
-                try:
-                    method = getattr(self.service_instance, method_name)
-                    result = method(*args, **kwargs)
-                    response = {"success": True, "result": result}
-                except Exception as e:
-                    response = {"success": False, "error": str(e)}
-
-                send_msg(client_socket, response)
+                await in_flight.acquire()
+                task = asyncio.ensure_future(self.respond(command, client_socket, sending, segments))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+                task.add_done_callback(lambda _: in_flight.release())
         except Exception as e:
             print(f"Error in handle_client: {e}")
         finally:
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            if segments:
+                release_segments(segments)
             client_socket.close()
- 
+            self.clients.pop(asyncio.current_task(), None)
+
+    async def respond(self, command, client_socket, sending, segments):
+        method_name = command["method"]
+        try:
+            method = getattr(self.service_instance, method_name)
+            call = functools.partial(method, *command["args"], **command["kwargs"])
+            result = await self.loop.run_in_executor(self.executor, call)
+            response = {"id": command.get("id"), "success": True, "result": result}
+        except Exception as e:
+            response = {"id": command.get("id"), "success": False, "error": str(e)}
+
+        try:
+            parts = encode_msg(response, segments)
+        except Exception as e:  # e.g. a result that can't be pickled
+            parts = encode_msg({"id": command.get("id"), "success": False, "error": f"Could not send the result: {e}"})
+        await self.send(client_socket, sending, parts)
+
+    async def send(self, client_socket, sending, parts):
+        try:
+            async with sending:
+                for part in parts:
+                    await self.loop.sock_sendall(client_socket, part)
+        except OSError:
+            pass  # The client has gone, its segments are released with the connection
+
     def shutdown(self):
+        """
+        Stop serving, and close the service instance once the calls still running have
+        finished. Waits for that, unless called from the event loop (a SHUTDOWN request).
+        """
         if self.running:
             print("Shutting down server...")
             self.running = False
-            self.service_socket.close()
-            if hasattr(self.service_instance, "close"):
-                self.service_instance.close()
+            if self.loop is None:
+                self.service_socket.close()
+                self._close_service()
+            else:
+                try:
+                    self.loop.call_soon_threadsafe(self._stopped.set)
+                except RuntimeError:
+                    pass  # The loop has already finished
+                if threading.get_ident() != self._loop_thread:
+                    self._closed.wait()
                     
     @classmethod
     def master(cls, service_class, max_que, *service_args, **service_kwargs):
@@ -98,41 +447,190 @@ class Server:
         threading.Thread(target=server_instance.listen, daemon=True).start()
         return server_instance.service_instance  # Return the service instance
 
+
+class Connection:
+    """
+    A connection to a Server that can have any number of calls in flight. A thread
+    reads the responses and hands each to the call with the same id.
+    """
+    def __init__(self, host, port, shared_memory=True):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.shared_memory = shared_memory and same_host(self.sock)
+        self.pending = {}  # {id: Future of the response}
+        self.calls = 0  # Calls answered
+        self.last_response = time.time()
+        self.alive = True
+        self.send_lock = threading.Lock()
+        self._pings = itertools.count(-1, -1)  # Negative ids, so they can't clash with the calls
+        threading.Thread(target=self._read_responses, daemon=True).start()
+
+    def send(self, command, segments=None):
+        with self.send_lock:
+            send_msg(self.sock, command, segments)
+
+    def call(self, command):
+        """Send a command with an id and return a Future of the response."""
+        future = futures.Future()
+        self.pending[command["id"]] = future
+        if not self.alive:
+            self.pending.pop(command["id"], None)
+            raise ConnectionResetError("Connection closed by the server.")
+        segments = {} if self.shared_memory else None
+        try:
+            self.send(command, segments)
+        except OSError:
+            self.close()
+            raise
+        finally:
+            if segments:
+                # The server has read the request once it has responded
+                future.add_done_callback(lambda _: release_segments(segments))
+        return future
+
+    def check(self, timeout=1.0):
+        """
+        Health check: round trip a PING, which the server answers without running
+        anything. Returns False, and closes the connection, if no answer comes in time.
+        """
+        try:
+            future = self.call({"method": "PING", "args": (), "kwargs": {}, "id": next(self._pings)})
+            future.result(timeout)
+            return True
+        except (futures.TimeoutError, ConnectionError, OSError):
+            self.close()
+            return False
+
+    def _read_responses(self):
+        try:
+            while True:
+                shared_names = []
+                response = recv_msg(self.sock, shared_names)
+                if response is None:
+                    break
+                if shared_names:
+                    self.send({"method": "RELEASE", "args": shared_names, "kwargs": {}})
+                future = self.pending.pop(response.get("id"), None)
+                self.calls += 1
+                self.last_response = time.time()
+                if future is not None:
+                    try:
+                        future.set_result(response)
+                    except futures.InvalidStateError:
+                        pass  # Cancelled by a call which timed out
+        except OSError:
+            pass
+        finally:
+            self.close()
+
+    def close(self):
+        self.alive = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Wakes up the reading thread
+        except OSError:
+            pass
+        self.sock.close()
+        pending, self.pending = self.pending, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionResetError("Connection closed by the server."))
+
+
 class Client:
-    def __init__(self, service_class, max_que=5):
+    """
+    Proxy for a service running in a Server: client.method(*args) calls the method in
+    the server process. Up to pool_size connections are kept open and shared by all
+    threads using the client, each with any number of calls in flight, so polling
+    calls don't pay for a TCP handshake each and don't wait for each other.
+
+    A connection which has been idle for health_check_interval seconds is checked with
+    a PING before it is used again, so a server which has gone away is noticed before a
+    call is sent to it. A call is only retried on a new connection if it could not be
+    sent, never once the server may have run it.
+
+    With shared_memory, large arrays are exchanged with a server on the same machine
+    through shared memory segments instead of the socket. Each side owns the segments
+    it creates: the client releases those of a request once the response arrives, and
+    tells the server to release those of the response once it has read them.
+    """
+    health_check_interval = 5.0  # Seconds a connection can be idle before it is checked
+
+    def __init__(self, service_class, max_que=5, pool_size=2, timeout=None, shared_memory=True):
         self.service_class = service_class
         self.host = service_class.host
         self.port = service_class.port
         self.max_que = max_que
+        self.pool_size = pool_size
+        self.timeout = timeout  # Seconds to wait for a response, None waits forever
+        self.shared_memory = shared_memory
+        self._pool = []
+        self._pool_lock = threading.Lock()
+        self._ids = itertools.count(1)
 
     def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
         def method_proxy(*args, **kwargs):
-            retries = 3
-            for attempt in range(retries):
-                try:
-                    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                        client_socket.connect((self.host, self.port))
-                        command = {
-                            "method": name,
-                            "args": args,
-                            "kwargs": kwargs,
-                        }
-                        send_msg(client_socket, command)
-                        response = recv_msg(client_socket)
-
-                        if response["success"]:
-                            return response["result"]
-                        else:
-                            raise Exception(f"Error calling {name}: {response['error']}")
-                except ConnectionRefusedError:
-                    if attempt < retries - 1:
-                        print(f"Server is not running. Attempting to start... (Retry {attempt + 1}/{retries})")
-                        self._start_server()
-                        time.sleep(0.5)  # Allow the server time to start
-                    else:
-                        raise ConnectionRefusedError("Could not connect to the server after multiple retries.")
+            command = {
+                "method": name,
+                "args": args,
+                "kwargs": kwargs,
+            }
+            response = self._call(command)
+            if response["success"]:
+                return response["result"]
+            else:
+                raise Exception(f"Error calling {name}: {response['error']}")
         return method_proxy
 
+    def _call(self, command):
+        retries = 3
+        for attempt in range(retries):
+            try:
+                connection = self._connection()
+            except ConnectionRefusedError:
+                if attempt < retries - 1:
+                    print(f"Server is not running. Attempting to start... (Retry {attempt + 1}/{retries})")
+                    self._start_server()
+                    time.sleep(0.5)  # Allow the server time to start
+                    continue
+                raise ConnectionRefusedError("Could not connect to the server after multiple retries.")
+            command["id"] = next(self._ids)
+            try:
+                future = connection.call(command)
+            except (ConnectionError, OSError):
+                # The server only runs a command once it has all of it, so one that
+                # couldn't be sent can safely go on a fresh connection
+                if attempt < retries - 1:
+                    continue
+                raise
+            try:
+                return future.result(self.timeout)
+            except futures.TimeoutError:
+                connection.pending.pop(command["id"], None)
+                future.cancel()  # Releases the request's segments
+                raise
+
+    def _connection(self):
+        """The open connection with the fewest calls in flight, opening another if all are busy."""
+        with self._pool_lock:
+            self._pool = [connection for connection in self._pool if connection.alive]
+            for connection in [connection for connection in self._pool if not connection.pending]:
+                if time.time() - connection.last_response < self.health_check_interval or connection.check():
+                    return connection
+                self._pool.remove(connection)
+            if len(self._pool) < self.pool_size:
+                self._pool.append(Connection(self.host, self.port, self.shared_memory))
+                return self._pool[-1]
+            return min(self._pool, key=lambda connection: len(connection.pending))
+
+    def close(self):
+        """Close the connections."""
+        with self._pool_lock:
+            for connection in self._pool:
+                connection.close()
+            self._pool = []
+
     def _start_server(self):
         server = Server(self.service_class, self.max_que)
         threading.Thread(target=server.listen, daemon=True).start()
@@ -140,10 +638,11 @@ class Client:
 
     def shutdown(self):
         """Send a SHUTDOWN command to the server."""
+        self.close()
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
                 client_socket.connect((self.host, self.port))
                 command = {"method": "SHUTDOWN", "args": [], "kwargs": {}}
-                client_socket.sendall(pickle.dumps(command))
+                send_msg(client_socket, command)  # Use the length-prefixed protocol!
         except ConnectionRefusedError:
-            print("Server is not running.")
\ No newline at end of file
+            print("Server is not running.")
@@ -19,16 +19,16 @@ import inspect
 import csv
 from datetime import datetime
 
-def file_name(directory=r"C:\Users\probe\OneDrive - University of Sussex\Desktop\Data", base_name=None):
+def file_name(directory=r"C:\Users\probe\OneDrive - University of Sussex\Desktop\Data", base_name=None, extension=".csv"):
     import os, inspect
     from datetime import datetime
     script_name = os.path.splitext(os.path.basename(inspect.stack()[-1].filename))[0]
     date_time = datetime.now().strftime("%Y%m%d_%H%M%S")
-    filename = f"{script_name}_{date_time}.csv"
+    filename = f"{script_name}_{date_time}{extension}"
     if base_name is None:
-        filename = f"{script_name}_{date_time}.csv"
+        filename = f"{script_name}_{date_time}{extension}"
     else:
-        filename = f"{script_name}_{base_name}_{date_time}.csv"
+        filename = f"{script_name}_{base_name}_{date_time}{extension}"
         
     if directory:
         os.makedirs(directory, exist_ok=True)
@@ -457,6 +457,15 @@ class Pulse_Sequencer:
         self._new_pulse_lengths = []
         self._new_end_pulse = None
 
+    def gate_windows(self, pin=None):
+        """
+        Number of separate HIGH windows of a pin (default the PMT gate) in one cycle of
+        the current sequence, counting a window that wraps round the cycle once.
+        """
+        pin = self.pmt_gate_pin if pin is None else pin
+        levels = [pulse[pin] == '1' for pulse in self._pulses]
+        return sum(1 for i, high in enumerate(levels) if high and not levels[i - 1]) or (1 if levels and levels[0] else 0)
+
     def write_optional_sequence(self):
         """
         Writes an optional pulse to the pulse sequencer.
@@ -1039,10 +1048,18 @@ class Experiment_Builder_Singletone:
         self.pulse_sequencer.write_sequence()
 
 class Experiment_Runner:
-    def __init__(self, dds_dictionary, pulse_sequencer, timeout=10, pmt_threshold=None, sp_threshold=None, expected_fluorescence=None, pulse_expected_fluorescence=0, catch_timeout=20, load_timeout=100, trigger_mode="normal", cavity_lock=False):
+    def __init__(self, dds_dictionary, pulse_sequencer, timeout=10, pmt_threshold=None, sp_threshold=None, expected_fluorescence=None, pulse_expected_fluorescence=0, catch_timeout=20, load_timeout=100, trigger_mode="normal", cavity_lock=False, pmt_gates=None, time_diff_dir=None):
+        """
+        pmt_gates: list of (name, counter, gate_terminal, pulse_sequencer_pin) for gated PMT
+        counting during experiments, e.g. [("gated", "Dev1/ctr2", "/Dev1/PFI1", 1)] with PFI1
+        wired to the pmt_gate_pin. The PMT_Reader then reports the counts in every gate
+        window of every run, see get_section_counts.
+        time_diff_dir: keep the accumulated time diffs in memory-mapped files in this
+        directory rather than in RAM, see QuTau_Reader.
+        """
         # Initialize QuTau_Reader with channels
         self.pulse_sequencer = pulse_sequencer
-        self.qutau_reader = Server.master(QuTau_Reader, max_que=5)
+        self.qutau_reader = Server.master(QuTau_Reader, 5, time_diff_dir=time_diff_dir)
         # Initialize clients for PMT_Reader and RedlabsDAC
         self.pmt_reader_client = Client(PMT_Reader)
         self.redlabs_dac_client = Client(Redlabs_DAC)
@@ -1054,6 +1071,10 @@ class Experiment_Runner:
         self.pulse_expected_fluorescence = pulse_expected_fluorescence
 
         self.pmt_counts = 0
+        self.pmt_gates = pmt_gates or []
+        self.section_counts = {}  # {gate name: (runs, windows) counts of the last iteration}
+        self.section_totals = {}  # {gate name: counts per window summed over saved iterations}
+        self.section_runs = {}  # {gate name: runs in section_totals}
         
         #Experiment Settings that you may sometimes want to change
         self.experiment_trap_depth = 1.0
@@ -1074,6 +1095,8 @@ class Experiment_Runner:
         self.running = False  # Flag for running status
         self.loading = False  # Flag for loading status
         self.single_ion = False # Flag for single ion detection
+        self.raw_file_name = None
+        self.file_name = None  # The raw timestamp file being recorded
 
         # Timeouts
         self.timeout = timeout  # Timeout for the experiment
@@ -1320,13 +1343,7 @@ class Experiment_Runner:
 
     def start_experiment(self, N=None, raw_file_name=None):
         self.N = N  # Remember N for resuming
-        if raw_file_name:
-            self.file_name = file_name(
-                    directory=r"C:\Users\probe\OneDrive - University of Sussex\Desktop\Raw_Data",
-                    base_name=f"{raw_file_name}"
-                )
-        else:
-            self.file_name = None
+        self.raw_file_name = raw_file_name
 
         self.N_Valid_Pulses = 0  # This variable keeps track of the true number of cycles run, i.e., the number of pulse sequences run whilst the ion is nicely trapped
         self.N_Total_Pulses = 0
@@ -1351,24 +1368,51 @@ class Experiment_Runner:
         self.clear_channels()
         self.iteration = 0
         self.qutau_reader.enter_experiment_mode()
-        self.qutau_reader.qutau.getLastTimestamps(True) # clear buffer
-        self.calibrate_run_time()  # Calibrate run time on the first run
-        self.process_data()
-        laser_status, ion_status, cavity_status = self.run_diagnostics()
-        # Continue the experiment if diagnostics passed
-        self.running = True
-        if not cavity_status or not laser_status:
-            print("Diagnostics failed. Discarding data and pausing experiment.")
-            print("Laser status:", laser_status)
-            print("Cavity status:", cavity_status)
-            self.discard_data()
-            self.running = False
-            self.pause_experiment()
-        else:
-            self.save_data()
-            self.iteration += 1  # Increment iteration after successful run
-            read_pulse_sequencer_results("COM5")
-            self.experiment_loop()
+        self.qutau_reader.clear_data() # clear buffer
+        # Pausing and resuming run inside this call, so however the experiment ends
+        # (finished, timed out, interrupted or failed) the recording and gates stop here
+        try:
+            self.start_gated_counting()
+            self.start_recording()
+            self.calibrate_run_time()  # Calibrate run time on the first run
+            self.process_data()
+            laser_status, ion_status, cavity_status = self.run_diagnostics()
+            # Continue the experiment if diagnostics passed
+            self.running = True
+            if not cavity_status or not laser_status:
+                print("Diagnostics failed. Discarding data and pausing experiment.")
+                print("Laser status:", laser_status)
+                print("Cavity status:", cavity_status)
+                self.discard_data()
+                self.running = False
+                self.pause_experiment()
+            else:
+                self.save_data()
+                self.iteration += 1  # Increment iteration after successful run
+                read_pulse_sequencer_results("COM5")
+                self.experiment_loop()
+        finally:
+            self.stop_recording()
+            if self.pmt_gates:
+                self.pmt_reader_client.stop_gated_counting()
+
+    def start_recording(self):
+        """Record the raw timestamps to a new file, if a raw_file_name was given to start_experiment."""
+        if not self.raw_file_name:
+            return
+        # Raw timestamps are written by the QuTau library in its binary format,
+        # load them back with QuTau.loadTimestampFile
+        self.file_name = file_name(
+                directory=r"C:\Users\probe\OneDrive - University of Sussex\Desktop\Raw_Data",
+                base_name=f"{self.raw_file_name}",
+                extension=".bin"
+            )
+        self.qutau_reader.start_recording(self.file_name)
+
+    def stop_recording(self):
+        if self.file_name:
+            self.qutau_reader.stop_recording()
+            self.file_name = None
 
     def calibrate_run_time(self):
         print(f"Calibrating run time for input to go HIGH on {self.channel_name} for up to {self.timeout} seconds...")
@@ -1395,6 +1439,7 @@ class Experiment_Runner:
             while True:
                 if self.N is not None and self.iteration >= self.N:  # Stop after N runs
                     print(f"Finished running {self.N} iterations of {self.pulse_sequencer.N_Cycles} Cycles.")
+                    self.stop_recording()
                     self.qutau_reader.exit_experiment_mode()
                     break
 
@@ -1460,11 +1505,8 @@ class Experiment_Runner:
     def process_data(self):
         """Handle data processing."""
         self.qutau_reader.get_data()
-        start_time = time.time()
-        if self.file_name:
-            save_array_data(self.file_name, channels = self.qutau_reader.tchannel, timestamps=self.qutau_reader.tstamp)
-        end_time = time.time()
-        print(f"Latency for saving data: {end_time - start_time:.6f} seconds")
+        if self.pmt_gates:
+            self.section_counts = self.pmt_reader_client.get_gated_counts()
 
         # here we filter data to remove runs where the ion was not trapped.
 
@@ -1501,6 +1543,7 @@ class Experiment_Runner:
 
     def pause_experiment(self):
         """Pause the experiment and allow manual resume."""
+        self.stop_recording()  # Resuming continues in a new file
         self.qutau_reader.exit_experiment_mode()
         print("Experiment paused. Press 'P' to resume.")
         while not self.running:  # Wait for running to be set to True
@@ -1528,6 +1571,7 @@ class Experiment_Runner:
 
         for dds in self.dds_dictionary.values():
             dds.exit_trapping_mode()
+        self.start_recording()
         self.experiment_loop()
      
     def check_ion(self):
@@ -1599,6 +1643,36 @@ class Experiment_Runner:
 
     def save_data(self):
         self.qutau_reader.save_recent_time_diffs()
+        for name, counts in self.section_counts.items():
+            if len(counts):
+                self.section_totals[name] = self.section_totals.get(name, 0) + counts.sum(axis=0)
+                self.section_runs[name] = self.section_runs.get(name, 0) + len(counts)
+
+    def start_gated_counting(self):
+        """Start counting the PMT in every pmt_gates window, with the windows per run taken from the sequence."""
+        self.section_counts = {}
+        self.section_totals = {}
+        self.section_runs = {}
+        if not self.pmt_gates:
+            return
+        gates = [(name, counter, terminal, self.pulse_sequencer.gate_windows(pin))
+                 for name, counter, terminal, pin in self.pmt_gates]
+        # The gate is held open by the end pulse between iterations, so the first window
+        # of each iteration also contains the time spent waiting for the next start
+        self.pmt_reader_client.start_gated_counting(gates)
+        self.pmt_reader_client.clear_gated_counts()
+
+    def get_section_counts(self, name, last=False):
+        """
+        Mean PMT counts per run in each window of the named gate, over the saved
+        iterations, or over the last iteration only if last is True.
+        """
+        if last:
+            counts = self.section_counts.get(name)
+            return counts.mean(axis=0) if counts is not None and len(counts) else None
+        if not self.section_runs.get(name):
+            return None
+        return self.section_totals[name] / self.section_runs[name]
 
     def discard_data(self):
         self.qutau_reader.discard_recent_time_diffs()
@@ -1606,7 +1680,8 @@ class Experiment_Runner:
     def clear_channels(self):
         self.qutau_reader.clear_channels()
 
-    def get_time_diffs(self, mode, lower_cutoff=None, upper_cutoff=None):
+    def get_time_diffs(self, mode, lower_cutoff=None, upper_cutoff=None, start=0, stop=None):
+        # start/stop select a slice of each channel's stored diffs, so only that part is read
         # Find all channels with the specified mode
         channels = [ch for ch in self.qutau_reader.channels if ch.mode == mode]
         if not channels:
@@ -1617,7 +1692,7 @@ class Experiment_Runner:
 
         # Collect time differences for each channel
         for channel in channels:
-            time_diffs_us = np.array(channel.time_diffs) * 1E6  # Convert to NumPy array and multiply by 1E6
+            time_diffs_us = channel.time_diffs.view(start, stop) * 1E6  # Convert to microseconds
             #print(np.sort(time_diffs_us))
             # Apply lower cutoff if specified
             if lower_cutoff is not None:
@@ -1649,7 +1724,7 @@ class Experiment_Runner:
 
         # Plot histograms for each channel
         for channel in channels:
-            time_diffs_us = np.array(channel.time_diffs) * 1E6  # Convert to NumPy array and multiply by 1E6
+            time_diffs_us = channel.time_diffs.view() * 1E6  # Convert to microseconds
             print(np.sort(time_diffs_us))
             # Apply lower cutoff if specified
             if lower_cutoff is not None:
@@ -1690,7 +1765,7 @@ class Experiment_Runner:
         # Get counts for each channel
         for channel in channels:
             print(channel.name)
-            time_diffs_us = np.array(channel.time_diffs) * 1E6  # Convert to NumPy array and multiply by 1E6
+            time_diffs_us = channel.time_diffs.view() * 1E6  # Convert to microseconds
             
             # Apply lower cutoff if specified
             if lower_cutoff is not None:
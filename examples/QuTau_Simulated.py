@@ -0,0 +1,24 @@
+import time
+from adriq.QuTau_Simulator import QuTau_Simulator
+from adriq.QuTau_Acquisition import QuTau_Acquisition
+
+# Run the acquisition stack against a simulated QuTau, e.g. on a Linux machine.
+# realtime=False generates `step` seconds of events per drain, as fast as possible.
+qutau = QuTau_Simulator(rates={0: 2e3, 6: 20e3}, periods={5: 1 / 1e6, 7: 50e-6}, realtime=False, step=0.05, seed=0)
+qutau.enableChannels([0, 5, 6, 7])
+
+acquisition = QuTau_Acquisition(qutau, interval=0.0)
+subscriber = acquisition.subscribe("benchmark")
+acquisition.start()
+
+start_time = time.time()
+events = 0
+while time.time() - start_time < 5:
+    tstamp, tchannel = subscriber.read()
+    events += len(tstamp)
+    time.sleep(0.05)
+acquisition.stop()
+
+elapsed_time = time.time() - start_time
+print(f"Processed {events} events in {elapsed_time:.2f} s ({events / elapsed_time:.3g} events/s)")
+print(acquisition.get_status())
@@ -0,0 +1,178 @@
+import time
+import numpy as np
+import pytest
+
+from adriq.QuTau import QuTau_Backend
+from adriq.QuTau_Simulator import QuTau_Simulator
+from adriq.QuTau_Acquisition import QuTau_Acquisition, Multi_Device_Acquisition, Adaptive_Drain_Controller
+
+
+@pytest.fixture
+def simulator():
+    # 1 kHz on channel 0 and 400 Hz on channel 3, advancing 0.1 s per read
+    return QuTau_Simulator(rates={}, periods={0: 1e-3, 3: 2.5e-3}, realtime=False, step=0.1, seed=1)
+
+
+def test_backend_must_implement_the_interface():
+    class Incomplete(QuTau_Backend):
+        def getTimebase(self):
+            return 81e-12
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_backend_settings_are_per_instance(simulator):
+    other = QuTau_Simulator(rates={}, seed=2)
+    simulator.setCoincidenceWindow(100)
+    assert simulator.getSettings() == {"coincWindow": 100}
+    assert other.getSettings() == {}
+
+
+def test_drain_moves_events_into_the_ring_in_order(simulator):
+    acquisition = QuTau_Acquisition(simulator)
+    acquisition.enable_channels([0, 3])
+    acquisition.subscribe("counting")
+    for _ in range(3):
+        acquisition.drain()
+    tstamp, tchannel = acquisition.read("counting")
+    assert np.all(np.diff(tstamp) >= 0)
+    assert np.count_nonzero(tchannel == 0) == pytest.approx(300, abs=2)
+    assert np.count_nonzero(tchannel == 3) == pytest.approx(120, abs=2)
+    assert acquisition.read("counting")[0].size == 0
+
+
+def test_subscribers_read_independently(simulator):
+    acquisition = QuTau_Acquisition(simulator)
+    acquisition.enable_channels([0])
+    acquisition.subscribe("early")
+    acquisition.drain()
+    acquisition.subscribe("late")
+    acquisition.drain()
+    early, _ = acquisition.read("early")
+    late, _ = acquisition.read("late")
+    assert len(early) == pytest.approx(2 * len(late), abs=2)
+    np.testing.assert_array_equal(early[-len(late):], late)
+    acquisition.skip("early")
+    acquisition.drain()
+    assert len(acquisition.read("early")[0]) == len(acquisition.read("late")[0])
+
+
+def test_only_enabled_channels_and_delays_are_applied(simulator):
+    acquisition = QuTau_Acquisition(simulator)
+    acquisition.enable_channels([3])
+    acquisition.configure_channels(delays={3: 1000})
+    acquisition.subscribe("a")
+    acquisition.drain()
+    tstamp, tchannel = acquisition.read("a")
+    assert set(tchannel.tolist()) == {3}
+    undelayed = QuTau_Simulator(rates={}, periods={3: 2.5e-3}, realtime=False, step=0.1)
+    undelayed.enableChannels([3])
+    reference, _, _ = undelayed.getLastTimestamps(True)
+    np.testing.assert_array_equal(tstamp, reference + 1000)
+
+
+def test_device_data_loss_is_reported(simulator):
+    simulator.setBufferSize(50)
+    acquisition = QuTau_Acquisition(simulator)
+    acquisition.enable_channels([0])
+    simulator.getLastTimestamps(False)  # Overflows the device buffer
+    acquisition.drain()
+    assert acquisition.data_lost == 1
+    assert acquisition.get_status()["data_lost"] == 1
+
+
+def test_hardware_counters(simulator):
+    acquisition = QuTau_Acquisition(simulator)
+    acquisition.enable_channels([0, 3])
+    acquisition.set_exposure_time(100)
+    counters, updates = acquisition.read_counters()
+    assert updates == 1
+    assert (counters[0], counters[3]) == (100, 40)
+
+
+def test_background_acquisition(simulator):
+    acquisition = QuTau_Acquisition(simulator, interval=0.01)
+    acquisition.enable_channels([0])
+    acquisition.subscribe("a")
+    acquisition.start()
+    time.sleep(0.2)
+    acquisition.stop()
+    assert acquisition.drains > 0
+    assert len(acquisition.read("a")[0]) > 0
+
+
+def test_adaptive_buffer_survives_a_burst_after_idling():
+    controller = Adaptive_Drain_Controller()
+    interval, buffer_size = 0.05, 1000000
+    for _ in range(20):  # Idle, a stray event per drain
+        interval, buffer_size = controller.update(1, interval, False, buffer_size, interval)
+    assert interval == controller.max_interval
+    assert buffer_size == controller.min_buffer
+    # 20 kHz PMT and 20 kHz trigger enabled, the next drain is a whole max_interval away
+    simulator = QuTau_Simulator(rates={6: 20e3, 7: 20e3}, realtime=False, step=interval, seed=1)
+    simulator.setBufferSize(buffer_size)
+    acquisition = QuTau_Acquisition(simulator, adaptive=controller)
+    acquisition.enable_channels([6, 7])
+    assert acquisition.drain() > 15000
+    assert acquisition.data_lost == 0
+
+
+class Scripted_Devices:
+    """Backend handing out fixed batches of events per device, for the merge."""
+    CHANNELS = 8
+
+    def __init__(self, batches):
+        self.batches = {dev: [(np.array(t, dtype=np.int64), np.array(c, dtype=np.int8)) for t, c in device]
+                        for dev, device in batches.items()}
+        self.address = 0
+
+    def addressDevice(self, dev):
+        self.address = dev
+        return 0
+
+    def getDataLost(self):
+        return 0
+
+    def getLastTimestamps(self, reset):
+        if self.batches[self.address]:
+            tstamp, tchannel = self.batches[self.address].pop(0)
+        else:
+            tstamp, tchannel = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8)
+        return tstamp, tchannel, len(tstamp)
+
+
+def test_multi_device_merge_is_time_ordered():
+    devices = Scripted_Devices({
+        0: [([0, 10, 20, 30], [1, 1, 1, 1])],
+        1: [([5, 15, 25], [2, 2, 2]), ([35], [2])],
+    })
+    acquisition = Multi_Device_Acquisition(devices, [0, 1], offsets={1: 100}, flush_timeout=60)
+    acquisition.subscribe("a")
+    acquisition.drain_device(0)
+    assert acquisition.read("a")[0].size == 0  # Device 1 hasn't delivered yet
+    acquisition.drain_device(1)
+    tstamp, tchannel = acquisition.read("a")
+    assert tstamp.tolist() == [0, 10, 20, 30]  # Device 1 is offset to 105...
+    acquisition.drain_device(0)
+    acquisition.drain_device(1)
+    acquisition.merge(flush=True)
+    tstamp, tchannel = acquisition.read("a")
+    assert tstamp.tolist() == [105, 115, 125, 135]
+    assert set(tchannel.tolist()) == {10}  # Channel 2 of the second device
+
+
+def test_multi_device_merge_interleaves_and_releases_silent_devices():
+    devices = Scripted_Devices({
+        0: [([0, 10, 20, 30], [0, 0, 0, 0])],
+        1: [([5, 15, 25], [0, 0, 0])],
+    })
+    acquisition = Multi_Device_Acquisition(devices, [0, 1], flush_timeout=60)
+    acquisition.subscribe("a")
+    acquisition.drain()
+    tstamp, tchannel = acquisition.read("a")
+    assert tstamp.tolist() == [0, 5, 10, 15, 20, 25]
+    assert tchannel.tolist() == [0, 8, 0, 8, 0, 8]
+    acquisition.flush_timeout = 0  # Both now count as silent, nothing holds the rest back
+    acquisition.merge()
+    assert acquisition.read("a")[0].tolist() == [30]
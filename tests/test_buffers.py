@@ -0,0 +1,199 @@
+import numpy as np
+import pytest
+
+from adriq.Buffers import (Timestamp_Ring_Buffer, Count_History, Count_Rollups, Time_Diff_Store,
+                           Mapped_Time_Diff_Store, open_time_diffs)
+
+
+def events(start, stop):
+    tstamp = np.arange(start, stop, dtype=np.int64)
+    return tstamp, (tstamp % 8).astype(np.int8)
+
+
+# Timestamp_Ring_Buffer ---------------------------------------------------
+
+def test_ring_reads_across_the_wrap():
+    ring = Timestamp_Ring_Buffer(8)
+    subscriber = ring.subscribe()
+    ring.write(*events(0, 6))
+    assert subscriber.read()[0].tolist() == list(range(6))
+    ring.write(*events(6, 12))
+    tstamp, tchannel = subscriber.read()
+    assert tstamp.tolist() == list(range(6, 12))
+    assert tchannel.tolist() == [t % 8 for t in range(6, 12)]
+    assert subscriber.lost == 0
+
+
+def test_ring_counts_overwritten_events_as_lost():
+    ring = Timestamp_Ring_Buffer(8)
+    subscriber = ring.subscribe()
+    ring.write(*events(0, 5))
+    ring.write(*events(5, 20))  # Laps the subscriber
+    tstamp, _ = subscriber.read()
+    assert tstamp.tolist() == list(range(12, 20))
+    assert subscriber.lost == 12
+    assert subscriber.lag() == 0
+
+
+def test_ring_write_larger_than_capacity_keeps_the_newest():
+    ring = Timestamp_Ring_Buffer(4)
+    ring.write(*events(0, 10))
+    assert ring.head == 10
+    tstamp, _, cursor, lost = ring.read(0)
+    assert tstamp.tolist() == [6, 7, 8, 9]
+    assert (cursor, lost) == (10, 6)
+
+
+def test_ring_subscribers_have_their_own_cursors():
+    ring = Timestamp_Ring_Buffer(16)
+    early = ring.subscribe()
+    ring.write(*events(0, 4))
+    late = ring.subscribe()
+    ring.write(*events(4, 6))
+    assert early.lag() == 6 and late.lag() == 2
+    assert late.read()[0].tolist() == [4, 5]
+    early.skip()
+    assert early.read()[0].tolist() == []
+
+
+# Count_History -------------------------------------------------------------
+
+def test_history_get_since_returns_only_new_samples():
+    history = Count_History(["a", "b"], 10)
+    for i in range(3):
+        history.append(float(i), [i, 10 * i])
+    times, values, cursor = history.get_since(0)
+    assert times.tolist() == [0, 1, 2] and values["b"].tolist() == [0, 10, 20]
+    history.append(3.0, [3, 30])
+    times, values, cursor = history.get_since(cursor)
+    assert times.tolist() == [3] and cursor == 4
+    assert history.get_since(cursor)[0].tolist() == []
+
+
+def test_history_skips_overwritten_samples_and_restarts_after_clear():
+    history = Count_History(["a"], 4)
+    history.extend(np.arange(10.0), np.arange(10.0)[np.newaxis])
+    times, _, cursor = history.get_since(2)
+    assert times.tolist() == [6, 7, 8, 9]
+    history.clear()
+    history.append(10.0, [10])
+    assert history.get_since(cursor)[0].tolist() == [10]
+    assert len(history) == 1
+    assert history.latest() == {"a": 10}
+
+
+def test_history_resize_keeps_the_newest_samples():
+    history = Count_History(["a"], 5)
+    for i in range(5):
+        history.append(float(i), [i])
+    history.resize(3)
+    assert history.get()[0].tolist() == [2, 3, 4]
+    history.resize(6)
+    history.append(5.0, [5])
+    assert history.get()[1]["a"].tolist() == [2, 3, 4, 5]
+
+
+# Count_Rollups -------------------------------------------------------------
+
+@pytest.fixture
+def rollups():
+    rollups = Count_Rollups(Count_History(["a"], 100), rate=10)
+    for k in range(3000):  # 300 s at 10 Hz
+        rollups.append(1000 + k / 10, [k])
+    return rollups
+
+
+def test_rollups_raw_level_covers_the_last_minute(rollups):
+    resolution, times, low, mean, high = rollups.query(55, width=1000, now=1300)
+    assert resolution == 0
+    assert len(times) == 550
+    assert low["a"] is mean["a"] is high["a"]
+
+
+def test_rollups_use_the_finest_tier_that_covers_the_span(rollups):
+    resolution, times, low, mean, high = rollups.query(200, width=1000, now=1300)
+    assert resolution == 1
+    assert np.all(low["a"] <= mean["a"]) and np.all(mean["a"] <= high["a"])
+    # Too many 1 s buckets for the width, so the 10 s tier is used
+    assert rollups.query(200, width=50, now=1300)[0] == 10
+
+
+def test_rollups_beyond_the_session_use_the_finest_level_with_all_of_it(rollups):
+    resolution, times, *_ = rollups.query(10 ** 6, width=1000, now=1300)
+    assert resolution == 1
+    assert times[0] == 1000 and len(times) == 299  # The last bucket is still open
+    # Only the 1 min buckets stay within 2 * width points
+    assert rollups.query(10 ** 6, width=10, now=1300)[0] == 60
+
+
+def test_rollups_of_a_short_session_return_the_raw_samples():
+    rollups = Count_Rollups(Count_History(["a"], 100), rate=10)
+    for k in range(300):  # 30 s at 10 Hz
+        rollups.append(1000.5 + k / 10, [k])
+    resolution, times, low, mean, high = rollups.query(3600, now=1030.5)
+    assert resolution == 0
+    assert len(times) == 300
+
+
+def test_rollups_raw_buffer_follows_the_rate():
+    rollups = Count_Rollups(Count_History(["a"], 10), rate=10, raw_span=60)
+    assert rollups.raw.capacity >= 600
+    rollups.set_rate(20)
+    assert rollups.raw.capacity >= 1200
+
+
+# Time diff stores --------------------------------------------------------
+
+def test_time_diff_store_grows_and_summarises():
+    store = Time_Diff_Store(capacity=2, outlier_threshold=5)
+    assert store.append([1.0, 2.0, 3.0]) == 0
+    assert store.append([6.0, 8.0]) == 2
+    assert np.array(store).tolist() == [1, 2, 3, 6, 8]
+    summary = store.summary()
+    assert summary["count"] == 5 and summary["outliers"] == 2
+    assert summary["mean"] == pytest.approx(4.0) and summary["max"] == 8
+    store.clear()
+    assert len(store) == 0 and np.isnan(store.summary()["mean"])
+
+
+def test_mapped_store_grows_in_segments_without_invalidating_views(tmp_path):
+    path = str(tmp_path / "ch.tdiff")
+    store = Mapped_Time_Diff_Store(path, segment_size=4)
+    store.append(np.arange(3.0))
+    early = store.view()
+    store.append(np.arange(3.0, 11.0))
+    assert early.tolist() == [0, 1, 2]
+    assert store.view().tolist() == list(range(11))
+    assert store.view(2, 6).tolist() == [2, 3, 4, 5]
+    assert store.view(-2).tolist() == [9, 10]
+    assert len(store.segments) == 3
+    store.close()
+
+
+def test_mapped_store_readers_see_only_flushed_values(tmp_path):
+    path = str(tmp_path / "ch.tdiff")
+    store = Mapped_Time_Diff_Store(path, segment_size=4, flush_interval=3600)
+    store.append([1.0, 2.0])
+    assert len(open_time_diffs(path)) == 0
+    store.flush()
+    reader = open_time_diffs(path)
+    store.append(np.arange(10.0))
+    store.flush()
+    assert reader.tolist() == [1, 2]
+    assert open_time_diffs(path, 1, 4).tolist() == [2, 0, 1]
+    store.close()
+
+
+def test_mapped_store_reopens_and_appends(tmp_path):
+    path = str(tmp_path / "ch.tdiff")
+    store = Mapped_Time_Diff_Store(path, segment_size=4, outlier_threshold=5)
+    store.append(np.arange(6.0))
+    store.close()
+    store = Mapped_Time_Diff_Store(path, outlier_threshold=5)
+    assert store.segment_size == 4
+    assert len(store) == 6 and store.summary()["max"] == 5
+    store.append([7.0])
+    assert store.view(-2).tolist() == [5, 7]
+    assert store.outliers == 1
+    store.close()
+    assert open_time_diffs(path).tolist() == [0, 1, 2, 3, 4, 5, 7]
@@ -0,0 +1,174 @@
+import time
+import threading
+import numpy as np
+import pytest
+
+from adriq.QuTau_Simulator import QuTau_Simulator
+from adriq.Buffers import open_time_diffs
+
+Counters = pytest.importorskip("adriq.Counters")  # Needs nidaqmx, PyQt5 and the built tdc_functions
+
+CHANNELS = """
+[PMT]
+number = 6
+name = PMT
+mode = signal-f
+
+[Trap]
+number = 5
+name = Trap
+mode = trap
+
+[Sync]
+number = 7
+name = Sync
+mode = trigger
+"""
+
+
+def make_reader(tmp_path, **kwargs):
+    ini_file = tmp_path / "qutau_config.cfg"
+    ini_file.write_text(CHANNELS)
+    simulator = QuTau_Simulator(rates={6: 20e3}, periods={5: 1e-5, 7: 1e-3}, seed=1)
+    return Counters.QuTau_Reader(str(ini_file), backend=simulator, **kwargs)
+
+
+@pytest.fixture
+def reader(tmp_path):
+    reader = make_reader(tmp_path)
+    yield reader
+    reader.close()
+
+
+def test_pair_delays_finds_every_pair_within_the_window():
+    t1 = np.array([0, 100, 200])
+    t2 = np.array([5, 95, 150, 400])
+    delays = Counters.pair_delays(t1, t2, 60)
+    assert sorted(delays.tolist()) == sorted([5, 95 - 100, 150 - 100, 150 - 200])
+
+
+def test_pair_delays_leaves_out_self_pairs_of_an_autocorrelation():
+    t = np.array([0, 10, 100])
+    assert sorted(Counters.pair_delays(t, t, 20).tolist()) == [-10, 0, 0, 0, 10]
+    assert sorted(Counters.pair_delays(t, t, 20, same_events=True).tolist()) == [-10, 10]
+
+
+def test_histograms_must_be_started_first(reader):
+    with pytest.raises(RuntimeError, match="start_lifetime_histogram"):
+        reader.get_lifetime_histogram()
+    with pytest.raises(RuntimeError, match="start_hbt_histogram"):
+        reader.get_hbt_histogram()
+
+
+def test_software_hbt_histogram(reader):
+    assert reader.start_hbt_histogram(6, 6, 1e-6, 20) is False  # No HBT feature on the simulator
+    time.sleep(0.1)
+    delays, counts = reader.get_hbt_histogram(reset=True)
+    assert len(delays) == len(counts) == 20
+    assert counts.sum() > 0
+    assert counts[10] < 2 * np.median(counts)  # No self-pairs at zero delay
+
+
+def within(timeout, func, *args):
+    """Call func in a thread, failing instead of hanging if it doesn't return in time."""
+    result = []
+    thread = threading.Thread(target=lambda: result.append(func(*args)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{func.__name__} did not return within {timeout} s"
+    return result[0]
+
+
+def test_rf_correlation_job_can_be_polled_and_cancelled(reader):
+    job_id = within(5, reader.start_rf_correlation, 1000, 20, 50)
+    assert job_id is not None
+    assert within(5, reader.start_rf_correlation, 10, 20, 50) is None  # One at a time
+    job = within(5, reader.get_job, job_id)
+    assert job["status"] == "running" and job["no_runs"] == 1000
+    assert within(5, reader.cancel_job, job_id)
+    deadline = time.time() + 5
+    while within(5, reader.get_job, job_id)["status"] == "running":
+        assert time.time() < deadline
+        time.sleep(0.05)
+    job = reader.get_job(job_id)
+    assert job["status"] == "cancelled" and job["runs"] < 1000
+    assert reader.get_job(job_id + 1) is None
+    assert reader.current_mode == "idle"
+
+
+def test_rf_correlation_blocking(reader):
+    assert len(within(10, reader.RF_correlation, 3, 20, 50)) == 3
+    assert reader.jobs[max(reader.jobs)]["status"] == "done"
+
+
+def test_time_diff_files_follow_the_experiment_channel_modes(tmp_path):
+    directory = tmp_path / "time_diffs"
+    reader = make_reader(tmp_path, time_diff_dir=str(directory))
+    try:
+        for run in range(2):
+            reader.clear_channels()  # As Experiment_Runner.start_experiment does
+            reader.enter_experiment_mode()
+            for ch in reader.channels:
+                if ch.mode in ["signal-f", "signal-sp"]:
+                    ch.recent_time_diffs = np.full(3, 1e-6 * (run + 1))
+            reader.save_recent_time_diffs()
+            reader.discard_recent_time_diffs()
+            reader.flush_time_diffs()
+            reader.exit_experiment_mode()
+        files = sorted(path.name for path in directory.iterdir() if path.suffix == ".tdiff")
+        names = ["PMT", "idle-0", "idle-1", "idle-2", "idle-3"]
+        assert len(files) == 2 * len(names)
+        assert sorted({name.split("_")[0] for name in files}) == names
+        runs = [open_time_diffs(str(directory / name)).tolist() for name in files if name.startswith("PMT")]
+        assert sorted(runs) == [[1e-6] * 3, [2e-6] * 3]
+    finally:
+        reader.close()
+
+
+def test_rf_histogram_quantiles_interpolate_within_bins():
+    histogram = Counters.RF_Histogram(10, 10.0)
+    histogram.add(np.arange(0.5, 10.0, 1.0))
+    assert histogram.total() == 10
+    assert histogram.quantile(0.5) == pytest.approx(5.0)
+    assert histogram.quantile(0.25) == pytest.approx(2.5)
+
+
+def test_rf_histogram_fits_the_sine():
+    frequency, period = 20e6, 50e-9
+    histogram = Counters.RF_Histogram(200, period)
+    centres = (histogram.edges[:-1] + histogram.edges[1:]) / 2
+    histogram.counts[:] = np.round(1000 + 300 * np.sin(2 * np.pi * frequency * centres + 0.5))
+    popt, hist, bin_edges = histogram.result(frequency)
+    assert popt[0] == pytest.approx(300, rel=1e-2)
+    assert popt[2] == pytest.approx(0.5, abs=1e-2)
+    assert popt[3] == pytest.approx(1000, rel=1e-3)
+    assert len(hist) == len(bin_edges) - 1
+
+
+@pytest.mark.parametrize("no_bins", [1, 2])
+def test_rf_histogram_with_too_few_bins_gives_a_nan_fit(no_bins):
+    histogram = Counters.RF_Histogram(no_bins, 50e-9)
+    histogram.add(np.linspace(1e-9, 49e-9, 100))
+    popt, hist, bin_edges = histogram.result(20e6)
+    assert np.all(np.isnan(popt)) and len(popt) == 4
+    assert hist.sum() == 100 and len(bin_edges) == no_bins + 1
+    assert np.all(np.isnan(histogram.result()[0]))
+
+
+def test_fit_sine_wave_finds_the_frequency():
+    x = np.linspace(0, 1, 500, endpoint=False)
+    y = 2 * np.sin(2 * np.pi * 7.3 * x + 1.0) + 3
+    amplitude, frequency, phase, offset = Counters.fit_sine_wave(x, y)
+    assert frequency == pytest.approx(7.3, rel=1e-2)
+    assert amplitude == pytest.approx(2, rel=2e-2) and offset == pytest.approx(3, rel=1e-2)
+
+
+def test_only_the_default_consumer_keeps_its_events(reader):
+    reader.clear_data()
+    reader.clear_data("remote")
+    time.sleep(0.05)
+    tstamp, tchannel = reader.get_data()
+    time.sleep(0.05)
+    remote, _ = reader.get_last_timestamps()
+    assert reader.tstamp is tstamp and reader.tchannel is tchannel
+    assert remote[-1] > tstamp[-1]
@@ -0,0 +1,75 @@
+import csv
+import time
+import numpy as np
+
+from adriq.Data_Logger import Data_Logger, read_log, export_csv
+
+
+def test_log_round_trip(tmp_path):
+    path = str(tmp_path / "counts.npylog")
+    logger = Data_Logger(path, ["PMT", "APD"], batch_size=4)
+    for i in range(10):
+        logger.log(100.0 + i, [i, 2 * i])
+    logger.log_many([110.0, 111.0], [[10, 20], [11, 22]])
+    logger.close()
+    names, segments = read_log(path)
+    assert names == ["PMT", "APD"]
+    assert len(segments) == 1
+    times, values = segments[0]
+    assert times.tolist() == [100.0 + i for i in range(12)]
+    assert values[:, 1].tolist() == [2 * i for i in range(12)]
+
+
+def test_samples_of_different_shapes_are_kept_apart(tmp_path):
+    path = str(tmp_path / "scope.npylog")
+    logger = Data_Logger(path, ["CH1"])
+    logger.log(1.0, [np.arange(3)])
+    logger.log(2.0, [np.arange(3)])
+    logger.log(3.0, [np.arange(5)])
+    logger.close()
+    _, segments = read_log(path)
+    assert [values.shape for _, values in segments] == [(2, 1, 3), (1, 1, 5)]
+
+
+def test_rotation_and_csv_export(tmp_path):
+    path = str(tmp_path / "counts.npylog")
+    logger = Data_Logger(path, ["PMT"], batch_size=1, max_bytes=300, csv_export=True)
+    for i in range(40):
+        logger.log(float(i), [i])
+        time.sleep(0.001)
+    logger.close()
+    assert len(logger.files) > 1
+    assert logger.files[1] == str(tmp_path / "counts_1.npylog")
+    times = np.concatenate([times for f in logger.files for times, _ in read_log(f)[1]])
+    assert times.tolist() == [float(i) for i in range(40)]
+    with open(str(tmp_path / "counts.csv"), newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ["Time", "PMT"]
+    assert float(rows[1][1]) == 0
+
+
+def test_full_queue_drops_and_close_does_not_block(tmp_path):
+    path = str(tmp_path / "counts.npylog")
+    logger = Data_Logger(path, ["PMT"], max_queue=2)
+    for i in range(50):
+        logger.log(float(i), [i])
+    start = time.time()
+    logger.close(wait=False)
+    assert time.time() - start < 0.5
+    logger.thread.join(5)
+    assert not logger.thread.is_alive()
+    _, segments = read_log(path)
+    written = sum(len(times) for times, _ in segments)
+    assert written + logger.dropped == 50
+    logger.log(99.0, [1])  # Ignored once closed
+    assert logger.queue.empty()
+
+
+def test_export_csv_lists_array_values(tmp_path):
+    path = str(tmp_path / "scope.npylog")
+    logger = Data_Logger(path, ["CH1"])
+    logger.log(1.0, [np.array([0.5, 1.5])])
+    logger.close()
+    with open(export_csv(path), newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[1] == ["1.0", "[0.5, 1.5]"]
@@ -0,0 +1,339 @@
+import asyncio
+import socket
+import threading
+import time
+import numpy as np
+import pytest
+
+from adriq import Servers
+from adriq.Servers import (Server, Client, Connection, Service_Lock, exclusive, shared, send_msg, recv_msg,
+                           read_msg, release_segments, SHM_THRESHOLD)
+
+
+# Framing -----------------------------------------------------------------
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def exchange(pair, data, segments=None, shared_names=None):
+    a, b = pair
+    sender = threading.Thread(target=send_msg, args=(a, data, segments))
+    sender.start()
+    received = recv_msg(b, shared_names)
+    sender.join()
+    return received
+
+
+def test_plain_objects_round_trip(pair):
+    data = {"method": "get_counts", "args": (1, "two"), "kwargs": {"three": [3.0]}}
+    assert exchange(pair, data) == data
+
+
+def test_arrays_round_trip_out_of_band(pair):
+    data = {"t": np.arange(200000, dtype=np.float64), "c": np.arange(10, dtype=np.int8), "empty": np.zeros(0)}
+    received = exchange(pair, data)
+    for key, array in data.items():
+        assert received[key].dtype == array.dtype
+        np.testing.assert_array_equal(received[key], array)
+    received["t"][0] = 1.0  # Arrays are rebuilt on writable buffers
+
+
+def test_large_arrays_round_trip_through_shared_memory(pair):
+    array = np.arange(SHM_THRESHOLD // 8 * 2, dtype=np.float64)
+    segments, names = {}, []
+    received = exchange(pair, {"big": array, "small": array[:10].copy()}, segments, names)
+    np.testing.assert_array_equal(received["big"], array)
+    np.testing.assert_array_equal(received["small"], array[:10])
+    assert list(segments) == names and len(names) == 1
+    release_segments(segments, names)
+    assert segments == {}
+    # The received array is on the mapped segment, which outlives its release
+    np.testing.assert_array_equal(received["big"], array)
+    received["big"][0] = 1.0
+
+
+def test_messages_on_released_segments_are_skipped_whole(pair):
+    a, b = pair
+    segments = {}
+    send_msg(a, {"big": np.zeros(SHM_THRESHOLD // 8), "tail": np.arange(10)}, segments)
+    release_segments(segments)
+    with pytest.raises(FileNotFoundError):
+        recv_msg(b)
+    assert exchange(pair, "next") == "next"
+
+
+def test_recv_returns_none_when_the_connection_closes(pair):
+    a, b = pair
+    a.sendall(b"\x00\x00")
+    a.close()
+    assert recv_msg(b) is None
+
+
+def test_server_reads_arrays_into_writable_buffers(pair):
+    a, b = pair
+    b.setblocking(False)
+
+    async def read():
+        return await read_msg(asyncio.get_running_loop(), b)
+
+    data = {"t": np.arange(200000, dtype=np.float64)}
+    sender = threading.Thread(target=send_msg, args=(a, data))
+    sender.start()
+    received = asyncio.run(read())
+    sender.join()
+    np.testing.assert_array_equal(received["t"], data["t"])
+    received["t"][0] = 1.0
+    a.close()
+    assert asyncio.run(read()) is None
+
+
+# Service_Lock ------------------------------------------------------------
+
+def test_exclusive_holder_can_reenter():
+    lock = Service_Lock()
+    lock.acquire(True)
+    lock.acquire(True)
+    lock.acquire(False)
+    lock.release()
+    lock.release()
+    lock.release()
+    assert lock.owner is None and lock.shared == 0
+
+
+def test_exclusive_from_shared_raises():
+    lock = Service_Lock()
+    lock.acquire(False)
+    with pytest.raises(RuntimeError):
+        lock.acquire(True)
+    lock.release()
+
+
+def test_waiting_exclusive_goes_before_new_shared():
+    lock = Service_Lock()
+    order = []
+    lock.acquire(False)
+
+    def take(exclusive, name):
+        lock.acquire(exclusive)
+        order.append(name)
+        lock.release()
+
+    writer = threading.Thread(target=take, args=(True, "writer"))
+    writer.start()
+    time.sleep(0.05)
+    reader = threading.Thread(target=take, args=(False, "reader"))
+    reader.start()
+    time.sleep(0.05)
+    assert order == []
+    lock.release()
+    writer.join()
+    reader.join()
+    assert order == ["writer", "reader"]
+
+
+# Server and Client -----------------------------------------------------
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+class Service:
+    host = "localhost"
+    port = None
+
+    def __init__(self):
+        self.runs = []
+
+    def record(self, seconds):
+        self.runs.append(seconds)
+        time.sleep(seconds)
+        return seconds
+
+    def echo(self, value):
+        return value
+
+    def delay(self, value, seconds):
+        time.sleep(seconds)
+        return value
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    def fail(self):
+        raise ValueError("nope")
+
+    @shared
+    def read(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    @exclusive
+    def write(self, seconds):
+        time.sleep(seconds)
+        return seconds
+
+    @exclusive
+    def nested(self):
+        return self.write(0) == 0 and self.read(0) == 0
+
+
+@pytest.fixture
+def service():
+    service_class = type("Test_Service", (Service,), {"port": free_port()})
+    server = Server(service_class, 5)
+    thread = threading.Thread(target=server.listen, daemon=True)
+    thread.start()
+    client = Client(service_class, pool_size=1, timeout=10)
+    yield server.service_instance, client
+    client.close()
+    server.shutdown()
+    thread.join(5)
+
+
+def in_parallel(calls):
+    threads = [threading.Thread(target=call) for call in calls]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - start
+
+
+def test_calls_and_errors(service):
+    _, client = service
+    assert client.echo({"a": [1, 2]}) == {"a": [1, 2]}
+    np.testing.assert_array_equal(client.echo(np.arange(SHM_THRESHOLD)), np.arange(SHM_THRESHOLD))
+    with pytest.raises(Exception, match="nope"):
+        client.fail()
+    with pytest.raises(Exception, match="no_such_method"):
+        client.no_such_method()
+
+
+def test_responses_return_out_of_order_on_one_connection(service):
+    _, client = service
+    finished = []
+    slow = threading.Thread(target=lambda: finished.append(("slow", client.sleep(0.5))))
+    slow.start()
+    time.sleep(0.05)
+    finished.append(("fast", client.echo(1)))
+    slow.join()
+    assert finished == [("fast", 1), ("slow", 0.5)]
+    assert len(client._pool) == 1
+
+
+def test_undeclared_and_shared_methods_run_concurrently(service):
+    _, client = service
+    assert in_parallel([lambda: client.sleep(0.3) for _ in range(5)]) < 0.9
+    assert in_parallel([lambda: client.read(0.3) for _ in range(5)]) < 0.9
+
+
+def test_exclusive_methods_run_alone(service):
+    _, client = service
+    assert in_parallel([lambda: client.write(0.1) for _ in range(4)]) >= 0.4
+    assert in_parallel([lambda: client.read(0.2), lambda: client.write(0.2)]) >= 0.4
+    assert client.nested()
+
+
+def test_in_process_calls_share_the_lock(service):
+    instance, client = service
+    thread = threading.Thread(target=instance.write, args=(0.3,))
+    thread.start()
+    time.sleep(0.05)
+    start = time.time()
+    client.write(0)
+    assert time.time() - start >= 0.2
+    thread.join()
+
+
+def test_client_reconnects_after_the_connection_drops(service):
+    _, client = service
+    assert client.echo(1) == 1
+    client._pool[0].sock.shutdown(socket.SHUT_RDWR)
+    time.sleep(0.05)
+    assert client.echo(2) == 2
+
+
+def test_calls_that_may_have_run_are_not_retried(service):
+    instance, client = service
+    assert client.echo(1) == 1
+    timer = threading.Timer(0.1, client._pool[0].sock.shutdown, args=(socket.SHUT_RDWR,))
+    timer.start()
+    with pytest.raises(ConnectionError):
+        client.record(0.3)
+    timer.join()
+    time.sleep(0.4)
+    assert instance.runs == [0.3]
+
+
+def test_timed_out_calls_release_their_segments(service):
+    _, client = service
+    owned = set(Servers._owned)
+    client.timeout = 0.1
+    with pytest.raises(TimeoutError):
+        client.delay(np.arange(SHM_THRESHOLD), 0.3)
+    time.sleep(0.4)  # The late response's segment is released by the client too
+    assert Servers._owned == owned
+    client.timeout = 10
+    assert client.echo(1) == 1
+
+
+def test_idle_connections_are_checked_before_reuse(service):
+    _, client = service
+    client.health_check_interval = 0
+    assert client.echo(1) == 1
+    connection = client._pool[0]
+    assert client.echo(2) == 2
+    assert client._pool == [connection]
+    assert connection.calls == 3  # echo, PING, echo
+
+
+def test_shutdown_closes_the_service_after_the_running_calls():
+    events = []
+
+    class Closing_Service(Service):
+        port = free_port()
+
+        def record(self, seconds):
+            super().record(seconds)
+            events.append("call finished")
+
+        def close(self):
+            events.append("closed")
+
+    server = Server(Closing_Service, 5)
+    thread = threading.Thread(target=server.listen, daemon=True)
+    thread.start()
+    client = Client(Closing_Service, pool_size=1, timeout=10)
+
+    def call():
+        try:
+            client.record(0.3)
+        except ConnectionError:
+            pass  # Hung up on by the shutdown
+
+    caller = threading.Thread(target=call)
+    caller.start()
+    time.sleep(0.1)
+    server.shutdown()
+    assert events == ["call finished", "closed"]
+    caller.join()
+    client.close()
+    thread.join(5)
+
+
+def test_health_check_drops_an_unresponsive_connection():
+    with socket.socket() as listener:
+        listener.bind(("localhost", 0))
+        listener.listen(1)
+        connection = Connection("localhost", listener.getsockname()[1])
+        assert not connection.check(timeout=0.1)
+        assert not connection.alive